@@ -0,0 +1,119 @@
+##############################################################
+# Automatic self-calibration loop
+#
+# Phase-only rounds with shrinking solints, down to the minimum solint for
+# S/N 3 per antenna/spw/polarization (sensitivity.minsolint), then an optional
+# amplitude round.  After each round the image is made and its peak S/N
+# compared with the previous accepted round; the loop stops as soon as the
+# fractional improvement is below mingain, and that round's table is
+# dropped.  Accepted tables are recorded in prefix+'_autocal.json'.
+#
+#   tables = autocal.run(cvis, mvis, peak, rms, minsol, gaincalpars,
+#                        tcleanpars, statboxes)
+##############################################################
+
+import json
+import math
+import os
+
+
+def solints(minsol, inttime, start=120., factor=2.):
+    """Shrinking solints from start down to minsol, as multiples of inttime."""
+    last = inttime * math.ceil(minsol / inttime)
+    out = []
+    s = max(start, last)
+    while s > last:
+        out.append(inttime * max(1, round(s / inttime)))
+        s /= factor
+    out.append(last)
+    # rounding can produce repeats
+    return sorted(set(out), reverse=True)
+
+
+def inttime(vis):
+    """Median integration time (s) of vis."""
+    import msmeta
+    t = sorted(sc['inttime'] for sc in msmeta.get(vis)['scans'].values())
+    return float(t[len(t) // 2])
+
+
+def _image(vis, imagename, tcleanpars, boxes):
+    import imstats
+    import psfcache
+    os.system('rm -rf ' + imagename + '.*')
+    # phase rounds apply with calwt=False, so the PSF of the first round is reused
+    pars = dict(tcleanpars)
+    pars.setdefault('savemodel', 'modelcolumn')      # or 'virtual' (modelmode)
+    psfcache.tclean(vis=vis, imagename=imagename, **pars)
+    st = imstats.stats(imagename, boxes)
+    return st['peak']['max'], st['noise']['rms']
+
+
+def run(vis, prefix, peak, rms, minsol, gaincalpars, tcleanpars, boxes,
+        mingain=0.05, start=120., amp=True, ampsolint=None, calwt=True, log=print):
+    """Self-calibrate vis until the peak S/N stops improving by mingain.
+
+    peak, rms are of the image that made the current model (step 3); minsol
+    is the minimum phase solint in s.  gaincalpars are passed to every
+    gaincal (field, refant, refantmode ...), tcleanpars to every tclean.
+    Caltables are prefix+'.p0', '.p1', ... and '.a1', images
+    prefix+'_contp0.clean' etc.  Returns the accepted gaintables; if none
+    is, the calibration of vis is cleared again.
+    """
+    import casatasks
+
+    tables = []
+    snr = peak / rms
+    history = [{'round': 'initial', 'peak': peak, 'rms': rms, 'snr': snr}]
+    rounds = [('p%d' % i, '%gs' % s, 'p') for i, s in
+              enumerate(solints(minsol, inttime(vis), start))]
+    if amp:
+        rounds.append(('a1', ampsolint or rounds[0][1], 'a'))
+
+    for name, solint, calmode in rounds:
+        caltable = prefix + '.' + name
+        os.system('rm -rf ' + caltable)
+        casatasks.gaincal(vis=vis, caltable=caltable, gaintable=tables, spw='',
+                          solint=solint, calmode=calmode,
+                          gaintype='T' if calmode == 'p' and name != 'p0' else 'G',
+                          **gaincalpars)
+        casatasks.applycal(vis=vis, gaintable=tables + [caltable],
+                           applymode='calonly', calwt=False, flagbackup=False)
+        newpeak, newrms = _image(vis, prefix + '_cont' + name + '.clean', tcleanpars, boxes)
+        gain = (newpeak / newrms - snr) / snr
+        log('Self-cal %s solint %s: peak %5.3f mJy rms %5.3f mJy S/N %5i (%+.1f%%)'
+            % (name, solint, newpeak * 1000., newrms * 1000., newpeak / newrms, 100. * gain))
+        history.append({'round': name, 'solint': solint, 'peak': newpeak,
+                        'rms': newrms, 'snr': newpeak / newrms, 'gain': gain})
+        if gain < mingain:
+            log('Improvement below %g, dropping %s and stopping' % (mingain, name))
+            break
+        tables.append(caltable)
+        snr = newpeak / newrms
+
+    # leave the data calibrated with the accepted tables only
+    if tables:
+        casatasks.applycal(vis=vis, gaintable=tables, applymode='calonly',
+                           calwt=calwt, flagbackup=False)
+    else:
+        casatasks.clearcal(vis=vis)            # undo the rejected first round
+    with open(prefix + '_autocal.json', 'w') as f:
+        json.dump({'gaintable': tables, 'history': history}, f, indent=1)
+    return tables
+
+
+def accepted(prefix):
+    """Gaintables accepted by a previous run, or None."""
+    if not os.path.exists(prefix + '_autocal.json'):
+        return None
+    with open(prefix + '_autocal.json') as f:
+        return json.load(f)['gaintable']
+
+
+def history(prefix):
+    """Peak, rms and S/N of each round of a previous run (the first is the
+    initial image), or []."""
+    if not os.path.exists(prefix + '_autocal.json'):
+        return []
+    with open(prefix + '_autocal.json') as f:
+        return json.load(f)['history']
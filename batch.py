@@ -0,0 +1,156 @@
+##############################################################
+# Run the script for several bands/datasets at once
+#
+# Each config in configs/ is one job: a CASA process running
+# selfcal_script.py with bandconfig set to that file.  Jobs start as soon
+# as the jobs they come after have succeeded and their cores and memory fit
+# in what is left of the caps, so B6 and B7 self-calibrate side by side and
+# the combined B6B7 stage starts when both are done.  Config keys read here:
+#   resources  {"cores": 8, "memgb": 64, "mpi": false}  (mpi: run under mpicasa -n cores)
+#   after      names (config file names without .json) of jobs to wait for
+#   steps      e.g. "0-13" or [0, 1, 2]; default all
+#   split      {vis: outputvis} split with datacolumn='corrected' before
+#              the script runs, e.g. the self-calibrated band MSs
+#   workdir    directory to run in (default the current one)
+# Output of each job goes to <name>.batch.log in its workdir.
+#
+#   python batch.py configs/B6.json configs/B7.json configs/B6B7.json --cores 32 --memgb 240
+##############################################################
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import runconfig
+
+_DRIVER = '''import os, sys
+bandconfig = %r
+for vis, out in %r.items():
+    if not os.path.exists(out):
+        split(vis=vis, outputvis=out, datacolumn='corrected')
+__file__ = %r
+for mysteps in %r:
+    exec(open(__file__).read())
+'''
+
+
+class Job:
+    def __init__(self, path, script, casa):
+        cfg = runconfig.load(path)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.path = os.path.abspath(path)
+        res = cfg.get('resources', {})
+        self.cores = int(res.get('cores', 4))
+        self.memgb = float(res.get('memgb', 32))
+        self.mpi = bool(res.get('mpi', False))
+        self.after = list(cfg.get('after', []))
+        self.steps = runconfig.steps(cfg['steps']) if 'steps' in cfg else []
+        # contchans 'auto' needs the concatenated MS: run step 0 on its own first
+        self.phases = [self.steps]
+        if cfg.get('contchans') == 'auto' and (not self.steps or 0 in self.steps):
+            self.phases = [[0], self.steps]
+        self.split = cfg.get('split', {})
+        self.workdir = os.path.abspath(cfg.get('workdir', '.'))
+        self.script = script
+        self.casa = casa
+        self.proc = None
+        self.status = 'waiting'
+        self.t0 = self.t1 = None
+
+    def start(self, cores):
+        """Write the driver and start CASA on it with cores threads."""
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        driver = os.path.join(self.workdir, self.name + '.batch.py')
+        with open(driver, 'w') as f:
+            f.write(_DRIVER % (self.path, self.split, self.script, self.phases))
+        cmd = self.casa.split() + ['--nogui', '--nologger', '--log2term', '-c', driver]
+        if self.mpi:
+            cmd = ['mpicasa', '-n', str(cores)] + cmd
+        env = dict(os.environ, OMP_NUM_THREADS=str(cores))
+        self.log = open(os.path.join(self.workdir, self.name + '.batch.log'), 'a')
+        self.proc = subprocess.Popen(cmd, cwd=self.workdir, env=env,
+                                     stdout=self.log, stderr=subprocess.STDOUT)
+        self.status = 'running'
+        self.t0 = time.time()
+
+    def poll(self):
+        if self.proc is None or self.proc.poll() is None:
+            return False
+        self.log.close()
+        self.t1 = time.time()
+        self.status = 'done' if self.proc.returncode == 0 else 'failed (%i)' % self.proc.returncode
+        return True
+
+
+def schedule(jobs, cores, memgb, interval=10., log=print):
+    """Run the jobs within the caps, respecting their order; True if all succeeded."""
+    byname = {j.name: j for j in jobs}
+    for j in jobs:
+        missing = [a for a in j.after if a not in byname]
+        if missing:
+            raise ValueError('%s comes after unknown job(s) %s' % (j.name, ', '.join(missing)))
+        if j.cores > cores or j.memgb > memgb:
+            log('%s needs %i cores / %g GB, more than the caps; it will run alone' %
+                (j.name, j.cores, j.memgb))
+    while True:
+        running = [j for j in jobs if j.status == 'running']
+        for j in running:
+            if j.poll():
+                log('%s %s after %.0f min' % (j.name, j.status, (j.t1 - j.t0) / 60.))
+        running = [j for j in jobs if j.status == 'running']
+        for j in jobs:
+            if j.status == 'waiting' and any(byname[a].status.startswith(('failed', 'skipped'))
+                                             for a in j.after):
+                j.status = 'skipped'
+                log('%s skipped, an earlier job failed' % j.name)
+        used = sum(min(j.cores, cores) for j in running)
+        usedmem = sum(min(j.memgb, memgb) for j in running)
+        for j in jobs:
+            if j.status != 'waiting' or any(byname[a].status != 'done' for a in j.after):
+                continue
+            c, m = min(j.cores, cores), min(j.memgb, memgb)
+            if used + c <= cores and usedmem + m <= memgb:
+                j.start(c)
+                used += c
+                usedmem += m
+                log('%s started (%i cores, %g GB), log %s' %
+                    (j.name, c, m, os.path.join(j.workdir, j.name + '.batch.log')))
+        if all(j.status != 'waiting' and j.status != 'running' for j in jobs):
+            break
+        if not any(j.status == 'running' for j in jobs) and \
+           not any(j.status == 'waiting' and all(byname[a].status == 'done' for a in j.after)
+                   for j in jobs):
+            for j in jobs:                  # circular 'after'
+                if j.status == 'waiting':
+                    j.status = 'skipped'
+                    log('%s skipped, waits on itself' % j.name)
+            break
+        time.sleep(interval)
+    for j in jobs:
+        log('%-10s %s' % (j.name, j.status))
+    return all(j.status == 'done' for j in jobs)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description='Run selfcal_script.py for several band configs '
+                                'concurrently within core and memory caps.')
+    p.add_argument('configs', nargs='+', help='JSON config files, e.g. configs/B6.json')
+    p.add_argument('--cores', type=int, default=os.cpu_count(), help='total cores (default all)')
+    p.add_argument('--memgb', type=float, default=None, help='total memory in GB (default all)')
+    p.add_argument('--casa', default='casa', help='CASA command (default casa)')
+    p.add_argument('--script', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                    'selfcal_script.py'))
+    p.add_argument('--interval', type=float, default=10., help='seconds between polls')
+    args = p.parse_args(argv)
+    memgb = args.memgb
+    if memgb is None:
+        memgb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.**3
+    jobs = [Job(c, os.path.abspath(args.script), args.casa) for c in args.configs]
+    return 0 if schedule(jobs, args.cores, memgb, args.interval) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
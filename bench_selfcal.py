@@ -0,0 +1,187 @@
+##############################################################
+# Benchmarks of the self-cal pipeline stages on synthetic data
+#
+# Runs on a plain Linux box with NumPy only (no CASA, no real data): the
+# datasets come from synthvis, shaped like 2021.1.00917.S (TDM spws of
+# 128 channels, point source plus lines, antenna gain errors).  Each stage
+# (contchans parsing, sensitivity prediction, line-free detection, continuum
+# subtraction, gain solving, image statistics) is timed over a few repeats
+# and reported as throughput with the peak memory NumPy allocated.  Step 2
+# averages with CASA mstransform, which cannot run here: 'line-free averaging
+# (model)' times a NumPy stand-in for it (contavg below), not pipeline code.
+# The B6 contchans are repeated over the spws beyond its 40 for larger --nspw.
+#
+#   python bench_selfcal.py                       # 12 antennas, 40 spws
+#   python bench_selfcal.py --nant 45 --ntime 20 --save base.json
+#   python bench_selfcal.py --compare base.json   # ratios against a baseline
+##############################################################
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+import chansel
+import gainsolve
+import imstats
+import linefree
+import sensitivity
+import synthvis
+import uvcontsub
+
+# the B6 contchans, as in selfcal_script.py
+CONTCHANS = ('17:0~88;101~112,19:0~123, 21:0~9;34~55;59~72;85~89;97~123, 23:0~17;38~90,'
+             '29:0~90;93~123,31:0~8;33~40;74~123, 33:25~123,35:0~87;95~106;114~120,'
+             '41:0~41;51~63;68~85;116~123, 43:0~48;90~101,45:0~88;108~123,47:0~33;71~90;107~123,'
+             '53:0~123,55:0~120,57:12~24;54~95,59:15~44;65~80;93~104;116~123,'
+             '65:46~58;75~80;86~89;97~123,67:0~54;71~78;122~123,69:0~27;77~93;108~123,71:0~123,'
+             '133:0~34;52~76;95~123,135:15~123,137:0~104,139:37~80;103~111,'
+             '145:0~9;18~26;34~42;64~78;84~89;99~111,147:0~39;56~77;92~96,149:0~33;72~83;118~123,'
+             '151:14~29;38~45;50~86;115~123,'
+             '157:0~123,159:26~123,161:0~32;41~58;69~101,163:45~101;108~115,'
+             '169:0~110,171:0~8;32~79;91~123,173:0~5;37~123,175:0~7;24~64;73~123,'
+             '181:0~51;69~76;91~117,183:0~123,185:0~58;115~123,187:0~20;52~123')
+
+
+def contchans(nspw):
+    """CONTCHANS for nspw spws: its channel ranges in order, repeated as needed."""
+    sel = chansel.parse(CONTCHANS)
+    ids = sel.spws
+    ranges = {}
+    for i in range(nspw):
+        spw = ids[i] if i < len(ids) else ids[-1] + 2 * (i - len(ids) + 1)
+        ranges[spw] = sel.ranges[ids[i % len(ids)]]
+    return chansel.ChanSel(ranges)
+
+
+def timeit(func, repeat):
+    """Best wall time (s) of repeat calls and the peak traced memory (MB)."""
+    best = np.inf
+    tracemalloc.start()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return best, peak
+
+
+def contavg(data, flag, weight, mask, nout=1):
+    """Weighted average of the line-free channels to nout channels, a NumPy
+    model of the mstransform chanaverage of step 2."""
+    chans = np.flatnonzero(mask)
+    bins = np.array_split(chans, nout)
+    w = np.where(flag, 0., weight[:, None, :])
+    out = np.empty(data.shape[:1] + (nout,) + data.shape[2:], dtype=data.dtype)
+    wout = np.empty(out.shape, dtype=np.float32)
+    for i, b in enumerate(bins):
+        wsum = w[:, b, :].sum(axis=1)
+        out[:, i, :] = (data[:, b, :] * w[:, b, :]).sum(axis=1) / np.where(wsum > 0, wsum, 1.)
+        wout[:, i, :] = wsum
+    return out, wout
+
+
+def stages(vis, contsel, imsz, nplane):
+    """{name: (func, units of work, unit name)} for the pipeline stages."""
+    spws = contsel.spws[:len(vis['data'])]
+    ncorr, nchan, nrow = vis['data'][0].shape
+    nvis = ncorr * nchan * nrow * len(spws)
+    masks = [contsel.mask(s, nchan) for s in spws]
+    projs = [uvcontsub.projector(m) for m in masks]
+
+    meta = {'spw': np.array(contsel.spws), 'freq': np.full(len(contsel), 242e9),
+            'chanwidth': np.full(len(contsel), 15.625e6), 'nchan': np.full(len(contsel), nchan),
+            'tos': np.full(len(contsel), 10.), 'inttime': np.full(len(contsel), vis['inttime']),
+            'nants': np.full(len(contsel), vis['nant']),
+            'scans': [(i // 4,) for i in range(len(contsel))]}
+
+    def parse():
+        chansel.parse.cache_clear()
+        chansel.parse(contsel.casa).nchan()
+
+    def predict():
+        sens = sensitivity.predict(meta, contsel)
+        sensitivity.minsolint(sens, 5.)
+
+    def detect():
+        spec = {'spw': np.array(spws), 'vector': np.zeros((len(spws), nchan)),
+                'scalar': np.zeros((len(spws), nchan)), 'chanwidth': np.full(len(spws), 15.625e6)}
+        for i, (d, f, w) in enumerate(zip(vis['data'], vis['flag'], vis['weight'])):
+            vs, a, ws = linefree.accumulate(d, f, w)
+            spec['vector'][i], spec['scalar'][i] = np.abs(vs) / ws, a / ws
+        linefree.detect(spec=spec, log=lambda line: None)
+
+    def average():
+        for d, f, w, m in zip(vis['data'], vis['flag'], vis['weight'], masks):
+            contavg(d, f, w, m)
+
+    def contsub():
+        for d, f, m, p in zip(vis['data'], vis['flag'], masks, projs):
+            uvcontsub.subtract(d, f, m, p)
+
+    vdata = gainsolve.fromsynth(vis)
+
+    def gains():
+        gainsolve.solve(vdata, 'int', refant=[0], calmode='p', gaintype='G')
+
+    rng = np.random.default_rng(0)
+    cube = rng.standard_normal((imsz, imsz, nplane)).astype(np.float32)
+    boxes = {'noise': '10,10,%d,%d' % (imsz - 10, 0.2 * imsz),
+             'peak': '%d,%d,%d,%d' % (0.25 * imsz, 0.25 * imsz, 0.75 * imsz, 0.75 * imsz)}
+
+    def stats():
+        imstats.regionstats(cube, boxes)
+
+    return {'contchans parsing': (parse, contsel.nchan(), 'channels'),
+            'sensitivity prediction': (predict, len(contsel), 'spws'),
+            'line-free detection': (detect, nvis, 'visibilities'),
+            'line-free averaging (model)': (average, nvis, 'visibilities'),
+            'continuum subtraction': (contsub, nvis, 'visibilities'),
+            'gain solving': (gains, nvis, 'visibilities'),
+            'image statistics': (stats, imsz * imsz * nplane, 'pixels')}
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the self-cal pipeline stages on synthetic data')
+    ap.add_argument('--nant', type=int, default=12)
+    ap.add_argument('--nspw', type=int, default=40)
+    ap.add_argument('--ntime', type=int, default=30)
+    ap.add_argument('--imsz', type=int, default=540)
+    ap.add_argument('--nplane', type=int, default=16, help='cube planes for image statistics')
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--only', default='', help='comma-separated stage names to run')
+    ap.add_argument('--save', help='write results to this JSON file')
+    ap.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = ap.parse_args()
+
+    contsel = contchans(args.nspw)
+    vis = synthvis.make(nant=args.nant, nspw=args.nspw, ntime=args.ntime, spwstep=1.0e9)
+    base = {}
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)['results']
+
+    results = {}
+    print('%d antennas, %d spws x %d channels, %d rows per spw'
+          % (args.nant, args.nspw, vis['data'][0].shape[1], vis['data'][0].shape[2]))
+    print('%-28s %10s %14s %12s %10s' % ('stage', 'time (s)', 'throughput', 'unit/s', 'peak MB'))
+    for name, (func, work, unit) in stages(vis, contsel, args.imsz, args.nplane).items():
+        if args.only and name not in args.only.split(','):
+            continue
+        t, mem = timeit(func, args.repeat)
+        results[name] = {'time': t, 'throughput': work / t, 'unit': unit, 'peak_mb': mem}
+        line = '%-28s %10.4f %14.4g %12s %10.1f' % (name, t, work / t, unit, mem)
+        if name in base:
+            line += '   x%.2f vs baseline' % (work / t / base[name]['throughput'])
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+##############################################################
+# Bad-solution detection in gaincal tables
+#
+# Loads a caltable (.p0, .p1, .a1) into arrays indexed
+# antenna x spw x time x polarization and marks, in one pass:
+#   phase   phase deviates from the running median over time (window
+#           solutions) by > nsigma robust sigma and > minphase deg
+#   amp     log amplitude deviates from the median of that antenna/spw/pol
+#           by > nsigma robust sigma and > minamp
+#   snr     solution S/N < minsnr
+# (robust sigma = 1.4826 MAD over all antennas and times of each spw).
+# Outliers are grouped by antenna and scan into flagdata list commands,
+# one per antenna and set of spws, merging scans, and whole antennas
+# are flagged if more than antfrac of their solutions are bad.
+#
+#   cmds = calflags.review(mvis+'.p0')      # prints a summary, writes .p0.flagcmd
+#   calflags.flag(cvis, badsols, mvis+'.p0')
+##############################################################
+
+import os
+
+import numpy as np
+
+
+def load(caltable):
+    """Solutions as arrays (nant, nspw, ntime, npol): gain, snr, flag.
+
+    Missing solutions are flagged with gain and snr nan.  Also returns the
+    antenna names, spw ids, solution times and the scan of each time.
+    """
+    from casatools import table
+    tb = table()
+    tb.open(caltable + '/ANTENNA')
+    antnames = list(tb.getcol('NAME'))
+    tb.close()
+    tb.open(caltable)
+    try:
+        cols = {c: tb.getcol(c) for c in ('TIME', 'ANTENNA1', 'SPECTRAL_WINDOW_ID',
+                                          'SCAN_NUMBER', 'CPARAM', 'SNR', 'FLAG')}
+    finally:
+        tb.close()
+    spws, si = np.unique(cols['SPECTRAL_WINDOW_ID'], return_inverse=True)
+    # spws of one solint are time-stamped within a second of each other
+    times, ti = np.unique(np.round(cols['TIME']), return_inverse=True)
+    npol = cols['CPARAM'].shape[0]
+    shape = (len(antnames), len(spws), len(times), npol)
+    cal = {'antnames': antnames, 'spw': spws, 'time': times,
+           'scan': np.zeros(len(times), dtype=int),
+           'gain': np.full(shape, np.nan, dtype=complex),
+           'snr': np.full(shape, np.nan),
+           'flag': np.ones(shape, dtype=bool)}
+    ai = cols['ANTENNA1']
+    cal['scan'][ti] = cols['SCAN_NUMBER']
+    cal['gain'][ai, si, ti] = cols['CPARAM'][:, 0, :].T
+    cal['snr'][ai, si, ti] = cols['SNR'][:, 0, :].T
+    cal['flag'][ai, si, ti] = cols['FLAG'][:, 0, :].T
+    return cal
+
+
+def _robust(dev):
+    """1.4826 MAD of dev over all but the spw axis (axis 1), ignoring nan."""
+    return 1.4826 * np.nanmedian(np.abs(np.moveaxis(dev, 1, 0)).reshape(dev.shape[1], -1), axis=1)
+
+
+def outliers(cal, nsigma=5., minphase=20., minamp=0.2, minsnr=3., window=9):
+    """Boolean arrays (nant, nspw, ntime, npol) of bad solutions by kind.
+
+    Returns {'phase', 'amp', 'snr'}; flagged and missing solutions are never outliers.
+    """
+    good = ~cal['flag'] & np.isfinite(cal['gain'])
+    g = np.where(good, cal['gain'], np.nan)
+    out = {'phase': np.zeros(g.shape, dtype=bool), 'amp': np.zeros(g.shape, dtype=bool)}
+
+    # phase against the running median of each antenna/spw/pol, over the times with solutions
+    ph = np.angle(g)
+    dph = np.full(g.shape, np.nan)
+    for s in range(g.shape[1]):
+        t = np.flatnonzero(good[:, s].any(axis=(0, 2)))
+        if len(t) == 0:
+            continue
+        p = ph[:, s][:, t]                                        # (nant, nt, npol)
+        h = window // 2
+        pad = np.pad(p, ((0, 0), (h, h), (0, 0)), constant_values=np.nan)
+        win = np.lib.stride_tricks.sliding_window_view(pad, window, axis=1)
+        # median of unit phasors, so wraps at +-180 do not matter
+        ref = np.angle(np.nanmedian(np.cos(win), axis=-1) + 1j * np.nanmedian(np.sin(win), axis=-1))
+        dph[:, s][:, t] = np.degrees(np.angle(np.exp(1j * (p - ref))))
+    sig = _robust(dph)[None, :, None, None]
+    with np.errstate(invalid='ignore'):
+        out['phase'] = (np.abs(dph) > np.maximum(nsigma * sig, minphase)) & good
+
+        la = np.log(np.abs(g))
+        dla = la - np.nanmedian(la, axis=2, keepdims=True)
+        sig = _robust(dla)[None, :, None, None]
+        out['amp'] = (np.abs(dla) > np.maximum(nsigma * sig, np.log1p(minamp))) & good
+        out['snr'] = (cal['snr'] < minsnr) & good
+    return out
+
+
+def commands(cal, bad, antfrac=0.5, reason='calflags'):
+    """flagdata list commands for the outliers (any kind) in bad."""
+    anybad = np.zeros(cal['gain'].shape, dtype=bool)
+    for b in bad.values():
+        anybad |= b
+    anybad = anybad.any(axis=3)                                   # (nant, nspw, ntime)
+    nsol = (~cal['flag']).any(axis=3).sum(axis=(1, 2))
+    names = cal['antnames']
+    whole = [names[a] for a in np.flatnonzero(anybad.sum(axis=(1, 2)) > antfrac * np.maximum(nsol, 1))]
+    cmds = ["mode='manual' antenna='%s' reason='%s'" % (a, reason) for a in whole]
+    # per antenna and scan, the spws with bad solutions; merge scans with the same spws
+    groups = {}
+    a, s, t = np.nonzero(anybad)
+    for ant, scan, spw in sorted(set(zip(a, cal['scan'][t], cal['spw'][s]))):
+        if names[ant] not in whole:
+            groups.setdefault((ant, scan), set()).add(int(spw))
+    merged = {}
+    for (ant, scan), spws in sorted(groups.items()):
+        merged.setdefault((ant, tuple(sorted(spws))), []).append(int(scan))
+    for (ant, spws), scans in sorted(merged.items()):
+        cmds.append("mode='manual' antenna='%s' scan='%s' spw='%s' reason='%s'"
+                    % (names[ant], ','.join(str(x) for x in scans),
+                       ','.join(str(x) for x in spws), reason))
+    return cmds
+
+
+def review(caltable, log=print, **kw):
+    """Find the outliers in caltable, log a summary and the flag commands.
+
+    The commands are also written to caltable+'.flagcmd'; keyword arguments
+    go to outliers().  Returns the commands.
+    """
+    cal = load(caltable)
+    bad = outliers(cal, **kw)
+    nsol = int((~cal['flag']).sum())
+    log('%s: %i solutions, %i antennas x %i spws x %i times' %
+        ((caltable, nsol) + cal['gain'].shape[:3]))
+    for kind, b in bad.items():
+        if b.any():
+            per = b.any(axis=3).sum(axis=(1, 2))
+            worst = ', '.join('%s %i' % (cal['antnames'][i], per[i])
+                              for i in np.argsort(-per)[:5] if per[i])
+            log('  %-5s outliers %5i  (%s)' % (kind, int(b.sum()), worst))
+    cmds = commands(cal, bad, reason=os.path.basename(caltable))
+    with open(caltable + '.flagcmd', 'w') as f:
+        f.write('\n'.join(cmds) + '\n')
+    for c in cmds:
+        log('  ' + c)
+    return cmds
+
+
+def flag(vis, badsols, caltable=None, log=print):
+    """Flag vis with badsols: a flagdata selection dict, a list of flag
+    commands, or 'auto' for the outliers in caltable (its .flagcmd file if
+    review() has written one)."""
+    import casatasks
+    if isinstance(badsols, dict):
+        if badsols:
+            casatasks.flagdata(vis=vis, mode='manual', **badsols)
+        return
+    if badsols == 'auto':
+        if caltable is None or not os.path.exists(caltable):
+            log('No caltable to find bad solutions in, nothing flagged')
+            return
+        if os.path.exists(caltable + '.flagcmd') and \
+           os.path.getmtime(caltable + '.flagcmd') >= os.path.getmtime(caltable):
+            with open(caltable + '.flagcmd') as f:
+                badsols = [c for c in f.read().splitlines() if c]
+        else:
+            badsols = review(caltable, log=log)
+    if badsols:
+        casatasks.flagdata(vis=vis, mode='list', inpfile=list(badsols))
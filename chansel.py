@@ -0,0 +1,197 @@
+##############################################################
+# Channel selections in CASA 'spw:ch~ch;ch~ch,spw:...' syntax
+#
+# The selection is parsed once into a dict of per-spw NumPy arrays of
+# inclusive [start, end] channel intervals, sorted and merged, so that
+# channel counts, bandwidths, masks and set operations are cheap.
+#
+#   contsel = chansel.parse(contchans)
+#   contsel.nchan()            total line-free channels
+#   contsel.ghz(contchwd)      total line-free bandwidth
+#   contsel.complement(128)    line channels
+#   contsel.casa               back to a selection string
+##############################################################
+
+import re
+from functools import lru_cache
+
+import numpy as np
+
+_spwre = re.compile(r'^(\d+)(?::(.*))?$')
+_chanre = re.compile(r'^(\d+)(?:~(\d+))?$')
+
+
+def _merge(iv):
+    """Sort and merge overlapping or adjacent intervals, (n,2) int array."""
+    iv = np.asarray(iv, dtype=np.int64).reshape(-1, 2)
+    if len(iv) < 2:
+        return iv
+    iv = iv[np.argsort(iv[:, 0], kind='stable')]
+    ends = np.maximum.accumulate(iv[:, 1])
+    new = np.ones(len(iv), dtype=bool)
+    new[1:] = iv[1:, 0] > ends[:-1] + 1
+    starts = iv[new, 0]
+    last = np.append(np.flatnonzero(new)[1:] - 1, len(iv) - 1)
+    return np.column_stack((starts, ends[last]))
+
+
+def _intersect(a, b):
+    lo = np.maximum(a[:, None, 0], b[None, :, 0]).ravel()
+    hi = np.minimum(a[:, None, 1], b[None, :, 1]).ravel()
+    keep = lo <= hi
+    return _merge(np.column_stack((lo[keep], hi[keep])))
+
+
+def _perspw(value, spw):
+    if isinstance(value, dict):
+        return value[spw]
+    return value
+
+
+class ChanSel(object):
+    """Immutable channel selection, {spw: (n,2) array of inclusive ranges}."""
+
+    def __init__(self, ranges):
+        self.ranges = {}
+        for spw in sorted(ranges):
+            iv = _merge(ranges[spw])
+            if len(iv):
+                iv.setflags(write=False)
+                self.ranges[int(spw)] = iv
+        self._casa = None
+        self._counts = None
+
+    @property
+    def spws(self):
+        return list(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __contains__(self, spw):
+        return spw in self.ranges
+
+    def __eq__(self, other):
+        if not isinstance(other, ChanSel):
+            return NotImplemented
+        return self.casa == other.casa
+
+    def __hash__(self):
+        return hash(self.casa)
+
+    def __repr__(self):
+        return 'ChanSel(%r)' % self.casa
+
+    def __str__(self):
+        return self.casa
+
+    @property
+    def casa(self):
+        """Selection string in CASA syntax, e.g. '17:0~88;101~112,19:0~123'."""
+        if self._casa is None:
+            self._casa = ','.join(
+                '%d:%s' % (spw, ';'.join('%d~%d' % (s, e) for s, e in iv))
+                for spw, iv in self.ranges.items())
+        return self._casa
+
+    def counts(self):
+        """Number of selected channels per spw, {spw: n}."""
+        if self._counts is None:
+            self._counts = {spw: int((iv[:, 1] - iv[:, 0] + 1).sum())
+                            for spw, iv in self.ranges.items()}
+        return self._counts
+
+    def nchan(self, spw=None):
+        """Selected channels in one spw, or in total if spw is None."""
+        if spw is not None:
+            return self.counts().get(spw, 0)
+        return sum(self.counts().values())
+
+    def spwghz(self, chanwidth):
+        """Selected bandwidth per spw in GHz.
+
+        chanwidth is the channel width in GHz, either one value for all
+        spws or a dict keyed by spw.
+        """
+        return {spw: n * abs(_perspw(chanwidth, spw))
+                for spw, n in self.counts().items()}
+
+    def ghz(self, chanwidth):
+        """Total selected bandwidth in GHz."""
+        return sum(self.spwghz(chanwidth).values())
+
+    def mask(self, spw, nchan):
+        """Boolean mask of length nchan, True for selected channels."""
+        m = np.zeros(nchan, dtype=bool)
+        for s, e in self.ranges.get(spw, ()):
+            m[s:e + 1] = True
+        return m
+
+    def union(self, other):
+        ranges = {spw: iv for spw, iv in self.ranges.items()}
+        for spw, iv in other.ranges.items():
+            ranges[spw] = np.vstack((ranges[spw], iv)) if spw in ranges else iv
+        return ChanSel(ranges)
+
+    def intersection(self, other):
+        return ChanSel({spw: _intersect(iv, other.ranges[spw])
+                        for spw, iv in self.ranges.items()
+                        if spw in other.ranges})
+
+    def complement(self, nchan, spws=None):
+        """Channels not selected, e.g. the line channels of contchans.
+
+        nchan is the number of channels per spw (int or dict keyed by spw);
+        spws defaults to the spws present in this selection.
+        """
+        if spws is None:
+            spws = self.spws
+        ranges = {}
+        for spw in spws:
+            n = _perspw(nchan, spw)
+            iv = self.ranges.get(spw)
+            if iv is None:
+                ranges[spw] = [[0, n - 1]]
+                continue
+            iv = iv[(iv[:, 0] < n)]
+            starts = np.append(0, iv[:, 1] + 1)
+            ends = np.append(iv[:, 0] - 1, n - 1)
+            keep = starts <= ends
+            ranges[spw] = np.column_stack((starts[keep], ends[keep]))
+        return ChanSel(ranges)
+
+    __or__ = union
+    __and__ = intersection
+
+
+@lru_cache(maxsize=64)
+def parse(sel, nchan=None):
+    """Parse a CASA channel selection string into a ChanSel (cached).
+
+    A bare spw id (no ':') selects the whole spw and needs nchan.
+    """
+    ranges = {}
+    for item in re.sub(r'\s+', '', sel).split(','):
+        if not item:
+            continue
+        m = _spwre.match(item)
+        if m is None:
+            raise ValueError('cannot parse spw selection %r' % item)
+        spw = int(m.group(1))
+        if m.group(2) is None:
+            if nchan is None:
+                raise ValueError('spw %d selected without channels, nchan needed' % spw)
+            iv = [(0, nchan - 1)]
+        else:
+            iv = []
+            for chans in m.group(2).split(';'):
+                c = _chanre.match(chans)
+                if c is None:
+                    raise ValueError('cannot parse channel range %r in spw %d' % (chans, spw))
+                s = int(c.group(1))
+                e = int(c.group(2)) if c.group(2) is not None else s
+                if e < s:
+                    raise ValueError('empty channel range %r in spw %d' % (chans, spw))
+                iv.append((s, e))
+        ranges[spw] = ranges[spw] + iv if spw in ranges else iv
+    return ChanSel(ranges)
@@ -0,0 +1,126 @@
+##############################################################
+# Column-level MS checkpoints
+#
+# Before a step that changes weights and flags in place (applycal with
+# calwt), save just the columns it mutates - WEIGHT, SIGMA, FLAG and their
+# _SPECTRUM versions if present, optionally CORRECTED_DATA - to compressed
+# .npz blocks in a side directory, instead of copying the whole MS.
+#
+#   checkpoint.save(cvis, cvis+'_prefinalapplycalwt.ckpt')
+#   checkpoint.restore(cvis, cvis+'_prefinalapplycalwt.ckpt')   # undo
+#
+# snapshot() first tries a full copy by reflink (btrfs, XFS with reflink),
+# which costs no extra disk until blocks change, and falls back to the
+# column checkpoint where the filesystem can't do that.  restore() takes
+# either form, or the dest given to snapshot():
+#
+#   checkpoint.snapshot(cvis, cvis+'_prefinalapplycalwt')
+#   checkpoint.restore(cvis, cvis+'_prefinalapplycalwt')        # undo
+#
+# Hard links are not used: CASA rewrites table files in place, so they
+# would change the original too.
+##############################################################
+
+import glob
+import json
+import os
+import shutil
+import subprocess
+
+import numpy as np
+
+COLUMNS = ['WEIGHT', 'SIGMA', 'FLAG', 'WEIGHT_SPECTRUM', 'SIGMA_SPECTRUM']
+
+
+def _blocks(tb):
+    """(ddid, query table) per data description, rows in one shape each."""
+    for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+        yield int(ddid), tb.query('DATA_DESC_ID==%d' % ddid)
+
+
+def save(vis, store, corrected=False, nrow=200000):
+    """Save the mutable columns of vis to store (a directory)."""
+    from casatools import table
+    os.system('rm -rf ' + store)
+    os.makedirs(store)
+    tb = table()
+    tb.open(vis)
+    try:
+        names = tb.colnames()
+        cols = [c for c in COLUMNS + (['CORRECTED_DATA'] if corrected else [])
+                if c in names and tb.iscelldefined(c, 0)]
+        for ddid, sub in _blocks(tb):
+            rows = sub.rownumbers()
+            for b, r0 in enumerate(range(0, len(rows), nrow)):
+                n = min(nrow, len(rows) - r0)
+                arrays = {c: sub.getcol(c, r0, n) for c in cols}
+                np.savez_compressed(os.path.join(store, 'dd%03d_%05d.npz' % (ddid, b)),
+                                    rows=rows[r0:r0 + n], **arrays)
+            sub.close()
+    finally:
+        tb.close()
+    with open(os.path.join(store, 'checkpoint.json'), 'w') as f:
+        json.dump({'vis': os.path.abspath(vis), 'columns': cols, 'nrow': nrow}, f)
+    return cols
+
+
+def restore(vis, store):
+    """Write the saved columns back into vis in place, or put back the full
+    copy; store is a checkpoint, a copy or the dest of snapshot()."""
+    path = existing(store)
+    if path is None:
+        raise IOError('no checkpoint ' + store)
+    store = path
+    if not os.path.exists(os.path.join(store, 'checkpoint.json')):
+        # a full copy by snapshot(): replace vis by it, keeping the snapshot
+        os.system('rm -rf ' + vis)
+        if not copy(store, vis):
+            shutil.copytree(store, vis, symlinks=True)
+        return
+    from casatools import table
+    with open(os.path.join(store, 'checkpoint.json')) as f:
+        info = json.load(f)
+    tb = table()
+    tb.open(vis, nomodify=False)
+    try:
+        for ddid, sub in _blocks(tb):
+            rows = sub.rownumbers()
+            for fn in sorted(glob.glob(os.path.join(store, 'dd%03d_*.npz' % ddid))):
+                b = int(fn[-9:-4])
+                r0 = b * info['nrow']
+                with np.load(fn) as z:
+                    if not np.array_equal(z['rows'], rows[r0:r0 + len(z['rows'])]):
+                        raise ValueError('%s does not match the rows of %s' % (fn, vis))
+                    for c in info['columns']:
+                        sub.putcol(c, z[c], r0, len(z['rows']))
+            sub.close()
+        tb.flush()
+    finally:
+        tb.close()
+
+
+def copy(src, dst):
+    """Copy src to dst by reflink; False if the filesystem can't do it."""
+    os.system('rm -rf ' + dst)
+    ret = subprocess.call(['cp', '-r', '--reflink=always', src, dst],
+                          stderr=subprocess.DEVNULL)
+    if ret != 0:
+        os.system('rm -rf ' + dst)
+    return ret == 0
+
+
+def existing(dest):
+    """Path of a snapshot made by snapshot(vis, dest), or None."""
+    for path in (dest, dest + '.ckpt'):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def snapshot(vis, dest, corrected=False):
+    """Reflink copy of vis to dest if possible, otherwise a column checkpoint
+    in dest+'.ckpt'.  Returns the path written."""
+    if copy(vis, dest):
+        return dest
+    save(vis, dest + '.ckpt', corrected=corrected)
+    return dest + '.ckpt'
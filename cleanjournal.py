@@ -0,0 +1,173 @@
+##############################################################
+# Resumable deconvolution
+#
+# cleanjournal.tclean() is a drop-in for tclean that deconvolves in
+# segments of a few major cycles (tclean nmajor, or niter blocks of
+# segment x cycleniter where nmajor is not available).  The first segment
+# makes the PSF and residual; each later one continues from the model and
+# residual on disk with calcpsf=False, calcres=False, the restart noted in
+# the header of the script.  After every segment the model, residual and
+# mask (with their .ttN) are snapshotted (reflink where possible) into
+# imagename+'.journal/', and imagename+'.journal.json' records the major
+# cycles and iterations done, the cycle threshold, peak residual and stop
+# code of each segment.  If the job is killed during a segment, the next
+# call restores the last snapshot and goes on from there: no PSF or
+# residual is recomputed and at most one segment is repeated.
+#
+# The journal is keyed on the tclean parameters and a stamp of the data
+# (psfcache.fingerprint: weights, flags, uvw), so a run with other
+# parameters or data starts afresh.  A finished journal also starts
+# afresh: the step runner only calls again when the image must be redone.
+# savemodel is done once, by a niter=0 tclean after the last segment.
+#
+#   cleanjournal.tclean(vis=cvis, imagename=mvis+'_contp0.clean', task=psfcache.tclean,
+#                       segment=cleansegment, niter=200, ...)
+##############################################################
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import checkpoint
+
+SNAPSHOT = ['model', 'residual', 'mask']
+# stop codes: 9 is the nmajor limit, i.e. the segment ended but the run did not
+NMAJOR_STOP = 9
+
+
+def _nmajor():
+    """True if this CASA's tclean has nmajor (6.6 on)."""
+    import inspect
+    import casatasks
+    try:
+        return 'nmajor' in inspect.signature(casatasks.tclean.__call__).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _products(imagename, kinds):
+    n = len(imagename) + 1
+    return [p for p in glob.glob(imagename + '.*') if p[n:].split('.')[0] in kinds]
+
+
+def _copy(src, dst):
+    if not checkpoint.copy(src, dst):          # reflink if possible
+        shutil.copytree(src, dst)
+
+
+def snapshot(imagename):
+    """Copy the model, residual and mask images into imagename+'.journal/'."""
+    d = imagename + '.journal'
+    tmp = d + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for p in _products(imagename, SNAPSHOT):
+        _copy(p, os.path.join(tmp, p[len(imagename):]))
+    shutil.rmtree(d, ignore_errors=True)
+    os.rename(tmp, d)
+
+
+def restore(imagename):
+    """Put the last snapshot back in place of the model, residual and mask."""
+    d = imagename + '.journal'
+    for p in _products(imagename, SNAPSHOT):
+        shutil.rmtree(p, ignore_errors=True)
+    for p in os.listdir(d):
+        _copy(os.path.join(d, p), imagename + p)
+
+
+def load(imagename):
+    fn = imagename + '.journal.json'
+    if os.path.exists(fn):
+        with open(fn) as f:
+            return json.load(f)
+    return {}
+
+
+def _save(journal, imagename):
+    fn = imagename + '.journal.json'
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(journal, f, indent=1, sort_keys=True)
+    os.replace(fn + '.tmp', fn)
+
+
+def tclean(vis, imagename, task=None, segment=5, stamp=None, **pars):
+    """tclean in checkpointed segments of segment major cycles, resuming an
+    interrupted run of the same image; segment=0 is one plain tclean.
+
+    task runs the first segment (e.g. psfcache.tclean, default tclean);
+    stamp identifies the data (default psfcache.fingerprint(vis)).
+    Returns the summary of the last segment with the totals done.
+    """
+    import casatasks
+    import psfcache
+    task = task or casatasks.tclean
+    if stamp is None:
+        stamp = psfcache.fingerprint(vis)
+    key = hashlib.sha1(json.dumps([vis, imagename, pars, stamp], sort_keys=True,
+                                  default=str).encode()).hexdigest()[:16]
+    journal = load(imagename)
+    resume = (journal.get('key') == key and not journal.get('done') and journal.get('segments')
+              and os.path.isdir(imagename + '.journal'))
+    if not resume:
+        for p in glob.glob(imagename + '.*'):
+            if p.endswith('.log'):                # cubechunks writes the chunk log there
+                continue
+            if os.path.isdir(p):
+                shutil.rmtree(p)
+            else:
+                os.remove(p)
+        if segment <= 0 or pars.get('interactive') or pars.get('niter', 0) <= 0:
+            return task(vis=vis, imagename=imagename, **pars)
+        journal = {'key': key, 'done': False, 'segments': [], 'iterdone': 0, 'nmajordone': 0}
+    else:
+        restore(imagename)
+        print('Resuming %s after %d major cycles, %d iterations' %
+              (imagename, journal['nmajordone'], journal['iterdone']))
+
+    savemodel = pars.pop('savemodel', 'none')
+    niter = pars['niter']
+    seg = dict(nmajor=segment) if _nmajor() else \
+        dict(niter=segment * pars['cycleniter']) if pars.get('cycleniter') else {}
+    ret = {}
+    while True:
+        first = not journal['segments']
+        left = niter - journal['iterdone']
+        p = dict(pars, savemodel='none', niter=left)
+        if 'niter' in seg:
+            p['niter'] = min(left, seg['niter'])
+        elif seg:
+            p['nmajor'] = seg['nmajor']
+        if not first:
+            p.update(calcpsf=False, calcres=False)
+        t0 = time.time()
+        ret = (task if first else casatasks.tclean)(vis=vis, imagename=imagename, **p) or {}
+        iters = int(ret.get('iterdone', left))        # no summary: take it as finished
+        journal['iterdone'] += iters
+        journal['nmajordone'] += int(ret.get('nmajordone', 0))
+        journal['segments'].append({'iterdone': iters, 'nmajordone': ret.get('nmajordone'),
+                                    'stopcode': ret.get('stopcode'),
+                                    'stop': ret.get('stopDescription'),
+                                    'threshold': ret.get('cyclethreshold', pars.get('threshold')),
+                                    'peakres': ret.get('peakres'), 'mask': any(_products(imagename, ['mask'])),
+                                    'wall': time.time() - t0, 'time': time.time()})
+        stop = ret.get('stopcode')
+        more = journal['iterdone'] < niter and iters > 0 and (
+            stop == NMAJOR_STOP if 'nmajor' in seg else ('niter' in seg and iters >= p['niter']))
+        if not more:
+            break
+        snapshot(imagename)
+        _save(journal, imagename)
+    if savemodel != 'none':
+        # one prediction of the final model, as savemodel at the end of a single tclean
+        casatasks.tclean(vis=vis, imagename=imagename, **dict(pars, niter=0, calcpsf=False, calcres=False,
+                                                               restoration=False, pbcor=False,
+                                                               savemodel=savemodel))
+    journal['done'] = True
+    _save(journal, imagename)
+    shutil.rmtree(imagename + '.journal', ignore_errors=True)
+    ret = dict(ret, iterdone=journal['iterdone'], nmajordone=journal['nmajordone'])
+    return ret
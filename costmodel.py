@@ -0,0 +1,278 @@
+##############################################################
+# Memory, disk and run-time estimates for the steps (dry run)
+#
+# Visibility volumes come from the MS metadata (msmeta: scans, antennas,
+# integrations, spws and channels), image sizes from imsize, channels,
+# deconvolver and nterms.  Each step is described as a sum of
+#   io      bytes read and written
+#   cal     visibilities through gaincal/applycal
+#   grid    visibilities gridded or degridded (x major cycles, terms, gridder)
+#   fft     image pixels transformed
+#   minor   minor-cycle iterations
+# whose costs are RATES (seconds per unit).  Steps that ran before left
+# their model time in the trace (steptrace, mvis+'_trace_*.json'), so the
+# ratio of the measured to the model time calibrates each step (or, for
+# steps never run, the median ratio of all of them).
+#
+#   model = costmodel.Model([mvis], ncorr=2)
+#   plan = costmodel.Plan({3: model.tclean(contsel, 1, imsz, niter=150)}, mvis+'_trace', memgb=64)
+#   plan.show(3); print(plan.report())
+#   costmodel.recommend(4040, imsz, memgb=64, cores=16)   # cube chunk and workers
+##############################################################
+
+import glob
+import json
+import math
+import os
+
+import numpy as np
+
+import cubechunks
+
+GB = 1024.**3
+# seconds per unit, for one core
+RATES = {'io': 1. / 150e6, 'cal': 5e-8, 'grid': 1e-7, 'fft': 2e-8, 'minor': 2e-5}
+# convolution support relative to the standard gridder
+GRIDDERS = {'standard': 1., 'mosaic': 3., 'wproject': 4., 'awproject': 10.}
+VISBYTES = 8 + 1 + 4          # complex64 visibility, flag, weight spectrum share
+
+
+class Estimate(object):
+    """Work units, peak memory and disk footprint of one step."""
+
+    def __init__(self, vis=0, mem=0., disk=0., nworkers=1, notes=(), **units):
+        self.vis = vis
+        self.mem = mem
+        self.disk = disk
+        self.nworkers = nworkers
+        self.units = units
+        self.notes = list(notes)
+
+    def __add__(self, other):
+        units = dict(self.units)
+        for k, v in other.units.items():
+            units[k] = units.get(k, 0) + v
+        return Estimate(max(self.vis, other.vis), max(self.mem, other.mem), self.disk + other.disk,
+                        max(self.nworkers, other.nworkers), self.notes + other.notes, **units)
+
+    def __mul__(self, n):
+        return Estimate(self.vis, self.mem, self.disk * n, self.nworkers, self.notes,
+                        **{k: v * n for k, v in self.units.items()})
+
+    def seconds(self, rates=RATES):
+        """Model wall time; gridding and FFTs divide over the workers."""
+        t = 0.
+        for k, v in self.units.items():
+            t += v * rates[k] / (self.nworkers if k in ('grid', 'fft') else 1)
+        return t
+
+
+def _meta(vis):
+    import msmeta
+    return msmeta.get(vis)
+
+
+def concatspws(metas, freqtol=2e6):
+    """{input spw: output spw} per MS, numbered as concat does: a spw of a
+    later MS with the nchan and width of an earlier output spw and its
+    frequency within freqtol (Hz) merges into it, others are appended."""
+    out, maps = [], []
+    for meta in metas:
+        m = {}
+        for s in sorted(meta['spws'], key=int):
+            spw = meta['spws'][s]
+            for i, o in enumerate(out):
+                if (o['nchan'] == spw['nchan'] and abs(o['chanwidth'] - spw['chanwidth']) < 1.
+                        and abs(o['freq'] - spw['freq']) <= freqtol):
+                    m[int(s)] = i
+                    break
+            else:
+                m[int(s)] = len(out)
+                out.append(spw)
+        maps.append(m)
+    return maps
+
+
+class Model(object):
+    """Visibility volumes and task estimates for a list of MSs (e.g. [mvis] or msin).
+
+    With concat=True the spws of the list are numbered as in their concat,
+    so selections can use the spw ids of mvis before it exists.
+    """
+
+    def __init__(self, vislist, ncorr=2, concat=False, freqtol=2e6):
+        self.metas = [_meta(v) for v in vislist]
+        self.ncorr = ncorr
+        if concat and len(self.metas) > 1:
+            self.spwmaps = concatspws(self.metas, freqtol)
+        else:
+            self.spwmaps = [{int(s): int(s) for s in m['spws']} for m in self.metas]
+
+    def nvis(self, sel=None, nchanout=None):
+        """Visibilities (rows x channels x correlations) in the spws of sel
+        (its channels, or nchanout per spw after averaging), or all."""
+        n = 0
+        for meta, spwmap in zip(self.metas, self.spwmaps):
+            for sc in meta['scans'].values():
+                nbl = sc['nants'] * (sc['nants'] - 1) // 2
+                for s in sc['spws']:
+                    spw = meta['spws'][str(s)]
+                    s = spwmap[s]
+                    if sel is not None and s not in sel:
+                        continue
+                    if spw['nchan'] < 4 and sel is None:          # WVR, channel averages
+                        continue
+                    nch = spw['nchan'] if sel is None else sel.nchan(s)
+                    if nchanout:
+                        nch = min(nch, nchanout)
+                    n += sc['nint'] * nbl * nch * self.ncorr
+        return n
+
+    def copy(self, sel=None, nchanout=None, insel=None, columns=1):
+        """Read (the spws of insel of) the MS, write sel/nchanout with columns data columns."""
+        nin, nout = self.nvis(insel), self.nvis(sel, nchanout)
+        return Estimate(nin, mem=min(nin * VISBYTES, GB) + 0.5 * GB, disk=nout * VISBYTES * columns,
+                        io=(nin + nout * columns) * VISBYTES)
+
+    def gaincal(self, sel=None, nchanout=None, nsolve=1):
+        n = self.nvis(sel, nchanout)
+        return Estimate(n, mem=min(n * VISBYTES, 2 * GB) + 0.5 * GB, disk=0., cal=n * nsolve,
+                        io=n * VISBYTES)
+
+    def applycal(self, sel=None, nchanout=None):
+        n = self.nvis(sel, nchanout)
+        return Estimate(n, mem=min(n * VISBYTES, GB) + 0.5 * GB, cal=n, io=2 * n * VISBYTES)
+
+    def tclean(self, sel=None, nchanout=None, imsize=540, nchan=1, nterms=1, niter=0,
+               cycleniter=None, gridder='standard', nworkers=1, chunk=None, savemodel=None):
+        """tclean of the selection: mfs (nchan=1, nterms) or a cube of nchan
+        channels imaged chunk channels at a time by nworkers processes;
+        savemodel='modelcolumn' adds writing MODEL_DATA."""
+        n = self.nvis(sel, nchanout)
+        npix = float(imsize) * imsize
+        padded = (1.2 * imsize)**2
+        nchunk = nchan if chunk is None else min(nchan, chunk)
+        if nchan > 1:
+            images = cubechunks.chunkmem(imsize, nchunk)
+            planes = cubechunks._IMAGES_PER_CHAN
+            nt = 1
+        else:
+            nt = nterms
+            planes = 7 * nterms + (nterms - 1)          # mtmfs keeps 2 nterms - 1 psf terms
+            images = npix * 4 * planes
+        grids = padded * 8 * 2 * (2 * nt - 1) * nchunk  # complex grid and its FFT
+        majors = 1 if niter <= 0 else 2 + int(math.log(1. + niter / float(cycleniter or 100), 2))
+        # each worker is a CASA process of its own (~1 GB)
+        est = Estimate(n, mem=(images + grids + GB) * nworkers, disk=npix * 4 * planes * nchan,
+                       nworkers=nworkers,
+                       grid=n * 2 * majors * nt * GRIDDERS.get(gridder, 1.) + n * (2 * nt - 1),
+                       fft=padded * nchan * (2 * majors * nt + 2 * nt - 1),
+                       minor=niter * nt * nt)
+        if nchan > 1:
+            est.notes.append('%i channels in chunks of %i' % (nchan, nchunk))
+        if savemodel == 'modelcolumn':
+            est = est + Estimate(n, disk=n * 8, io=n * 8)
+        return est
+
+    def images(self, imsize, nchan, planes=1):
+        """Read an image cube (moments, statistics)."""
+        b = float(imsize) * imsize * nchan * 4 * planes
+        return Estimate(0, mem=GB, io=b)
+
+
+def calibrate(prefix):
+    """{step: measured / model time} from earlier traces prefix+'_*.json'."""
+    ratios = {}
+    for fn in glob.glob(prefix + '_*.json'):
+        try:
+            with open(fn) as f:
+                events = json.load(f)['traceEvents']
+        except (ValueError, KeyError, IOError):
+            continue
+        for ev in events:
+            model = ev.get('args', {}).get('model_s')
+            if ev.get('cat') == 'step' and model:
+                step = ev['name'].split()[-1]
+                ratios.setdefault(step, []).append(ev['dur'] / 1e6 / model)
+    return {s: float(np.median(r)) for s, r in ratios.items()}
+
+
+def recommend(nchan, imsize, memgb, cores=16, chunks=('spw', 256, 128, 64, 32, 16, 8, 4, 2, 1),
+              nchanspw=128):
+    """Chunk size and workers for a cube of nchan channels within memgb.
+
+    Takes the largest chunk that lets min(cores, chunks) workers fit, or
+    the most workers any chunk allows.  Returns dict(chunk, nworkers, memgb per worker).
+    """
+    best = None
+    for c in chunks:
+        size = nchanspw if c == 'spw' else c
+        per = (cubechunks.chunkmem(imsize, size) + (1.2 * imsize)**2 * 16 * size + GB) / GB
+        nw = int(min(cores, max(1, math.ceil(nchan / float(size))), memgb // per))
+        if nw < 1:
+            continue
+        cand = {'chunk': c, 'nworkers': nw, 'memgb': round(per, 1)}
+        if nw >= min(cores, math.ceil(nchan / float(size))):
+            return cand
+        if best is None or nw > best['nworkers']:
+            best = cand
+    return best
+
+
+class Plan(object):
+    """Estimates of the steps of one run, calibrated from earlier traces."""
+
+    def __init__(self, steps, prefix, memgb=None, cores=None, diskgb=None):
+        self.steps = {str(k): v for k, v in steps.items() if v is not None}
+        self.factors = calibrate(prefix)
+        self.default = float(np.median(list(self.factors.values()))) if self.factors else 1.
+        self.memgb = memgb
+        self.cores = cores or os.cpu_count()
+        self.diskgb = diskgb
+        self.shown = []
+
+    def model_s(self, step):
+        """Uncalibrated model time, kept in the trace to calibrate later runs."""
+        est = self.steps.get(str(step))
+        return est.seconds() if est is not None else None
+
+    def seconds(self, step):
+        est = self.steps.get(str(step))
+        if est is None:
+            return None
+        return est.seconds() * self.factors.get(str(step), self.default)
+
+    def line(self, step):
+        est = self.steps.get(str(step))
+        if est is None:
+            return 'Step %3s  no estimate' % step
+        warn = []
+        if self.memgb and est.mem / GB > self.memgb:
+            warn.append('EXCEEDS %g GB' % self.memgb)
+        cal = '' if str(step) in self.factors else ' (uncalibrated)' if not self.factors else ' (median)'
+        return ('Step %3s  vis %9.3g  mem %7.1f GB  disk %7.1f GB  time %8.1f min%s  %s' % (
+            step, est.vis, est.mem / GB, est.disk / GB, self.seconds(step) / 60., cal,
+            '; '.join(est.notes + warn))).rstrip()
+
+    def show(self, step):
+        print(self.line(step))
+        self.shown.append(str(step))
+
+    def report(self, extra=()):
+        """Table of the steps shown, with totals."""
+        lines = [self.line(s) for s in self.shown]
+        if self.shown:
+            t = sum(self.seconds(s) for s in self.shown if s in self.steps)
+            m = max([self.steps[s].mem for s in self.shown if s in self.steps] or [0.]) / GB
+            d = sum(self.steps[s].disk for s in self.shown if s in self.steps) / GB
+            lines.append('Total     time %.1f h, peak memory %.1f GB, new products %.1f GB'
+                         % (t / 3600., m, d))
+            if self.diskgb is not None and d > self.diskgb:
+                lines.append('Products exceed the %.0f GB free on disk' % self.diskgb)
+        return '\n'.join(lines + list(extra))
+
+
+def freedisk(path='.'):
+    """Free space in GB on the filesystem of path."""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize / GB
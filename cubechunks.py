@@ -0,0 +1,207 @@
+##############################################################
+# Channel-chunked cube imaging
+#
+# The cube is the one the single tclean job of step 13 would make: the
+# spw selection, start, width and nchan are laid out on the output (LSRK)
+# channel grid as tclean does it (ms.cvelfreqs), and that grid is cut into
+# chunks of N output channels, or with chunk='spw' at the spw boundaries:
+# each grid channel goes to the spw whose centre is nearest among those
+# covering it, and a chunk is a run of channels of one spw (so where spws
+# overlap the cut falls half way, and no channel is imaged twice).  Each chunk is imaged by its own tclean in a
+# separate CASA python process, with start/width/nchan in Hz on the same
+# grid and only the spws that overlap it, with a bounded number running at
+# once.  The chunk cubes are then concatenated (virtually, no copy) in
+# frequency order and smoothed to one common beam.  Chunk status is kept
+# in imagename+'.chunks.json' so a rerun only re-images chunks that failed
+# or were never finished, and each chunk deconvolves in checkpointed
+# segments (cleanjournal), so a chunk that was killed resumes from its
+# last completed segment.
+#
+#   cubechunks.run(vis, imagename, tcleanpars, spw='', start=5, nchan=4040,
+#                  chunk='spw', nworkers=4, memgb=64)          # or chunk=128
+##############################################################
+
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# images held by tclean per cube channel (psf, residual, model, image, pb,
+# mask, weight, sumwt) - used to keep the workers inside the memory budget
+_IMAGES_PER_CHAN = 8
+DOPPLER = 1e-4      # fractional margin for the topocentric to LSRK shift (30 km/s)
+
+
+def spws(vis, spw=''):
+    """Spw ids of a tclean spw selection ('' is every spw, as tclean)."""
+    import chansel
+    import msmeta
+    if spw:
+        return chansel.parse(spw).spws
+    return sorted(int(s) for s in msmeta.get(vis)['spws'])
+
+
+def grid(vis, spw='', start=0, nchan=-1, width=1, outframe='LSRK'):
+    """Output channel frequencies (Hz) of the single cube job."""
+    from casatools import ms
+    m = ms()
+    m.open(vis)
+    try:
+        return list(m.cvelfreqs(spwids=spws(vis, spw), mode='channel', nchan=nchan,
+                                start=start, width=width, outframe=outframe))
+    finally:
+        m.close()
+
+
+def _spwcuts(meta, ids, freqs):
+    """Grid indices where the covering spw changes (see above)."""
+    cuts, last = [0], None
+    for i, f in enumerate(freqs):
+        near = None
+        for s in ids:
+            m = meta['spws'][str(s)]
+            d = abs(f - m['freq'])
+            if d <= 0.5 * m['nchan'] * m['chanwidth'] + DOPPLER * f and (near is None or d < near[0]):
+                near = (d, s)
+        if near is None:                 # in a gap: stays with the chunk before
+            continue
+        if last is not None and near[1] != last:
+            cuts.append(i)
+        last = near[1]
+    return cuts + [len(freqs)]
+
+
+def plan(vis, freqs, spw='', chunk=128):
+    """Chunk selections on the grid freqs, in grid order: dicts of spw (the
+    spws overlapping the chunk), start and width (Hz, the grid's sign) and nchan.
+
+    chunk is the number of channels per chunk, or 'spw' to cut at spw boundaries.
+    """
+    import msmeta
+    meta = msmeta.get(vis)
+    step = freqs[1] - freqs[0] if len(freqs) > 1 else meta['spws'][str(spws(vis, spw)[0])]['chanwidth']
+    if chunk == 'spw':
+        cuts = _spwcuts(meta, spws(vis, spw), freqs)
+    else:
+        cuts = list(range(0, len(freqs), int(chunk))) + [len(freqs)]
+    out = []
+    for i, j in zip(cuts[:-1], cuts[1:]):
+        f = freqs[i:j]
+        lo, hi = min(f[0], f[-1]), max(f[0], f[-1])
+        lo, hi = lo - 2 * abs(step) - DOPPLER * lo, hi + 2 * abs(step) + DOPPLER * hi
+        sel = []
+        for s in spws(vis, spw):
+            m = meta['spws'][str(s)]
+            half = 0.5 * m['nchan'] * m['chanwidth']
+            if m['freq'] - half < hi and m['freq'] + half > lo:
+                sel.append(s)
+        out.append({'spw': ','.join(str(s) for s in sel), 'start': '%.3fHz' % f[0],
+                    'width': '%.3fHz' % step, 'nchan': len(f)})
+    return out
+
+
+def chunkmem(imsize, nchan):
+    """Rough peak memory in bytes for a tclean cube of nchan channels."""
+    if not isinstance(imsize, (list, tuple)):
+        imsize = [imsize, imsize]
+    return imsize[0] * imsize[1] * nchan * 4 * _IMAGES_PER_CHAN
+
+
+def poolsize(chunks, imsize, nworkers=4, memgb=None):
+    """Number of chunks to run at once within nworkers and memgb."""
+    if memgb is None:
+        return max(1, nworkers)
+    nmax = max(c['nchan'] for c in chunks)
+    return max(1, min(nworkers, int(memgb * 1024**3 // chunkmem(imsize, nmax))))
+
+
+def _tclean(pars, logfile):
+    """Run one tclean in a fresh CASA python process; True on success."""
+    code = ('import json,sys\n'
+            'sys.path.insert(0, %r)\n'
+            'import cleanjournal\n'
+            'cleanjournal.tclean(**json.loads(sys.argv[1]))\n') % os.path.dirname(os.path.abspath(__file__))
+    with open(logfile, 'a') as log:
+        ret = subprocess.call([sys.executable, '-c', code, json.dumps(pars)],
+                              stdout=log, stderr=subprocess.STDOUT)
+    return ret == 0 and os.path.exists(pars['imagename'] + '.image')
+
+
+def _load(statusfile):
+    if os.path.exists(statusfile):
+        with open(statusfile) as f:
+            return json.load(f)
+    return {}
+
+
+def _save(status, statusfile):
+    tmp = statusfile + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(status, f, indent=1, sort_keys=True)
+    os.replace(tmp, statusfile)
+
+
+def run(vis, imagename, tcleanpars, spw='', start=0, nchan=-1, width=1, chunk=128,
+        nworkers=4, memgb=None, concat=True, segment=5):
+    """Image the cube of spw, start, nchan, width (as the single tclean job)
+    in chunks of chunk channels (or 'spw', one per spw) and concatenate into
+    imagename.image.
+
+    tcleanpars are the other tclean parameters.  Chunks already imaged
+    successfully with the same parameters (per the status file) are not
+    redone, interrupted ones resume (segment major cycles per checkpoint,
+    0 for none); returns the list of chunks that failed.
+    """
+    import casatasks
+    import msmeta
+
+    freqs = grid(vis, spw, start, nchan, width, tcleanpars.get('outframe', 'LSRK').upper())
+    chunks = plan(vis, freqs, spw, chunk)
+    statusfile = imagename + '.chunks.json'
+    # chunks imaged with other data or parameters are stale
+    key = json.dumps([vis, chunks, tcleanpars], sort_keys=True, default=str)
+    status = _load(statusfile)
+    if status.get('key') != key:
+        status = {'key': key, 'done': []}
+    names = ['%s.chunk%03d' % (imagename, i) for i in range(len(chunks))]
+    todo = [i for i in range(len(chunks)) if names[i] not in status['done']]
+
+    nw = poolsize(chunks, tcleanpars.get('imsize', 100), nworkers, memgb)
+    print('Imaging %d of %d chunks with %d workers' % (len(todo), len(chunks), nw))
+
+    stamp = msmeta.mtime(vis)                 # vis is only read while imaging
+
+    def one(i):
+        pars = dict(tcleanpars, vis=vis, imagename=names[i], parallel=False,
+                    segment=segment, stamp=stamp, **chunks[i])
+        return i, _tclean(pars, names[i] + '.log')
+
+    with ThreadPoolExecutor(max_workers=nw) as pool:
+        for i, ok in pool.map(one, todo):
+            if ok:
+                status['done'].append(names[i])
+                _save(status, statusfile)
+            else:
+                print('Chunk %d (%s, %d channels from %s) failed, see %s.log' %
+                      (i, chunks[i]['spw'], chunks[i]['nchan'], chunks[i]['start'], names[i]))
+    _save(status, statusfile)
+
+    failed = [names[i] for i in range(len(chunks)) if names[i] not in status['done']]
+    if failed or not concat:
+        return failed
+
+    # chunks are in grid order, the channel order of the single job
+    suffixes = ['.image']
+    if tcleanpars.get('pbcor'):
+        suffixes.append('.image.pbcor')
+    for suffix in suffixes:
+        os.system('rm -rf ' + imagename + '.chunks' + suffix + ' ' + imagename + suffix)
+        casatasks.imageconcat(infiles=[n + suffix for n in names],
+                              outfile=imagename + '.chunks' + suffix,
+                              relax=True, mode='nomovevirtual')
+        # chunks share the grid; each has its own common beam, smooth all to one
+        casatasks.imsmooth(imagename=imagename + '.chunks' + suffix,
+                           kernel='commonbeam',
+                           outfile=imagename + suffix)
+    return failed
@@ -0,0 +1,367 @@
+##############################################################
+# Quick-look antenna gain solver (NumPy, no CASA needed to solve)
+#
+# Solves the same problem as gaincal (gaintype 'G' per polarization or 'T'
+# combining them, calmode 'p', 'a' or 'ap', refantmode 'flex') with StEFCal
+# (Salvini & Wijnholds 2014).  The visibilities of each spw are averaged
+# over channels and reduced, per solution interval, to Hermitian
+# antenna x antenna matrices
+#     Y_pq = sum w D_pq M_pq*      S_pq = sum w |M_pq|^2
+# and every solution interval (and polarization) of the spw is then
+# iterated as one batched array problem,
+#     g_p <- sum_q Y_pq g_q / sum_q S_pq |g_q|^2
+# averaging successive iterates.  Spws are solved in a thread pool.
+#
+# S/N per solution is |g| sqrt(sum_q S_pq |g_q|^2), scaled by the
+# reduced chi-squared of the fit so it does not depend on the absolute
+# weights.  compare() solves for several solints and tabulates the median
+# S/N, the fraction of solutions below minsnr and the phase rms, to choose
+# solintp0/p1 before running gaincal.
+#
+#   vdata = gainsolve.load(cvis, target)            # DATA/CORRECTED and MODEL_DATA
+#   vdata = gainsolve.load(cvis, target, model=modelpred.read(mvis+'_cont.clean'))   # no MODEL_DATA
+#   gainsolve.compare(vdata, ['inf', '66s', '21s', 'int'], refant=antrefs)
+#
+# python gainsolve.py checks the solver on synthetic visibilities.
+##############################################################
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def solintsec(solint):
+    """Solint in seconds: 'inf' -> inf, 'int' -> 0, '66s', '1.5min' or a number."""
+    if not isinstance(solint, str):
+        return float(solint)
+    if solint == 'inf':
+        return np.inf
+    if solint == 'int':
+        return 0.
+    m = re.match(r'^\s*([\d.]+)\s*(s|min|h)?\s*$', solint)
+    if not m:
+        raise ValueError('cannot parse solint %r' % solint)
+    return float(m.group(1)) * {'s': 1., None: 1., 'min': 60., 'h': 3600.}[m.group(2)]
+
+
+def _predict(model, sub, key, chanfreq, nrow=100000):
+    """Model visibilities of the rows of sub, in chunks cached by the model."""
+    out = []
+    for r0 in range(0, sub.nrows(), nrow):
+        n = min(nrow, sub.nrows() - r0)
+        out.append(model.predict(sub.getcol('UVW', r0, n), chanfreq, key=key + (r0, n)))
+    return np.concatenate(out, axis=1)
+
+
+def _loadpart(vis, fields, datacolumn, model=None):
+    """Per-spw arrays of one MS (or one sub-MS of a multi-MS)."""
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/DATA_DESCRIPTION')
+    spwmap = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    if model is not None:
+        tb.open(vis + '/SPECTRAL_WINDOW')
+        chanfreq = [tb.getcell('CHAN_FREQ', s) for s in range(tb.nrows())]
+        tb.close()
+
+    out = []
+    tb.open(vis)
+    try:
+        names = tb.colnames()
+        dcol = 'CORRECTED_DATA' if datacolumn == 'corrected' and 'CORRECTED_DATA' in names else 'DATA'
+        for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+            query = 'DATA_DESC_ID==%d && ANTENNA1!=ANTENNA2' % ddid
+            if fields:
+                query += ' && FIELD_ID IN [%s]' % ','.join(str(f) for f in fields)
+            sub = tb.query(query)
+            if sub.nrows() == 0:
+                sub.close()
+                continue
+            data = sub.getcol(dcol)
+            if model is not None:
+                spw = int(spwmap[ddid])
+                pred = _predict(model, sub, (os.path.abspath(vis), int(ddid), query), chanfreq[spw])
+                mdata = np.broadcast_to(pred, data.shape).astype(data.dtype)
+            elif 'MODEL_DATA' in names:
+                mdata = sub.getcol('MODEL_DATA')
+            else:
+                mdata = np.ones_like(data)
+            out.append({
+                'spw': int(spwmap[ddid]),
+                'data': data,
+                'model': mdata,
+                'flag': sub.getcol('FLAG'),
+                'weight': sub.getcol('WEIGHT'),
+                'ant1': sub.getcol('ANTENNA1'),
+                'ant2': sub.getcol('ANTENNA2'),
+                'time': sub.getcol('TIME'),
+                'scan': sub.getcol('SCAN_NUMBER')})
+            sub.close()
+    finally:
+        tb.close()
+    return out
+
+
+def load(vis, field='', datacolumn='corrected', nworkers=4, model=None):
+    """Read vis into per-spw arrays for solve().
+
+    Uses CORRECTED_DATA if datacolumn is 'corrected' and it exists, else
+    DATA; the model visibilities predicted by model (a modelpred.Model, for
+    savemodel='virtual'), else MODEL_DATA if present, else a 1 Jy point
+    source as gaincal does.
+    The sub-MSs of a multi-MS are read concurrently and the rows of a spw
+    split over several of them joined.
+    """
+    from casatools import msmetadata
+    import mmspart
+    msmd = msmetadata()
+    msmd.open(vis)
+    try:
+        antnames = list(msmd.antennanames())
+        fields = list(msmd.fieldsforname(field)) if field else []
+    finally:
+        msmd.close()
+
+    byspw = {}
+    for part in mmspart.pmap(lambda p: _loadpart(p, fields, datacolumn, model), vis, nworkers):
+        for blk in part:
+            byspw.setdefault(blk['spw'], []).append(blk)
+    out = {'antnames': antnames, 'spws': []}
+    for spw in sorted(byspw):
+        blks = byspw[spw]
+        if len(blks) == 1:
+            out['spws'].append(blks[0])
+            continue
+        # rows are the last axis of every column
+        out['spws'].append(dict({k: np.concatenate([b[k] for b in blks], axis=-1)
+                                 for k in blks[0] if k != 'spw'}, spw=spw))
+    return out
+
+
+def fromsynth(vis):
+    """solve() input from a synthvis.make() dataset (one scan, spws 0..n-1)."""
+    return {'antnames': ['A%02d' % a for a in range(vis['nant'])],
+            'spws': [{'spw': s, 'data': d, 'model': m, 'flag': f, 'weight': w,
+                      'ant1': vis['ant1'], 'ant2': vis['ant2'], 'time': vis['time'],
+                      'scan': np.ones(len(vis['time']), dtype=int)}
+                     for s, (d, m, f, w) in enumerate(zip(vis['data'], vis['model'],
+                                                          vis['flag'], vis['weight']))]}
+
+
+def refants(refant, antnames):
+    """Antenna indices for a refant list ('DA63, DA57' or indices), in priority order."""
+    if isinstance(refant, str):
+        refant = [a.strip() for a in refant.split(',') if a.strip()]
+    return [antnames.index(a) if isinstance(a, str) else int(a) for a in refant]
+
+
+def bins(time, scan, solint):
+    """Solution interval index of each row and the mean time of each interval.
+
+    Intervals do not cross scans, as gaincal with combine=''.
+    """
+    sec = solintsec(solint)
+    us, sidx = np.unique(scan, return_inverse=True)
+    if sec == 0.:
+        k = np.unique(time, return_inverse=True)[1]
+    elif np.isinf(sec):
+        k = np.zeros(len(time), dtype=int)
+    else:
+        t0 = np.full(len(us), np.inf)
+        np.minimum.at(t0, sidx, time)
+        # integrations are time-stamped mid-interval; allow for jitter
+        k = np.floor((time - t0[sidx]) / sec + 1e-3).astype(int)
+    key, idx = np.unique(sidx * (k.max() + 1) + k, return_inverse=True)
+    tmean = np.bincount(idx, weights=time) / np.bincount(idx)
+    return idx, tmean, us[key // (k.max() + 1)]
+
+
+def normal(blk, idx, nbin, nant, gaintype='G'):
+    """Per-interval (Y, S, A, n) matrices (nbin*npol, nant, nant) for one spw.
+
+    A is sum w |D|^2 and n the number of unflagged visibilities, for chi-squared.
+    """
+    w = np.where(blk['flag'], 0., blk['weight'][:, None, :])     # (ncorr, nchan, nrow)
+    d, m = blk['data'], blk['model']
+    y = (w * d * np.conj(m)).sum(axis=1)                          # (ncorr, nrow)
+    s = (w * np.abs(m)**2).sum(axis=1)
+    a = (w * np.abs(d)**2).sum(axis=1)
+    n = (w > 0).sum(axis=1).astype(float)
+    if gaintype == 'T':
+        y, s, a, n = (x.sum(axis=0, keepdims=True) for x in (y, s, a, n))
+    npol = y.shape[0]
+    a1, a2 = blk['ant1'], blk['ant2']
+    base = (idx * npol)[None, :] + np.arange(npol)[:, None]         # (npol, nrow)
+    flat = ((base * nant + a1) * nant + a2).ravel()
+    size = nbin * npol * nant * nant
+
+    def acc(x):
+        return np.bincount(flat, weights=x.ravel(), minlength=size).reshape(nbin * npol, nant, nant)
+
+    Y = acc(y.real) + 1j * acc(y.imag)
+    S = acc(s)
+    Y = Y + np.conj(np.swapaxes(Y, 1, 2))
+    S = S + np.swapaxes(S, 1, 2)
+    A = np.bincount(base.ravel(), weights=a.ravel(), minlength=nbin * npol)
+    N = np.bincount(base.ravel(), weights=n.ravel(), minlength=nbin * npol)
+    return Y, S, A, N
+
+
+def stefcal(Y, S, calmode='ap', niter=100, tol=1e-6):
+    """Batched StEFCal: gains (nbatch, nant) for Y, S (nbatch, nant, nant)."""
+    g = np.ones(Y.shape[:2], dtype=complex)
+    g[S.sum(axis=2) == 0] = 0.
+    for i in range(niter):
+        num = (Y @ g[..., None])[..., 0]
+        den = (S @ (np.abs(g)**2)[..., None])[..., 0]
+        gnew = np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+        if calmode == 'p':
+            gnew = np.divide(gnew, np.abs(gnew), out=np.zeros_like(gnew), where=gnew != 0)
+        elif calmode == 'a':
+            gnew = np.abs(gnew).astype(complex)
+        if i % 2 == 1:
+            gnew = 0.5 * (gnew + g)
+            if calmode == 'p':
+                gnew = np.divide(gnew, np.abs(gnew), out=np.zeros_like(gnew), where=gnew != 0)
+        dg = np.abs(gnew - g).max() / max(np.abs(gnew).max(), 1e-30)
+        g = gnew
+        if dg < tol:
+            break
+    return g
+
+
+def _solvespw(blk, solint, nant, ref, calmode, gaintype, niter):
+    idx, tmean, scans = bins(blk['time'], blk['scan'], solint)
+    nbin = len(tmean)
+    Y, S, A, N = normal(blk, idx, nbin, nant, gaintype)
+    g = stefcal(Y, S, calmode, niter)
+    den = (S @ (np.abs(g)**2)[..., None])[..., 0]
+    # noise scale from the reduced chi-squared of an amplitude+phase fit, so that
+    # amplitude errors do not count as noise in phase-only solutions:
+    # sum w|D|^2 - 2 Re sum g_p* g_q Y_pq + sum |g_p|^2 |g_q|^2 S_pq, each baseline once
+    gf = g if calmode == 'ap' else stefcal(Y, S, 'ap', niter)
+    gg = np.conj(gf)[:, :, None] * gf[:, None, :]
+    chi2 = (A - np.einsum('bpq,bpq->b', gg, Y).real +
+            0.5 * np.einsum('bp,bpq,bq->b', np.abs(gf)**2, S, np.abs(gf)**2))
+    good = N > 2 * nant
+    redchi2 = np.median(chi2[good] / (N[good] - nant)) if good.any() else 1.
+    snr = np.abs(g) * np.sqrt(den / max(redchi2, 1e-30))
+    # flexible reference antenna: first in the list with a solution in each interval
+    rows = np.arange(len(g))
+    r = np.full(len(g), -1)
+    for a in reversed(ref):
+        r[snr[:, a] > 0] = a
+    r[r < 0] = np.argmax(snr, axis=1)[r < 0]
+    phref = g[rows, r]
+    g = g * np.divide(np.conj(phref), np.abs(phref), out=np.zeros_like(phref), where=phref != 0)[:, None]
+    npol = len(g) // nbin
+    return {'spw': np.full(nbin, blk['spw']), 'time': tmean, 'scan': scans,
+            'gain': g.reshape(nbin, npol, nant), 'snr': snr.reshape(nbin, npol, nant),
+            'refant': r.reshape(nbin, npol), 'redchi2': redchi2}
+
+
+def solve(vdata, solint, refant='', calmode='p', gaintype='G', minsnr=3., niter=100, nworkers=4):
+    """Antenna gains for every spw and solution interval of vdata (from load()).
+
+    Returns a dict of arrays over solutions: spw, time, scan (nsol,), gain and
+    snr (nsol, npol, nant), refant (nsol, npol) and flag (snr < minsnr).
+    """
+    nant = len(vdata['antnames'])
+    ref = refants(refant, vdata['antnames'])
+    with ThreadPoolExecutor(max_workers=nworkers) as pool:
+        parts = list(pool.map(lambda b: _solvespw(b, solint, nant, ref, calmode, gaintype, niter),
+                              vdata['spws']))
+    sol = {k: np.concatenate([p[k] for p in parts]) for k in ('spw', 'time', 'scan', 'gain', 'snr', 'refant')}
+    sol['flag'] = sol['snr'] < minsnr
+    sol['redchi2'] = {int(p['spw'][0]): float(p['redchi2']) for p in parts}
+    sol.update(solint=solint, calmode=calmode, gaintype=gaintype, antnames=vdata['antnames'])
+    return sol
+
+
+def phaserms(sol):
+    """Rms (deg) over time of the unflagged solution phases, per spw, pol and antenna.
+
+    Returns (spws, rms (nspw, npol, nant)); nan where there are <2 solutions
+    (e.g. solint 'inf' with one scan).
+    """
+    spws = np.unique(sol['spw'])
+    out = np.full((len(spws),) + sol['gain'].shape[1:], np.nan)
+    for i, s in enumerate(spws):
+        sel = sol['spw'] == s
+        g = sol['gain'][sel]
+        # the reference antenna's phase is zero by construction
+        isref = np.arange(g.shape[2])[None, None, :] == sol['refant'][sel][:, :, None]
+        ok = ~sol['flag'][sel] & (g != 0) & ~isref
+        ph = np.where(ok, np.angle(g), np.nan)
+        # circular mean so that phases near +-180 do not inflate the rms
+        mean = np.angle(np.nansum(np.where(ok, g / np.where(ok, np.abs(g), 1.), 0.), axis=0))
+        dph = np.angle(np.exp(1j * (ph - mean)))
+        n = ok.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[i] = np.where(n > 1, np.degrees(np.sqrt(np.nansum(dph**2, axis=0) / (n - 1))), np.nan)
+    return spws, out
+
+
+def summary(sol):
+    """Median S/N, fraction of solutions below minsnr and median phase rms (deg)."""
+    has = sol['snr'] > 0
+    rms = phaserms(sol)[1]
+    return {'solint': sol['solint'],
+            'nsol': int(has.sum()),
+            'snr': float(np.median(sol['snr'][has])) if has.any() else 0.,
+            'lowsnr': float((sol['flag'] & has).sum() / max(has.sum(), 1)),
+            'phaserms': float(np.nanmedian(rms)) if np.isfinite(rms).any() else np.nan}
+
+
+def compare(vdata, solints, refant='', calmode='p', gaintype='T', minsnr=3., nworkers=4, log=print):
+    """Solve for each candidate solint and tabulate summary(); returns the summaries."""
+    rows = []
+    log('%-8s %8s %10s %12s %14s' % ('solint', 'nsol', 'median S/N', 'S/N<%g (%%)' % minsnr,
+                                     'phase rms (deg)'))
+    for solint in solints:
+        st = summary(solve(vdata, solint, refant, calmode, gaintype, minsnr, nworkers=nworkers))
+        log('%-8s %8i %10.1f %12.1f %14.1f' % (solint, st['nsol'], st['snr'],
+                                               100. * st['lowsnr'], st['phaserms']))
+        rows.append(st)
+    return rows
+
+
+def selftest(seed=3):
+    """Check solve() against the synthvis input gains; returns the worst errors.
+
+    Phase-only per-integration solutions should match the true antenna phases
+    (relative to the reference antenna) to within the noise, amplitude+phase
+    solutions should also recover the amplitudes, and S/N should match the
+    expectation from the weights.
+    """
+    import synthvis
+    vis = synthvis.make(nspw=2, ntime=20, noise=1e-3, flux=50e-3, nlines=0, seed=seed)
+    vdata = fromsynth(vis)
+    truth = vis['gains'][:, :, :]                            # (ntime, nant, ncorr)
+    worst = {}
+    for calmode in ('p', 'ap'):
+        sol = solve(vdata, 'int', refant='A03,A00', calmode=calmode, gaintype='G', nworkers=2)
+        g = sol['gain'][sol['spw'] == 0]                     # (ntime, npol, nant)
+        ref = truth[np.arange(len(g)), 3][:, :, None]
+        exp = truth.transpose(0, 2, 1) * np.conj(ref) / np.abs(ref)
+        if calmode == 'p':
+            exp = exp / np.abs(exp)
+            err = np.degrees(np.abs(np.angle(g * np.conj(exp))))
+            # expected phase error: 1/snr rad
+            worst['phase'] = float(np.max(err / np.degrees(1. / sol['snr'][sol['spw'] == 0])))
+        else:
+            worst['amp'] = float(np.max(np.abs(np.abs(g) - np.abs(exp)) /
+                                        (np.abs(g) / sol['snr'][sol['spw'] == 0])))
+        worst['refant'] = int(np.max(sol['refant'] != 3))
+        worst['redchi2_%s' % calmode] = max(abs(c - 1.) for c in sol['redchi2'].values())
+    return worst
+
+
+if __name__ == '__main__':
+    w = selftest()
+    print('worst phase error %.1f sigma, amp error %.1f sigma, reduced chi2 %.2f/%.2f from 1'
+          % (w['phase'], w['amp'], w['redchi2_p'], w['redchi2_ap']))
+    assert w['phase'] < 6 and w['amp'] < 6 and w['refant'] == 0
@@ -0,0 +1,132 @@
+##############################################################
+# Image statistics in one pass
+#
+# Reads each image plane once and computes, for any number of named boxes
+# (imstat 'blcx,blcy,trcx,trcy' strings) or boolean masks:
+#   n, rms (as imstat, sqrt(mean(x^2))), madrms (1.4826*MAD), max, maxpos
+# and the S/N of one region's peak against another's rms.
+#
+#   s = imstats.stats(mvis+'_contp1.clean', statboxes)   # .image or .image.tt0
+#   s['noise']['rms'], s['peak']['max'], imstats.snr(s)
+#
+# For cubes, imstats.cubestats() streams blocks of channels and returns
+# per-channel arrays without loading the whole cube.
+##############################################################
+
+import os
+
+import numpy as np
+
+_suffixes = {'image': ['', '.image', '.image.tt0'],
+             'pbcor': ['', '.image.pbcor', '.image.tt0.pbcor', '.pbcor']}
+
+
+def resolve(name, kind='image'):
+    """Find the image for name, trying '.image', '.image.tt0' (or pbcor) variants."""
+    for suffix in _suffixes[kind]:
+        if os.path.exists(name + suffix):
+            return name + suffix
+    raise IOError('no %s found for %s' % (kind, name))
+
+
+def parsebox(box):
+    """imstat box string to integer (x0, y0, x1, y1), inclusive."""
+    x0, y0, x1, y1 = [int(float(v)) for v in box.split(',')]
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def _pixels(data, region):
+    """Pixels of region from data (nx, ny, nplane) as (npix, nplane)."""
+    if isinstance(region, str):
+        x0, y0, x1, y1 = parsebox(region)
+        return data[x0:x1 + 1, y0:y1 + 1].reshape(-1, data.shape[2])
+    return data[np.asarray(region, dtype=bool)]
+
+
+def regionstats(data, regions):
+    """Statistics per region for data (nx, ny, nplane); NaN pixels ignored.
+
+    regions maps names to box strings or (nx, ny) boolean masks.  Each
+    statistic is an array over planes.
+    """
+    out = {}
+    for name, region in regions.items():
+        pix = _pixels(data, region)
+        n = np.sum(np.isfinite(pix), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rms = np.sqrt(np.nansum(pix**2, axis=0) / n)
+            med = np.nanmedian(pix, axis=0)
+            madrms = 1.4826 * np.nanmedian(np.abs(pix - med), axis=0)
+        filled = np.where(np.isfinite(pix), pix, -np.inf)
+        imax = np.argmax(filled, axis=0)
+        peak = filled[imax, np.arange(pix.shape[1])]
+        if isinstance(region, str):
+            x0, y0, x1, y1 = parsebox(region)
+            px, py = np.unravel_index(imax, (x1 - x0 + 1, y1 - y0 + 1))
+            maxpos = np.stack((px + x0, py + y0), axis=-1)
+        else:
+            idx = np.argwhere(np.asarray(region, dtype=bool))
+            maxpos = idx[imax]
+        out[name] = {'n': n, 'rms': rms, 'madrms': madrms,
+                     'max': np.where(n > 0, peak, np.nan), 'maxpos': maxpos}
+    return out
+
+
+def snr(stats, peak='peak', noise='noise', robust=False):
+    """Peak of one region over the (MAD-)rms of another."""
+    return stats[peak]['max'] / stats[noise]['madrms' if robust else 'rms']
+
+
+def _plane(chunk):
+    """getchunk result to (nx, ny, nplane) with masked pixels as NaN."""
+    data, mask = chunk
+    data = np.where(mask, data, np.nan)
+    return data.reshape(data.shape[0], data.shape[1], -1)
+
+
+def stats(imagename, regions, chan=0, kind='image'):
+    """Statistics of one plane of an image, reading it once.
+
+    Returns {region: {'n', 'rms', 'madrms', 'max', 'maxpos'}} of scalars.
+    """
+    from casatools import image
+    ia = image()
+    ia.open(resolve(imagename, kind))
+    try:
+        shape = ia.shape()
+        blc = [0] * len(shape)
+        trc = [s - 1 for s in shape]
+        if len(shape) > 3:
+            blc[3] = trc[3] = chan
+        data = _plane((ia.getchunk(blc, trc, dropdeg=False),
+                       ia.getchunk(blc, trc, dropdeg=False, getmask=True)))
+    finally:
+        ia.close()
+    out = regionstats(data[:, :, :1], regions)
+    return {name: {k: v[0].tolist() for k, v in r.items()} for name, r in out.items()}
+
+
+def cubestats(imagename, regions, nblock=64, kind='image'):
+    """Per-channel statistics of a cube, streamed nblock channels at a time.
+
+    Returns {region: {stat: array over channels}}; memory use is set by
+    nblock planes, not by the size of the cube.
+    """
+    from casatools import image
+    ia = image()
+    ia.open(resolve(imagename, kind))
+    parts = []
+    try:
+        shape = ia.shape()
+        for c0 in range(0, shape[3], nblock):
+            c1 = min(c0 + nblock, shape[3]) - 1
+            blc = [0, 0, 0, c0]
+            trc = [shape[0] - 1, shape[1] - 1, 0, c1]
+            data = ia.getchunk(blc, trc, dropdeg=False)
+            mask = ia.getchunk(blc, trc, dropdeg=False, getmask=True)
+            parts.append(regionstats(_plane((data, mask)), regions))
+    finally:
+        ia.close()
+    return {name: {k: np.concatenate([p[name][k] for p in parts])
+                   for k in parts[0][name]}
+            for name in regions}
@@ -0,0 +1,202 @@
+##############################################################
+# Incremental applycal
+#
+# Steps 6, 8, 10 and 12 apply the whole, growing list of caltables to the
+# whole MS, even when a rerun only changed a few solutions (e.g. flagging
+# DA50 in scan 48 of .p0).  incrapply.applycal() keeps a manifest of what
+# was last applied, vis+'.applied.json': the applycal parameters and, for
+# every caltable, a hash of the solutions (time, parameters, flags) of
+# each spw x scan x antenna block.  On the next call only the blocks whose
+# hash changed, appeared or disappeared are recalibrated: applycal
+# rewrites CORRECTED_DATA (DATA x all the tables) for the rows of those
+# spws and scans on baselines to those antennas, one applycal per spw and
+# antenna set.  With linear time interpolation the neighbouring scans of a
+# changed block are redone too; a table solved with combine='scan' (scan
+# -1) affects every scan of its spw and antenna.  Other parameters
+# (applymode, calwt, interp, spwmap ...), a reset of CORRECTED_DATA since
+# the last apply (clearcal, split, checkpoint restore: checked on a sample
+# of rows), a missing manifest or more than maxfrac of the blocks changed
+# mean one full applycal.  An unchanged call does nothing.
+#
+# The selections are applied one after the other: applycal writers cannot
+# share an MS, so parallel passes come from a multi-MS (mmspart), whose
+# sub-MSs CASA calibrates concurrently under mpicasa.
+#
+#   incrapply.applycal(cvis, gaintable=[mvis+'.p0', mvis+'.p1'], applymode='calonly',
+#                      calwt=False, flagbackup=False)
+##############################################################
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+NPROBE = 64       # rows of CORRECTED_DATA sampled to detect a reset
+
+
+def blocks(caltable):
+    """{'spw/scan/antenna': hash} of the solutions of caltable."""
+    from casatools import table
+    tb = table()
+    tb.open(caltable)
+    try:
+        par = 'CPARAM' if 'CPARAM' in tb.colnames() else 'FPARAM'
+        cols = {c: tb.getcol(c) for c in ('TIME', 'ANTENNA1', 'SPECTRAL_WINDOW_ID',
+                                          'SCAN_NUMBER', par, 'FLAG')}
+    finally:
+        tb.close()
+    return _hashblocks(cols['SPECTRAL_WINDOW_ID'], cols['SCAN_NUMBER'], cols['ANTENNA1'],
+                       cols['TIME'], cols[par], cols['FLAG'])
+
+
+def _hashblocks(spw, scan, ant, time, par, flag):
+    """Hash per (spw, scan, antenna) of solution arrays (..., nrow)."""
+    order = np.lexsort((ant, scan, spw))             # stable: rows stay in time order
+    k = np.stack([spw, scan, ant])[:, order]
+    edges = np.nonzero((np.diff(k, axis=1) != 0).any(axis=0))[0] + 1
+    out = {}
+    for rows in np.split(order, edges):
+        h = hashlib.sha1(np.ascontiguousarray(time[rows]).tobytes())
+        h.update(np.ascontiguousarray(par[..., rows]).tobytes())
+        h.update(np.ascontiguousarray(flag[..., rows]).tobytes())
+        r = rows[0]
+        out['%d/%d/%d' % (spw[r], scan[r], ant[r])] = h.hexdigest()[:16]
+    return out
+
+
+def changed(old, new, linear=True):
+    """(spw, scan, antenna) blocks to recalibrate between manifests' blocks
+    {table: {block: hash}}; scan None means every scan."""
+    keys = set()
+    for t in set(old) | set(new):
+        a, b = old.get(t, {}), new.get(t, {})
+        keys.update(k for k in set(a) | set(b) if a.get(k) != b.get(k))
+    out = set()
+    for k in keys:
+        spw, scan, ant = (int(v) for v in k.split('/'))
+        out.add((spw, None if scan < 0 else scan, ant))
+    if linear:
+        # solutions of neighbouring scans are interpolated into each other
+        scans = {}
+        for t in new.values():
+            for k in t:
+                spw, scan, ant = (int(v) for v in k.split('/'))
+                scans.setdefault((spw, ant), set()).add(scan)
+        for spw, scan, ant in list(out):
+            s = sorted(scans.get((spw, ant), ()))
+            if scan is None or scan not in s:
+                continue
+            i = s.index(scan)
+            out.update((spw, n, ant) for n in s[max(0, i - 1):i + 2])
+    return out
+
+
+def selections(blks, antnames):
+    """applycal selections (spw, scan, antenna) covering the blocks, one per
+    spw and set of antennas."""
+    byspw = {}
+    for spw, scan, ant in blks:
+        byspw.setdefault(spw, {}).setdefault(scan, set()).add(ant)
+    out = []
+    for spw in sorted(byspw):
+        scans = byspw[spw]
+        if None in scans:                    # every scan of these antennas
+            ants = set().union(*scans.values())
+            groups = {frozenset(ants): [None]}
+        else:
+            groups = {}
+            for scan, ants in scans.items():
+                groups.setdefault(frozenset(ants), []).append(scan)
+        for ants, sc in sorted(groups.items(), key=lambda g: sorted(g[1], key=str)):
+            out.append({'spw': str(spw),
+                        'scan': '' if None in sc else ','.join(str(s) for s in sorted(sc)),
+                        'antenna': '' if len(ants) >= len(antnames)
+                        else ','.join(antnames[a] for a in sorted(ants))})
+    return out
+
+
+def probe(vis, n=NPROBE):
+    """Hash of CORRECTED_DATA in n rows spread over vis, or None without the column."""
+    from casatools import table
+    tb = table()
+    tb.open(vis)
+    try:
+        if 'CORRECTED_DATA' not in tb.colnames():
+            return None
+        nrow = tb.nrows()
+        h = hashlib.sha1(str(nrow).encode())
+        for r in np.unique(np.linspace(0, nrow - 1, n).astype(int)):
+            h.update(np.ascontiguousarray(tb.getcell('CORRECTED_DATA', int(r))).tobytes())
+    finally:
+        tb.close()
+    return h.hexdigest()[:16]
+
+
+def _antnames(vis):
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/ANTENNA')
+    try:
+        return list(tb.getcol('NAME'))
+    finally:
+        tb.close()
+
+
+def load(vis):
+    fn = vis.rstrip('/') + '.applied.json'
+    if os.path.exists(fn):
+        with open(fn) as f:
+            return json.load(f)
+    return {}
+
+
+def _save(manifest, vis):
+    fn = vis.rstrip('/') + '.applied.json'
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(fn + '.tmp', fn)
+
+
+def applycal(vis, gaintable, maxfrac=0.5, **pars):
+    """applycal of gaintable to vis, redoing only the blocks whose solutions
+    changed since the last call (see above).  pars are the other applycal
+    parameters; a selection (field, spw, scan, antenna ...) always applies in full.
+
+    Returns {'full': bool, 'blocks': blocks changed, 'calls': applycal runs}.
+    """
+    import casatasks
+    tables = [gaintable] if isinstance(gaintable, str) else list(gaintable)
+    new = {t: blocks(t) for t in tables}
+    key = json.dumps({k: v for k, v in pars.items() if k != 'flagbackup'}, sort_keys=True, default=str)
+    old = load(vis)
+    interp = pars.get('interp', '')
+    interp = [i for i in ([interp] if isinstance(interp, str) else interp) if i]
+    linear = not interp or not all(str(i).startswith('nearest') for i in interp)
+    full = (old.get('pars') != key or old.get('probe') is None or old['probe'] != probe(vis)
+            or any(p in pars for p in ('field', 'spw', 'scan', 'antenna', 'timerange',
+                                       'intent', 'observation', 'uvrange')))
+    todo = set() if full else changed(old.get('blocks', {}), new, linear)
+    nblk = sum(len(b) for b in new.values()) or 1
+    if not full and len(todo) > maxfrac * nblk:
+        full = True
+    calls = 0
+    if full:
+        print('applycal %s to all of %s' % (', '.join(tables), vis))
+        casatasks.applycal(vis=vis, gaintable=tables, **pars)
+        calls = 1
+    elif todo:
+        sels = selections(todo, _antnames(vis))
+        print('applycal %s to %d of %d solution blocks of %s (%d selections)' %
+              (', '.join(tables), len(todo), nblk, vis, len(sels)))
+        for i, sel in enumerate(sels):
+            p = dict(pars, **sel)
+            if i > 0:
+                p['flagbackup'] = False
+            casatasks.applycal(vis=vis, gaintable=tables, **p)
+        calls = len(sels)
+    else:
+        print('%s already calibrated with %s, nothing to apply' % (vis, ', '.join(tables)))
+    if calls:
+        _save({'pars': key, 'tables': tables, 'blocks': new, 'probe': probe(vis)}, vis)
+    return {'full': full, 'blocks': len(todo), 'calls': calls}
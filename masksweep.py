@@ -0,0 +1,180 @@
+##############################################################
+# Automasking parameter sweep
+#
+# Images every combination of a grid of tclean parameters (noisethreshold,
+# minbeamfrac, sidelobethreshold, lownoisethreshold, growiterations,
+# robust, niter ...) for the continuum or a few cube channels.  Each run is
+# a tclean in its own CASA python process, with a bounded number running
+# at once; they only read the MS (savemodel='none').  Runs that share the
+# PSF (same robust etc.) copy it from one PSF-only tclean per group.  Each
+# image is scored in its own process on
+#   rms      rms of the residual in the noise box (median over channels)
+#   peak     peak of the image in the peak box
+#   maskfrac fraction of pixels in the final mask
+#   time     wall time of the tclean
+# and the runs are ranked by residual rms, those masking more than
+# maxmask of the image last (masks grown into the noise).  Results of runs
+# with unchanged parameters are reused on a rerun.
+#
+#   ranked = masksweep.run(cvis, mvis+'_sweep', tcleanpars,
+#                          dict(noisethreshold=[3., 3.5, 4.25], minbeamfrac=[0.1, 0.3]),
+#                          statboxes)
+##############################################################
+
+import itertools
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import cubechunks
+import msmeta
+import psfcache
+
+_JOB = '''import json, os, sys, time
+sys.path.insert(0, %r)
+import numpy as np
+from casatasks import tclean
+from casatools import image
+import imstats
+pars, boxes = json.loads(sys.argv[1]), json.loads(sys.argv[2])
+t0 = time.time()
+tclean(**pars)
+t = time.time() - t0
+name = pars['imagename']
+res = {'time': t}
+if pars['niter'] > 0:
+    kind = '.tt0' if os.path.exists(name + '.residual.tt0') else ''
+    rst = imstats.cubestats(name + '.residual' + kind, {'noise': boxes['noise']})
+    ist = imstats.cubestats(name + '.image' + kind, {'peak': boxes['peak']})
+    ia = image()
+    ia.open(name + '.mask')
+    m = ia.getchunk()
+    ia.close()
+    res.update(rms=float(np.nanmedian(rst['noise']['rms'])), peak=float(np.nanmax(ist['peak']['max'])),
+               maskfrac=float(np.mean(m > 0)))
+with open(name + '.sweep.json', 'w') as f:
+    json.dump(res, f)
+'''
+
+
+def grid(axes):
+    """All combinations of axes {param: [values]} as a list of dicts."""
+    names = sorted(axes)
+    return [dict(zip(names, vals)) for vals in itertools.product(*(axes[n] for n in names))]
+
+
+def _job(pars, boxes, logfile):
+    """tclean plus scoring in a fresh CASA python process; the scores or None."""
+    code = _JOB % os.path.dirname(os.path.abspath(__file__))
+    with open(logfile, 'a') as log:
+        ret = subprocess.call([sys.executable, '-c', code, json.dumps(pars), json.dumps(boxes)],
+                              stdout=log, stderr=subprocess.STDOUT)
+    if ret != 0 or not os.path.exists(pars['imagename'] + '.sweep.json'):
+        return None
+    with open(pars['imagename'] + '.sweep.json') as f:
+        return json.load(f)
+
+
+def table(ranked):
+    """Text table of ranked results."""
+    if not ranked:
+        return ''
+    names = sorted(ranked[0]['pars'])
+    lines = ['%4s ' % 'rank' + ' '.join('%10s' % n[:10] for n in names) +
+             ' %10s %10s %8s %8s %8s' % ('rms (mJy)', 'peak (mJy)', 'S/N', 'mask %', 'time (s)')]
+    for i, r in enumerate(ranked):
+        lines.append('%4i ' % (i + 1) + ' '.join('%10s' % r['pars'][n] for n in names) +
+                     ' %10.4f %10.3f %8.1f %8.2f %8.0f%s' % (
+                         1000. * r['rms'], 1000. * r['peak'], r['peak'] / r['rms'],
+                         100. * r['maskfrac'], r['time'], '  mask > maxmask' if r['wide'] else ''))
+    return '\n'.join(lines)
+
+
+def run(vis, prefix, tcleanpars, axes, boxes, nworkers=4, memgb=None, maxmask=0.2, log=print):
+    """Image vis with every combination in axes and rank the results.
+
+    tcleanpars are the base tclean parameters (with spw, imsize, usemask
+    etc.); axes maps parameter names to lists of values.  Images are made
+    under prefix+'_sweep/'.  Returns the results, best first, and writes
+    them to prefix+'_sweep.json' and a table to prefix+'_sweep.txt'.
+    """
+    outdir = prefix + '_sweep'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    base = dict(tcleanpars, vis=vis, savemodel='none', interactive=False, parallel=False)
+    combos = grid(axes)
+    runs = [dict(base, imagename=os.path.join(outdir, 'run%03d' % i), **c)
+            for i, c in enumerate(combos)]
+
+    # one PSF-only tclean per group of runs with the same PSF
+    groups = {}
+    for r in runs:
+        groups.setdefault(json.dumps({p: r.get(p) for p in psfcache.PSFPARS}, sort_keys=True,
+                                     default=str), []).append(r)
+    psfs = {}
+    for i, (k, members) in enumerate(groups.items()):
+        psfs[k] = dict(members[0], imagename=os.path.join(outdir, 'psf%02d' % i), niter=0,
+                       usemask='user', mask='')
+
+    nchan = max(1, tcleanpars.get('nterms', 1), tcleanpars.get('nchan', 1))
+    nw = max(1, nworkers)
+    if memgb:
+        mem = cubechunks.chunkmem(tcleanpars.get('imsize', 100), nchan)
+        nw = max(1, min(nw, int(memgb * 1024**3 // mem)))
+    # results are reused only for the same parameters and an unchanged MS
+    stamp = msmeta.mtime(vis)
+    log('Sweep of %d combinations (%d PSF groups) with %d workers' % (len(runs), len(psfs), nw))
+
+    def fresh(pars):
+        """Earlier results for exactly these parameters, or None."""
+        fn = pars['imagename'] + '.pars.json'
+        if os.path.exists(fn) and os.path.exists(pars['imagename'] + '.sweep.json'):
+            with open(fn) as f:
+                if f.read() == json.dumps([pars, stamp], sort_keys=True, default=str):
+                    with open(pars['imagename'] + '.sweep.json') as g:
+                        return json.load(g)
+        return None
+
+    def one(pars, psf=None):
+        res = fresh(pars)
+        if res is not None:
+            return res
+        name = pars['imagename']
+        os.system('rm -rf ' + name + '.*')
+        job = pars
+        if psf is not None:
+            for p in psfcache._products(psf):
+                psfcache._copy(p, name + p[len(psf):])
+            job = dict(pars, calcpsf=False)
+        res = _job(job, boxes, name + '.log')
+        if res is not None:
+            with open(name + '.pars.json', 'w') as f:
+                f.write(json.dumps([pars, stamp], sort_keys=True, default=str))
+        return res
+
+    with ThreadPoolExecutor(max_workers=nw) as pool:
+        ok = dict(zip(psfs, pool.map(one, psfs.values())))
+        futs = []
+        for k, members in groups.items():
+            psf = psfs[k]['imagename'] if ok[k] is not None else None
+            futs += [(r, pool.submit(one, r, psf)) for r in members]
+        results = []
+        for r, fut in futs:
+            res = fut.result()
+            if res is None or 'rms' not in res:
+                log('Run %s failed, see %s.log' % (r['imagename'], r['imagename']))
+                continue
+            res['pars'] = {p: r[p] for p in sorted(axes)}
+            res['imagename'] = r['imagename']
+            res['wide'] = res['maskfrac'] > maxmask
+            results.append(res)
+
+    ranked = sorted(results, key=lambda r: (r['wide'], r['rms'], -r['peak'], r['time']))
+    with open(prefix + '_sweep.json', 'w') as f:
+        json.dump(ranked, f, indent=1)
+    with open(prefix + '_sweep.txt', 'w') as f:
+        f.write(table(ranked) + '\n')
+    log(table(ranked))
+    return ranked
@@ -0,0 +1,132 @@
+##############################################################
+# Partitioned (multi-MS) concatenation for step 0
+#
+# Instead of concat copying msin into one monolithic mvis, each input is
+# split by spw group into sub-MSs (mstransform, one CASA process each,
+# nworkers at once), and virtualconcat then moves - not copies - the
+# sub-MSs under the reference MS mvis, renumbering spws as concat does.
+# The groups follow the spw layout: the spws observed together in the same
+# scans (one tuning of the spectral scan, so the groups also split by scan)
+# are kept together, or split into single spws when there are more cores
+# than tunings, or merged when there are far fewer; nparts='auto' aims at
+# about one sub-MS per core.
+#
+# CASA tasks (tclean parallel=True, applycal, mstransform, flagdata) then
+# work on the partitions under mpicasa, and the NumPy readers here
+# (gainsolve, uvcontsub, linefree, psfcache, msmeta) go through parts()
+# to read the sub-MSs concurrently.
+#
+#   mmspart.make(msin, mvis, nparts='auto', freqtol='2MHz', dirtol='1arcsec')
+#   mmspart.parts(mvis)        # sub-MS paths, or [mvis] for a plain MS
+##############################################################
+
+import glob
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parts(vis):
+    """The sub-MSs of a multi-MS, in order, or [vis] for a plain MS."""
+    sub = sorted(glob.glob(os.path.join(vis, 'SUBMSS', '*')))
+    return sub or [vis]
+
+
+def pmap(func, vis, nworkers=4):
+    """[func(part) for each part of vis], reading the parts concurrently."""
+    ps = parts(vis)
+    if len(ps) == 1:
+        return [func(ps[0])]
+    with ThreadPoolExecutor(max_workers=max(1, min(nworkers, len(ps)))) as pool:
+        return list(pool.map(func, ps))
+
+
+def tunings(meta, minnchan=16):
+    """Groups of science spws observed together, in order of first scan."""
+    groups = []
+    for sc in sorted(meta['scans'], key=int):
+        g = [s for s in meta['scans'][sc]['spws'] if meta['spws'][str(s)]['nchan'] >= minnchan]
+        if g and g not in groups:
+            groups.append(g)
+    # spws of a tuning seen in several scan setups belong to the first group only
+    seen, out = set(), []
+    for g in groups:
+        g = [s for s in g if s not in seen]
+        seen.update(g)
+        if g:
+            out.append(sorted(g))
+    return out
+
+
+def plan(metas, nparts='auto', cores=None):
+    """Spw groups (lists of spw ids) per input MS.
+
+    nparts is the total number of sub-MSs wanted ('auto': the number of
+    cores); each input gets its share, rounded to whole tunings where possible.
+    """
+    cores = cores or os.cpu_count() or 1
+    total = cores if nparts == 'auto' else int(nparts)
+    per = max(1, int(round(total / float(len(metas)))))
+    out = []
+    for meta in metas:
+        groups = tunings(meta)
+        if per >= 2 * len(groups):                   # more cores than tunings: one spw each
+            groups = [[s] for g in groups for s in g]
+        if len(groups) > per:                        # fewer cores: merge neighbouring tunings
+            k = int(math.ceil(len(groups) / float(per)))
+            groups = [sum(groups[i:i + k], []) for i in range(0, len(groups), k)]
+        # WVR and channel-average spws go with the first group, so nothing is lost
+        rest = sorted(set(int(s) for s in meta['spws']) - set(sum(groups, [])))
+        if groups:
+            groups[0] = sorted(groups[0] + rest)
+        elif rest:
+            groups = [rest]
+        out.append(groups)
+    return out
+
+
+def _mstransform(pars, logfile):
+    """Run one mstransform in a fresh CASA python process; True on success."""
+    code = ('import json,sys\n'
+            'from casatasks import mstransform\n'
+            'mstransform(**json.loads(sys.argv[1]))\n')
+    with open(logfile, 'a') as log:
+        ret = subprocess.call([sys.executable, '-c', code, json.dumps(pars)],
+                              stdout=log, stderr=subprocess.STDOUT)
+    return ret == 0 and os.path.isdir(pars['outputvis'])
+
+
+def make(msin, mvis, nparts='auto', cores=None, nworkers=None, **concatpars):
+    """Make mvis as a multi-MS of msin split by spw group; returns the sub-MS count.
+
+    concatpars (freqtol, dirtol, copypointing ...) go to virtualconcat.
+    """
+    import casatasks
+    import msmeta
+    cores = cores or os.cpu_count() or 1
+    groups = plan([msmeta.get(v) for v in msin], nparts, cores)
+    work = mvis.rstrip('/') + '.parts'
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+    jobs = []
+    for i, (vis, gs) in enumerate(zip(msin, groups)):
+        for j, g in enumerate(gs):
+            jobs.append(dict(vis=vis, spw=','.join(str(s) for s in g), datacolumn='all',
+                             reindex=False,       # keep the spw ids, as concat does
+                             outputvis=os.path.join(work, '%s.%d.%03d.ms' % (os.path.basename(mvis), i, j))))
+    print('Partitioning %d inputs into %d sub-MSs, %d at once' %
+          (len(msin), len(jobs), min(len(jobs), nworkers or cores)))
+    with ThreadPoolExecutor(max_workers=max(1, nworkers or cores)) as pool:
+        ok = list(pool.map(lambda p: _mstransform(p, p['outputvis'] + '.log'), jobs))
+    if not all(ok):
+        bad = [p['outputvis'] for p, o in zip(jobs, ok) if not o]
+        raise RuntimeError('mstransform failed for ' + ' '.join(bad) + ', see their .log')
+    concatpars.setdefault('copypointing', False)
+    casatasks.virtualconcat(vis=[p['outputvis'] for p in jobs], concatvis=mvis, keepcopy=False,
+                            **concatpars)
+    shutil.rmtree(work, ignore_errors=True)
+    return len(jobs)
@@ -0,0 +1,196 @@
+##############################################################
+# Model visibilities from the clean model image, on demand
+#
+# With modelmode='virtual' the continuum rounds image with
+# savemodel='virtual': tclean keeps only a reference to the model image and
+# gaincal predicts from it as it goes, instead of a full MODEL_DATA column
+# (every row, channel and correlation of cvis) being written after each
+# round and read back by gaincal.  The NumPy gain solver (gainsolve.load)
+# predicts the same model here, chunk by chunk as it reads the data:
+#   - a compact source such as V4334 Sgr leaves a few hundred non-zero
+#     clean-component pixels, summed directly (vectorized DFT, with the w term)
+#   - otherwise the model (padded pad times) is Fourier transformed once per
+#     Taylor term and the uv points interpolated bilinearly (no w term)
+# mtmfs models (.model.tt0, .tt1) give a spectral term
+#     I(nu) = tt0 + tt1 (nu - reffreq) / reffreq
+# Predicted chunks are kept in an LRU cache of cachemb MB, keyed by
+# sub-MS, spw and rows, so repeated reads of the same rows are free.
+# The model image is assumed centred on the phase centre of the field
+# (tclean without phasecenter); only Stokes I is predicted.
+#
+#   model = modelpred.read(mvis+'_cont.clean')          # .model or .model.tt0/.tt1
+#   vdata = gainsolve.load(cvis, target, model=model)
+#
+# python modelpred.py compares the DFT and FFT predictions on a synthetic model.
+##############################################################
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+C = 299792458.
+MAXCOMP = 500      # components summed directly; beyond that the FFT is used
+
+
+class Model(object):
+    """Taylor-term model images (nterm, nx, ny) predicting visibilities.
+
+    dl, dm are the signed pixel increments in radians, (i0, j0) the pixel
+    of the phase centre, so pixel (i, j) is at l = (i - i0) dl, m = (j - j0) dm.
+    """
+
+    def __init__(self, terms, dl, dm, i0, j0, reffreq=None, maxcomp=MAXCOMP, pad=4, cachemb=256):
+        self.terms = np.asarray(terms, dtype=float)
+        if self.terms.ndim == 2:
+            self.terms = self.terms[None]
+        self.dl, self.dm, self.i0, self.j0 = dl, dm, i0, j0
+        self.reffreq = reffreq
+        self.pad = pad
+        ii, jj = np.nonzero((self.terms != 0).any(axis=0))
+        self.flux = self.terms[:, ii, jj]                      # (nterm, ncomp)
+        self.l = (ii - i0) * dl
+        self.m = (jj - j0) * dm
+        self.mode = 'dft' if len(ii) <= maxcomp else 'fft'
+        self.cachemb = cachemb
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._grids = None
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @property
+    def ncomp(self):
+        return self.flux.shape[1]
+
+    def _taylor(self, freqs):
+        """(nterm, nchan) weights of the Taylor terms at freqs."""
+        x = (np.asarray(freqs) - self.reffreq) / self.reffreq if self.reffreq else np.zeros(len(freqs))
+        return np.array([x**t for t in range(len(self.terms))]).reshape(len(self.terms), -1)
+
+    def dft(self, uvw, freqs, maxel=4000000):
+        """(nchan, nrow) visibilities of the components; uvw (3, nrow) in metres."""
+        freqs = np.asarray(freqs, dtype=float)
+        spec = self._taylor(freqs).T @ self.flux                # (nchan, ncomp)
+        n = np.sqrt(np.maximum(0., 1. - self.l**2 - self.m**2)) - 1.
+        out = np.zeros((len(freqs), uvw.shape[1]), dtype=complex)
+        step = max(1, maxel // max(1, len(freqs) * self.ncomp))
+        k = -2j * np.pi * freqs / C
+        for r0 in range(0, uvw.shape[1], step):
+            u, v, w = uvw[:, r0:r0 + step]
+            path = np.outer(u, self.l) + np.outer(v, self.m) + np.outer(w, n)    # (nrow, ncomp)
+            out[:, r0:r0 + step] = np.einsum('crk,ck->cr', np.exp(k[:, None, None] * path), spec)
+        return out
+
+    def _fftgrids(self):
+        """Transforms of the padded terms, phase centre at pixel 0."""
+        with self._lock:
+            if self._grids is None:
+                nt, nx, ny = self.terms.shape
+                nu, nv = self.pad * nx, self.pad * ny
+                grids = []
+                for t in self.terms:
+                    p = np.zeros((nu, nv))
+                    p[:nx, :ny] = t
+                    p = np.roll(p, (-self.i0, -self.j0), axis=(0, 1))
+                    grids.append(np.fft.fft2(p))
+                self._grids = np.array(grids)
+        return self._grids
+
+    def fft(self, uvw, freqs):
+        """(nchan, nrow) visibilities interpolated from the transformed model."""
+        grids = self._fftgrids()
+        nt, nu, nv = grids.shape
+        spec = self._taylor(freqs)
+        out = np.zeros((len(freqs), uvw.shape[1]), dtype=complex)
+        for c, f in enumerate(freqs):
+            # F[k, q] is the visibility at u = k / (nu dl) wavelengths
+            x = (uvw[0] * f / C * self.dl * nu) % nu
+            y = (uvw[1] * f / C * self.dm * nv) % nv
+            x0, y0 = np.floor(x).astype(int), np.floor(y).astype(int)
+            fx, fy = x - x0, y - y0
+            x1, y1 = (x0 + 1) % nu, (y0 + 1) % nv
+            for t in range(nt):
+                g = grids[t]
+                out[c] += spec[t, c] * ((1 - fx) * (1 - fy) * g[x0, y0] + fx * (1 - fy) * g[x1, y0] +
+                                        (1 - fx) * fy * g[x0, y1] + fx * fy * g[x1, y1])
+        return out
+
+    def predict(self, uvw, freqs, key=None):
+        """(nchan, nrow) complex64 model visibilities, from the cache if key was seen."""
+        if key is not None:
+            with self._lock:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return self._cache[key]
+        vis = (self.dft if self.mode == 'dft' else self.fft)(uvw, freqs).astype(np.complex64)
+        if key is not None:
+            with self._lock:
+                self.misses += 1
+                self._cache[key] = vis
+                self._bytes += vis.nbytes
+                while self._bytes > self.cachemb * 1024**2 and len(self._cache) > 1:
+                    self._bytes -= self._cache.popitem(last=False)[1].nbytes
+        return vis
+
+
+def read(imagename, **kw):
+    """Model of a tclean image set (imagename+'.model', or '.model.tt0', '.tt1' ...)."""
+    from casatools import image
+    names = [imagename + '.model']
+    if not os.path.exists(names[0]):
+        names, t = [], 0
+        while os.path.exists('%s.model.tt%d' % (imagename, t)):
+            names.append('%s.model.tt%d' % (imagename, t))
+            t += 1
+    if not names:
+        raise IOError('no model image for ' + imagename)
+    ia = image()
+    terms = []
+    for name in names:
+        ia.open(name)
+        try:
+            terms.append(ia.getchunk()[:, :, 0, 0])         # Stokes I, first channel
+            cs = ia.coordsys()
+            incr = cs.increment(type='direction')['numeric']
+            ref = cs.referencepixel(type='direction')['numeric']
+            reffreq = cs.referencevalue(type='spectral')['numeric'][0]
+            cs.done()
+        finally:
+            ia.close()
+    model = Model(terms, incr[0], incr[1], int(round(ref[0])), int(round(ref[1])), reffreq, **kw)
+    print('Model %s: %d components, %s prediction' % (imagename, model.ncomp, model.mode))
+    return model
+
+
+def selftest(n=256, ncomp=40, nrow=20000, seed=5):
+    """Predict a synthetic model both ways; returns the relative difference."""
+    rng = np.random.default_rng(seed)
+    dl = np.radians(0.05 / 3600.)
+    terms = np.zeros((2, n, n))
+    ii = rng.integers(n // 2 - 10, n // 2 + 10, ncomp)
+    jj = rng.integers(n // 2 - 10, n // 2 + 10, ncomp)
+    terms[0, ii, jj] = rng.exponential(1e-3, ncomp)
+    terms[1, ii, jj] = -0.5 * terms[0, ii, jj]
+    freqs = np.linspace(230e9, 232e9, 4)
+    uvw = rng.normal(0., 300., (3, nrow))
+    uvw[2] = 0.                                   # the FFT path has no w term
+    dft = Model(terms, -dl, dl, n // 2, n // 2, 231e9)
+    fft = Model(terms, -dl, dl, n // 2, n // 2, 231e9, maxcomp=0)
+    t0 = time.time()
+    a = dft.predict(uvw, freqs, key='a')
+    t1 = time.time()
+    b = fft.predict(uvw, freqs)
+    t2 = time.time()
+    dft.predict(uvw, freqs, key='a')
+    err = float(np.abs(a - b).max() / np.abs(a).max())
+    print('%d components, %d rows x %d channels: dft %.2f s, fft %.2f s, max difference %.2g of peak, '
+          'cache hits %d' % (dft.ncomp, nrow, len(freqs), t1 - t0, t2 - t1, err, dft.hits))
+    return err
+
+
+if __name__ == '__main__':
+    selftest()
@@ -0,0 +1,255 @@
+##############################################################
+# Streamed moment maps and spectra from an image cube
+#
+# One pass through the cube, nblock channels at a time, produces
+#   mom0   integrated intensity          sum I dv           (Jy/beam km/s)
+#   mom1   intensity-weighted velocity   sum I v dv / mom0  (km/s)
+#   mom2   velocity dispersion           sqrt(sum I (v-mom1)^2 dv / mom0)
+#   peak   peak intensity and the velocity of the peak channel
+#   noise  rms per channel (1.4826 MAD in the noise box, or the whole plane)
+#   spectrum  flux density (Jy) in a circular aperture at a sky position
+# Moments use only pixels above clip x that channel's noise.  Blocks are
+# read and reduced in a process pool with a bounded number in flight, so
+# memory is set by nblock and nworkers, not by the size of the cube.
+#
+# FITS cubes (exportfits) are read through np.memmap; CASA images by
+# getchunk, each worker opening the image for its own block.
+#
+#   mom = moments.run(mvis+'_spw.clean.image.pbcor', centre=fitcen, radius='0.3arcsec',
+#                     noisebox=statboxes['noise'], chans='100~400')
+#   # writes .mom0 .mom1 .mom2 .peak .peakvel images and .spectrum.txt
+##############################################################
+
+import os
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import imstats
+
+C = 299792.458   # km/s
+
+
+def _fitsheader(path):
+    """(header dict, data offset) of the primary HDU of a FITS file."""
+    hdr = {}
+    with open(path, 'rb') as f:
+        nblock = 0
+        while True:
+            block = f.read(2880).decode('ascii')
+            nblock += 1
+            for i in range(0, 2880, 80):
+                card = block[i:i + 80]
+                key = card[:8].strip()
+                if key == 'END':
+                    return hdr, nblock * 2880
+                if card[8:10] == '= ':
+                    val = card[10:].split('/')[0].strip().strip("'").strip()
+                    hdr[key] = val
+
+
+def _fitscube(path):
+    """(memmap (nchan, ny, nx), spectral axis) of a FITS cube with up to 4 axes."""
+    hdr, offset = _fitsheader(path)
+    if int(hdr['BITPIX']) != -32 or float(hdr.get('BSCALE', 1)) != 1 or float(hdr.get('BZERO', 0)) != 0:
+        raise ValueError('%s: only unscaled float32 FITS cubes are supported' % path)
+    naxis = [int(hdr['NAXIS%d' % i]) for i in range(1, int(hdr['NAXIS']) + 1)]
+    spec = [i for i in range(2, len(naxis))
+            if hdr.get('CTYPE%d' % (i + 1), '').startswith(('FREQ', 'VRAD', 'VELO'))][0]
+    mm = np.memmap(path, dtype='>f4', mode='r', offset=offset, shape=tuple(reversed(naxis)))
+    # numpy order is reversed: (.., FREQ/STOKES, DEC, RA); keep the first stokes
+    idx = [0] * (len(naxis) - 2)
+    idx[len(naxis) - 1 - spec] = slice(None)
+    return mm[tuple(idx)], spec
+
+
+def _read(path, c0, c1):
+    """Channels c0..c1-1 as (nx, ny, nc) float32 with masked pixels NaN."""
+    if path.lower().endswith(('.fits', '.fit')):
+        cube, spec = _fitscube(path)
+        return np.array(cube[c0:c1]).astype(np.float32).transpose(2, 1, 0)
+    from casatools import image
+    ia = image()
+    ia.open(path)
+    try:
+        shape = ia.shape()
+        blc = [0, 0, 0, c0]
+        trc = [shape[0] - 1, shape[1] - 1, 0, c1 - 1]
+        data = ia.getchunk(blc, trc, dropdeg=False)
+        mask = ia.getchunk(blc, trc, dropdeg=False, getmask=True)
+    finally:
+        ia.close()
+    data = np.where(mask, data, np.nan).astype(np.float32)
+    return data.reshape(data.shape[0], data.shape[1], -1)
+
+
+def reduce(data, vel, dv, clip=3., noisebox=None, aperture=None):
+    """Moment sums, peak, noise and aperture sums for one block (nx, ny, nc).
+
+    vel and dv are the velocity and channel width (km/s) of each channel;
+    aperture is a boolean (nx, ny) mask.  Results of blocks combine with combine().
+    """
+    if noisebox is not None:
+        pix = imstats._pixels(data, noisebox)
+    else:
+        pix = data.reshape(-1, data.shape[2])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)            # blank channels
+        med = np.nanmedian(pix, axis=0)
+        noise = 1.4826 * np.nanmedian(np.abs(pix - med), axis=0)
+    with np.errstate(invalid='ignore'):
+        use = data > clip * noise[None, None, :]
+    w = np.where(use, data, 0.) * np.abs(dv)[None, None, :]
+    filled = np.where(np.isfinite(data), data, -np.inf)
+    ipk = np.argmax(filled, axis=2)
+    peak = np.take_along_axis(filled, ipk[:, :, None], axis=2)[:, :, 0]
+    out = {'s0': w.sum(axis=2), 's1': (w * vel).sum(axis=2), 's2': (w * vel**2).sum(axis=2),
+           'peak': peak, 'peakvel': vel[ipk], 'noise': noise}
+    if aperture is not None:
+        out['apsum'] = np.nansum(data[aperture], axis=0)
+    return out
+
+
+def combine(acc, part):
+    """Add the sums of part into acc (maps) in place; returns acc."""
+    if acc is None:
+        return {k: part[k] for k in ('s0', 's1', 's2', 'peak', 'peakvel')}
+    for k in ('s0', 's1', 's2'):
+        acc[k] += part[k]
+    better = part['peak'] > acc['peak']
+    acc['peak'] = np.where(better, part['peak'], acc['peak'])
+    acc['peakvel'] = np.where(better, part['peakvel'], acc['peakvel'])
+    return acc
+
+
+def _block(path, c0, c1, vel, dv, clip, noisebox, aperture):
+    return c0, reduce(_read(path, c0, c1), vel, dv, clip, noisebox, aperture)
+
+
+def _axes(path, centre, radius):
+    """Frequencies per channel, rest frequency, pixel area in beams and the aperture mask."""
+    from casatools import image, quanta
+    qa = quanta()
+    ia = image()
+    ia.open(path)
+    try:
+        shape = ia.shape()
+        csys = ia.coordsys()
+        spec = int(csys.findcoordinate('spectral')['pixel'][0])
+        ref = [0.] * len(shape)
+        freq = np.empty(shape[spec])
+        for c in range(shape[spec]):
+            ref[spec] = c
+            freq[c] = csys.toworld(ref, 'n')['numeric'][spec]
+        rest = csys.restfrequency()['value'][0] or float(np.mean(freq))
+        inc = csys.increment(type='direction', format='n')['numeric']
+        pixarea = abs(inc[0] * inc[1])                    # rad^2
+        beam = ia.restoringbeam()
+        if 'beams' in beam:
+            beam = beam['beams']['*0']['*0']
+        bmaj = qa.convert(beam['major'], 'rad')['value']
+        bmin = qa.convert(beam['minor'], 'rad')['value']
+        beampix = np.pi * bmaj * bmin / (4 * np.log(2)) / pixarea
+        aperture = None
+        if centre:
+            d = centre.split()
+            world = csys.toworld([0.] * len(shape), 'm')
+            world['measure']['direction']['m0'] = qa.quantity(d[-2])
+            world['measure']['direction']['m1'] = qa.quantity(d[-1])
+            x, y = csys.topixel(world)['numeric'][:2]
+            r = qa.convert(radius, 'rad')['value'] / np.sqrt(pixarea)
+            gx, gy = np.mgrid[:shape[0], :shape[1]]
+            aperture = (gx - x)**2 + (gy - y)**2 <= r**2
+        csys.done()
+    finally:
+        ia.close()
+    return freq, rest, beampix, aperture
+
+
+def _chans(chans, nchan):
+    if not chans:
+        return 0, nchan
+    c0, c1 = [int(c) for c in chans.split('~')]
+    return c0, min(c1, nchan - 1) + 1
+
+
+def run(imagename, centre='', radius='0.3arcsec', noisebox=None, chans='', clip=3.,
+        nblock=64, nworkers=4, outfile=None):
+    """Moment maps, per-channel noise and aperture spectrum of a cube in one pass.
+
+    imagename is a CASA image or FITS cube; centre an 'ICRS <ra> <dec>'
+    direction (e.g. fitcen from step 4), or '' for no spectrum.  chans
+    'c0~c1' limits the channels used.  Moment images are written to
+    outfile (default imagename) + '.mom0' etc. and the spectrum to
+    outfile+'.spectrum.txt'.  Returns a dict of the maps and arrays.
+    """
+    outfile = outfile or imagename
+    freq, rest, beampix, aperture = _axes(imagename, centre, radius)
+    vel = C * (1. - freq / rest)                                # radio convention
+    dv = np.gradient(vel) if len(vel) > 1 else np.ones(1)
+    c0, c1 = _chans(chans, len(freq))
+    noise = np.full(len(freq), np.nan)
+    spectrum = np.full(len(freq), np.nan)
+    acc = None
+    pending = deque()
+
+    def collect(fut):
+        nonlocal acc
+        b0, part = fut.result()
+        n = len(part['noise'])
+        noise[b0:b0 + n] = part['noise']
+        if 'apsum' in part:
+            spectrum[b0:b0 + n] = part['apsum'] / beampix
+        acc = combine(acc, part)
+
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        for b0 in range(c0, c1, nblock):
+            b1 = min(b0 + nblock, c1)
+            pending.append(pool.submit(_block, imagename, b0, b1, vel[b0:b1], dv[b0:b1],
+                                       clip, noisebox, aperture))
+            # bound the blocks held in memory
+            while len(pending) > 2 * nworkers:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mom0 = acc['s0']
+        mom1 = np.where(mom0 > 0, acc['s1'] / mom0, np.nan)
+        mom2 = np.sqrt(np.maximum(np.where(mom0 > 0, acc['s2'] / mom0, np.nan) - mom1**2, 0.))
+    blank = ~np.isfinite(acc['peak'])
+    maps = {'mom0': mom0, 'mom1': mom1, 'mom2': mom2,
+            'peak': np.where(blank, np.nan, acc['peak']),
+            'peakvel': np.where(blank, np.nan, acc['peakvel'])}
+    _write(imagename, outfile, maps)
+    with open(outfile + '.spectrum.txt', 'w') as f:
+        f.write('# chan  freq (GHz)  vrad (km/s)  noise (Jy/beam)  flux (Jy) in %s at %s\n'
+                % (radius, centre or '-'))
+        for c in range(c0, c1):
+            f.write('%5i %12.6f %12.3f %14.6g %14.6g\n' % (c, freq[c] / 1e9, vel[c], noise[c], spectrum[c]))
+    maps.update(freq=freq, vel=vel, noise=noise, spectrum=spectrum)
+    return maps
+
+
+def _write(template, outfile, maps):
+    """Write the maps as single-plane CASA images with the cube's coordinates."""
+    from casatools import image
+    ia = image()
+    ia.open(template)
+    try:
+        csys = ia.coordsys()
+        units = {'mom0': ia.brightnessunit() + '.km/s', 'mom1': 'km/s', 'mom2': 'km/s',
+                 'peak': ia.brightnessunit(), 'peakvel': 'km/s'}
+    finally:
+        ia.close()
+    for name, m in maps.items():
+        out = outfile + '.' + name
+        os.system('rm -rf ' + out)
+        im = image()
+        im.fromarray(outfile=out, pixels=m[:, :, None, None].astype(np.float32),
+                     csys=csys.torecord(), overwrite=True)
+        im.setbrightnessunit(units[name])
+        im.done()
+    csys.done()
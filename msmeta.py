@@ -0,0 +1,104 @@
+##############################################################
+# Cached MS metadata
+#
+# Antennas, unflagged antennas, fields and their phase centres, spws
+# (frequency, channel width, channels) and scans (field, spws,
+# integrations, integration time, antennas) are read from the MS once and
+# kept in a small JSON sidecar next to it, e.g. mvis+'.meta.json', keyed
+# by the MS path and modification time.  Later runs read the sidecar, so
+# exec'ing the script to rerun one step does not touch the MS; any change
+# to the MS (flagging, applycal) makes the next call extract them again.
+#
+#   meta = msmeta.get(mvis)
+#   meta['antennas'], meta['unflagged'], meta['spws']['17']['freq'], meta['scans']['48'] ...
+#
+# analysisUtils is slow to import and only needed for the odd utility:
+#   aU = msmeta.analysisutils(aUpath)
+##############################################################
+
+import json
+import os
+import sys
+
+_memo = {}
+
+
+def mtime(vis):
+    """Latest modification time of the files of the MS main table (of every
+    sub-MS of a multi-MS)."""
+    import mmspart
+    return max(os.path.getmtime(os.path.join(p, f)) for p in set([vis] + mmspart.parts(vis))
+               for f in os.listdir(p))
+
+
+def sidecar(vis):
+    return vis.rstrip('/') + '.meta.json'
+
+
+def get(vis):
+    """Metadata of vis, from memory, the sidecar file, or the MS if both are stale."""
+    key = {'path': os.path.abspath(vis), 'mtime': mtime(vis)}
+    k = (key['path'], key['mtime'])
+    if k in _memo:
+        return _memo[k]
+    meta = None
+    if os.path.exists(sidecar(vis)):
+        try:
+            with open(sidecar(vis)) as f:
+                meta = json.load(f)
+        except ValueError:
+            meta = None
+    if meta is None or meta.get('key') != key:
+        meta = extract(vis)
+        meta['key'] = key
+        try:
+            with open(sidecar(vis), 'w') as f:
+                json.dump(meta, f, indent=1)
+        except (IOError, OSError):
+            pass                    # read-only (e.g. the pipeline msin): keep in memory only
+    _memo[k] = meta
+    return meta
+
+
+def extract(vis):
+    """Read the metadata from the MS (msmetadata, plus a flagdata summary)."""
+    import casatasks
+    from casatools import msmetadata
+    msmd = msmetadata()
+    msmd.open(vis)
+    try:
+        meta = {'antennas': list(msmd.antennanames()), 'fields': {}, 'spws': {}, 'scans': {}}
+        for f in range(msmd.nfields()):
+            pc = msmd.phasecenter(f)
+            meta['fields'][msmd.namesforfields(f)[0]] = {
+                'id': f, 'ra': pc['m0']['value'], 'dec': pc['m1']['value']}
+        target = set(msmd.spwsforintent('OBSERVE_TARGET*'))
+        for s in range(msmd.nspw()):
+            widths = msmd.chanwidths(s)
+            meta['spws'][str(s)] = {'freq': msmd.meanfreq(s),
+                                    'chanwidth': float(abs(sorted(widths)[len(widths) // 2])),
+                                    'nchan': msmd.nchan(s),
+                                    'target': s in target}
+        for sc in msmd.scannumbers():
+            spws = [int(s) for s in msmd.spwsforscan(sc)]
+            meta['scans'][str(sc)] = {
+                'fields': [int(f) for f in msmd.fieldsforscan(sc)],
+                'spws': spws,
+                'nint': len(msmd.timesforscan(sc)),
+                'inttime': msmd.exposuretime(scan=sc, spwid=spws[0])['value'],
+                'nants': len(msmd.antennasforscan(sc))}
+    finally:
+        msmd.close()
+    # antennas with any unflagged data
+    summ = casatasks.flagdata(vis=vis, mode='summary', action='calculate')['antenna']
+    meta['unflagged'] = [a for a in meta['antennas']
+                         if a in summ and summ[a]['flagged'] < summ[a]['total']]
+    return meta
+
+
+def analysisutils(path='/raid/scratch/dwalker/analysis_scripts/'):
+    """Import analysisUtils from path, on first use."""
+    if path not in sys.path:
+        sys.path.append(path)
+    import analysisUtils
+    return analysisUtils
@@ -0,0 +1,126 @@
+##############################################################
+# PSF reuse between continuum imaging rounds
+#
+# Phase-only rounds apply with calwt=False and image with the same
+# imsize, cell, weighting and spw, so the PSF cannot change from one round
+# to the next.  psfcache.tclean() is a drop-in for tclean that keys each
+# image on the parameters that set the PSF plus a hash of the visibility
+# weights, flags and uvw.  After imaging it keeps the PSF products (.psf,
+# .sumwt, .weight, .pb, with their .ttN for mtmfs) in vis+'.psfcache/';
+# when a later call has the same key they are copied into the new image
+# and tclean runs with calcpsf=False, so only the residual and the
+# deconvolution are computed.  Any flagging or weight change (e.g. applycal
+# with calwt=True) gives a new key and a full tclean.
+#
+#   psfcache.tclean(vis=cvis, imagename=mvis+'_contp0.clean', imsize=imsz, ...)
+##############################################################
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+import checkpoint
+
+# tclean parameters that change the PSF, sumwt, weight or pb images
+PSFPARS = ['field', 'spw', 'timerange', 'uvrange', 'antenna', 'scan', 'observation', 'intent',
+           'datacolumn', 'imsize', 'cell', 'phasecenter', 'stokes', 'projection', 'specmode',
+           'reffreq', 'nchan', 'start', 'width', 'outframe', 'gridder', 'wprojplanes',
+           'vptable', 'mosweight', 'pblimit', 'normtype', 'deconvolver', 'nterms',
+           'weighting', 'robust', 'noise', 'npixels', 'uvtaper', 'perchanweightdensity']
+PRODUCTS = ['psf', 'sumwt', 'weight', 'pb']
+KEEP = 4          # cached PSFs kept per MS
+
+_memo = {}
+
+
+def fingerprint(vis, nrow=500000):
+    """Hash of the WEIGHT, FLAG and UVW columns of vis (memoized per mtime)."""
+    import mmspart
+    import msmeta
+    k = (os.path.abspath(vis), msmeta.mtime(vis))
+    if k not in _memo:
+        # sub-MSs of a multi-MS hashed concurrently, combined in order
+        hs = mmspart.pmap(lambda p: _hash(p, nrow), vis)
+        if len(hs) > 1:
+            hs = [hashlib.sha1(''.join(hs).encode()).hexdigest()]
+        _memo[k] = hs[0]
+    return _memo[k]
+
+
+def _hash(vis, nrow):
+    from casatools import table
+    h = hashlib.sha1()
+    tb = table()
+    tb.open(vis)
+    try:
+        cols = ['WEIGHT', 'FLAG', 'UVW', 'DATA_DESC_ID', 'FIELD_ID']
+        if 'WEIGHT_SPECTRUM' in tb.colnames() and tb.iscelldefined('WEIGHT_SPECTRUM', 0):
+            cols.append('WEIGHT_SPECTRUM')
+        n = tb.nrows()
+        for r0 in range(0, n, nrow):
+            for c in cols:
+                h.update(np.ascontiguousarray(tb.getcol(c, r0, min(nrow, n - r0))).tobytes())
+    finally:
+        tb.close()
+    return h.hexdigest()
+
+
+def key(vis, pars):
+    """Cache key of an image of vis made with tclean parameters pars."""
+    sel = {p: pars.get(p) for p in PSFPARS}
+    h = hashlib.sha1(json.dumps(sel, sort_keys=True, default=str).encode())
+    h.update(fingerprint(vis).encode())
+    return h.hexdigest()[:16]
+
+
+def _products(imagename):
+    """PSF products of imagename, e.g. .psf, .psf.tt0, .sumwt.tt1, .pb.tt0."""
+    n = len(imagename) + 1
+    return [p for p in glob.glob(imagename + '.*') if p[n:].split('.')[0] in PRODUCTS]
+
+
+def _copy(src, dst):
+    if not checkpoint.copy(src, dst):          # reflink if possible
+        shutil.copytree(src, dst)
+
+
+def restore(vis, imagename, k):
+    """Copy the cached PSF products for key k into imagename; True if found."""
+    d = os.path.join(vis + '.psfcache', k)
+    if not os.path.isdir(d) or not os.listdir(d):
+        return False
+    for p in os.listdir(d):
+        _copy(os.path.join(d, p), imagename + p)
+    os.utime(d)
+    return True
+
+
+def store(vis, imagename, k):
+    """Keep the PSF products of imagename under key k, dropping the oldest beyond KEEP."""
+    root = vis + '.psfcache'
+    d = os.path.join(root, k)
+    os.system('rm -rf ' + d)
+    os.makedirs(d)
+    for p in _products(imagename):
+        _copy(p, os.path.join(d, p[len(imagename):]))
+    old = sorted(glob.glob(os.path.join(root, '*')), key=os.path.getmtime)
+    for o in old[:-KEEP]:
+        os.system('rm -rf ' + o)
+
+
+def tclean(vis, imagename, **pars):
+    """tclean, reusing the PSF of an earlier image with the same key."""
+    import casatasks
+    k = key(vis, pars)                       # before tclean rewrites MODEL_DATA
+    reuse = restore(vis, imagename, k)
+    if reuse:
+        print('Reusing the PSF and weights of an earlier round for ' + imagename)
+    calcpsf = pars.pop('calcpsf', True) and not reuse
+    ret = casatasks.tclean(vis=vis, imagename=imagename, calcpsf=calcpsf, **pars)
+    if not reuse:
+        store(vis, imagename, k)
+    return ret
@@ -0,0 +1,53 @@
+##############################################################
+# Per-band parameters from JSON config files
+#
+# Instead of commenting the Band 6 block in and out for Band 7, keep the
+# per-band parameters (msin, mvis, antrefs, contchans, rms_1_1, badsols,
+# solints, cube settings ...) in configs/<name>.json and in the terminal
+#   bandconfig='configs/B7.json'; exec(open('selfcal_script.py').read())
+# or set SELFCAL_CONFIG before starting CASA.  Any script variable may be
+# given; keys starting with '_' are comments and the scheduling keys
+# (resources, after, steps, split, workdir) are only read by batch.py.
+# cvis and statboxes are recomputed from mvis and imsz unless the config
+# sets them.
+##############################################################
+
+import json
+
+BATCHKEYS = ['resources', 'after', 'steps', 'split', 'workdir']
+
+
+def load(path):
+    """The config as a dict, with the scheduling keys."""
+    with open(path) as f:
+        cfg = json.load(f)
+    return {k: v for k, v in cfg.items() if not k.startswith('_')}
+
+
+def steps(spec):
+    """Step list from e.g. '0-4,13' or [0, 1, 2]."""
+    if isinstance(spec, (list, tuple)):
+        return [int(s) for s in spec]
+    out = []
+    for part in str(spec).replace(' ', '').split(','):
+        if '-' in part:
+            a, b = part.split('-')
+            out += range(int(a), int(b) + 1)
+        elif part:
+            out.append(int(part))
+    return out
+
+
+def apply(ns, path):
+    """Set the script variables in namespace ns from the config at path."""
+    cfg = {k: v for k, v in load(path).items() if k not in BATCHKEYS}
+    ns.update(cfg)
+    if 'cvis' not in cfg:
+        ns['cvis'] = ns['mvis'] + '.contavg'
+    if 'imsz' in cfg and 'statboxes' not in cfg:
+        imsz = ns['imsz']
+        ns['statboxes'] = {'noise': '10,10,' + str(imsz - 10) + ',' + str(0.2 * imsz),
+                           'peak': str(0.25 * imsz) + ',' + str(0.25 * imsz) + ',' +
+                                   str(0.75 * imsz) + ',' + str(0.75 * imsz)}
+    print('Parameters from ' + path + ': ' + ', '.join(sorted(cfg)))
+    return cfg
@@ -0,0 +1,241 @@
+##############################################################
+# Run ledger in SQLite
+#
+# Replaces the free-text _imstats1.txt: every run of the script is a row
+# in runs (run id as the trace files, MS, config), every step a row in
+# steps (status, wall and CPU time, peak RSS during the step, parameters) and every image
+# checked a row in images:
+#   step, image, kind, predicted rms, rms, peak, S/N (mJy), minsol (s),
+#   peak position, parameters (JSON) and anything else (extra, JSON)
+# plus free-text notes.  One ledger per imaging directory holds all bands,
+# e.g. target+'_ledger.sqlite'; concurrent runs (batch.py) share it.
+#
+#   ledger = runledger.Ledger(target+'_ledger.sqlite', run=tracer.run, mvis=mvis)
+#   ledger.record(6, mvis+'_contp0.clean.image', rms=rms, peak=peak, predicted=predicted_rms_cont/1000.)
+#   ledger.images(mvis=mvis, step=6)          # list of dicts, oldest first
+#   ledger.diff(run1, run2)                   # same images in two runs
+#
+# From the shell:
+#   python runledger.py V4334_Sgr_ledger.sqlite runs|images|steps|diff RUN1 RUN2|export out.jsonl
+##############################################################
+
+import json
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+import steptrace
+
+_SCHEMA = '''
+create table if not exists runs (run text primary key, mvis text, config text,
+    host text, started real);
+create table if not exists steps (id integer primary key, run text, mvis text, step integer,
+    status text, started real, wall real, cpu real, maxrss_mb real, params text);
+create table if not exists images (id integer primary key, run text, mvis text, step integer,
+    image text, kind text, predicted_mjy real, rms_mjy real, peak_mjy real, snr real,
+    minsol real, peakpos text, params text, extra text, time real);
+create table if not exists notes (id integer primary key, run text, mvis text, step integer,
+    text text, time real);
+create index if not exists images_image on images (image);
+create index if not exists images_run on images (run, step);
+create index if not exists images_mvis on images (mvis, step);
+create index if not exists steps_run on steps (run, step);
+'''
+
+
+def _dumps(obj):
+    return json.dumps(obj, sort_keys=True, default=str) if obj is not None else None
+
+
+class Ledger(object):
+    """Structured records of the runs, steps and images of one imaging directory."""
+
+    def __init__(self, path, run=None, mvis='', config=''):
+        self.path = path
+        self.run = run or steptrace.runid()
+        self.mvis = mvis
+        self.db = sqlite3.connect(path, timeout=60.)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('pragma journal_mode=wal')      # readers and other bands do not block
+        self.db.executescript(_SCHEMA)
+        self._steps = {}
+        if mvis:
+            with self.db:
+                # run ids are unique (steptrace.runid): a clash is an error, not a lost row
+                self.db.execute('insert into runs values (?, ?, ?, ?, ?)',
+                                (self.run, mvis, config, socket.gethostname(), time.time()))
+
+    # writing
+
+    def begin(self, step, params=None):
+        self._steps[step] = (time.time(), params)
+
+    def finish(self, step, status='done', ev=None):
+        """Record a step; ev is its steptrace event for CPU time and memory."""
+        t0, params = self._steps.pop(step, (time.time(), None))
+        a = ev['args'] if ev else {}
+        with self.db:
+            self.db.execute('insert into steps (run, mvis, step, status, started, wall, cpu, '
+                            'maxrss_mb, params) values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (self.run, self.mvis, step, status, t0, time.time() - t0,
+                             a.get('cpu'), a.get('peakrss_mb'), _dumps(params)))
+
+    def skipped(self, step):
+        self.finish(step, 'up to date')
+
+    def record(self, step, image, rms=None, peak=None, predicted=None, minsol=None,
+               peakpos=None, kind='cont', params=None, **extra):
+        """Record the statistics of an image; rms, peak and predicted in Jy.
+
+        params default to those the step was started with; other keyword
+        arguments are kept in extra.
+        """
+        if params is None and step in self._steps:
+            params = self._steps[step][1]
+        mjy = [None if v is None else 1000. * float(v) for v in (predicted, rms, peak)]
+        snr = float(peak) / float(rms) if rms and peak is not None else None
+        with self.db:
+            self.db.execute('insert into images (run, mvis, step, image, kind, predicted_mjy, '
+                            'rms_mjy, peak_mjy, snr, minsol, peakpos, params, extra, time) '
+                            'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (self.run, self.mvis, step, image, kind, mjy[0], mjy[1], mjy[2],
+                             snr, minsol, peakpos, _dumps(params), _dumps(extra or None),
+                             time.time()))
+
+    def note(self, step, text):
+        """Free text, e.g. a table printed by a step."""
+        with self.db:
+            self.db.execute('insert into notes (run, mvis, step, text, time) values (?, ?, ?, ?, ?)',
+                            (self.run, self.mvis, step, text, time.time()))
+
+    def close(self):
+        self.db.close()
+
+    # reading
+
+    def _select(self, table, order='time', **where):
+        where = {k: v for k, v in where.items() if v is not None}
+        sql = 'select * from %s' % table
+        if where:
+            sql += ' where ' + ' and '.join('%s = ?' % k for k in where)
+        rows = self.db.execute(sql + ' order by ' + order, list(where.values())).fetchall()
+        out = []
+        for r in rows:
+            d = dict(r)
+            for k in ('params', 'extra'):
+                if d.get(k):
+                    d[k] = json.loads(d[k])
+            out.append(d)
+        return out
+
+    def runs(self, mvis=None):
+        return self._select('runs', 'started', mvis=mvis)
+
+    def images(self, run=None, mvis=None, step=None, image=None, kind=None):
+        """Image records matching all the given fields, oldest first."""
+        return self._select('images', run=run, mvis=mvis, step=step, image=image, kind=kind)
+
+    def steps(self, run=None, mvis=None, step=None):
+        return self._select('steps', 'started', run=run, mvis=mvis, step=step)
+
+    def notes(self, run=None, mvis=None, step=None):
+        return self._select('notes', run=run, mvis=mvis, step=step)
+
+    def latest(self, image):
+        """The most recent record of image, or None."""
+        rows = self.images(image=image)
+        return rows[-1] if rows else None
+
+    def diff(self, run1, run2, by='image'):
+        """Records of run1 and run2 side by side, matched on image name (or by='step').
+
+        Returns dicts with the two records (a, b; None if missing from a
+        run), the change in rms and S/N and the parameters that differ.
+        """
+        def last(run):
+            recs = {}
+            for r in self.images(run=run):
+                recs[r[by] if by == 'image' else (r['step'], os.path.basename(r['image']))] = r
+            return recs
+        a, b = last(run1), last(run2)
+        out = []
+        for k in sorted(set(a) | set(b), key=str):
+            ra, rb = a.get(k), b.get(k)
+            d = {'key': k, 'a': ra, 'b': rb, 'drms': None, 'dsnr': None, 'params': {}}
+            if ra and rb:
+                if ra['rms_mjy'] and rb['rms_mjy'] is not None:
+                    d['drms'] = rb['rms_mjy'] / ra['rms_mjy'] - 1.
+                if ra['snr'] and rb['snr'] is not None:
+                    d['dsnr'] = rb['snr'] / ra['snr'] - 1.
+                pa, pb = ra['params'] or {}, rb['params'] or {}
+                d['params'] = {p: (pa.get(p), pb.get(p)) for p in sorted(set(pa) | set(pb))
+                               if pa.get(p) != pb.get(p)}
+            out.append(d)
+        return out
+
+    def table(self, rows):
+        """Text table of image records."""
+        lines = ['%-26s %4s %-40s %9s %9s %9s %7s %7s' % (
+            'run', 'step', 'image', 'pred mJy', 'rms mJy', 'peak mJy', 'S/N', 'minsol')]
+        f = lambda v, fmt: fmt % v if v is not None else '%*s' % (len(fmt % 0), '-')
+        for r in rows:
+            lines.append('%-26s %4i %-40s %s %s %s %s %s' % (
+                r['run'], r['step'], os.path.basename(r['image'])[-40:],
+                f(r['predicted_mjy'], '%9.4f'), f(r['rms_mjy'], '%9.4f'), f(r['peak_mjy'], '%9.3f'),
+                f(r['snr'], '%7.1f'), f(r['minsol'], '%7.1f')))
+        return '\n'.join(lines)
+
+    def export(self, outfile, since=None):
+        """Write one compact JSON object per line: the steps and image records
+        (since a unix time if given), for monitoring."""
+        n = 0
+        with open(outfile, 'w') as f:
+            for kind, rows in (('step', self.steps()), ('image', self.images())):
+                for r in rows:
+                    if since is not None and (r.get('time') or r.get('started')) < since:
+                        continue
+                    r = {k: v for k, v in r.items() if v is not None and k != 'id'}
+                    r['type'] = kind
+                    f.write(json.dumps(r, sort_keys=True, separators=(',', ':')) + '\n')
+                    n += 1
+        return n
+
+
+USAGE = 'usage: python runledger.py LEDGER runs|images [MVIS]|steps [RUN]|diff RUN1 RUN2|export OUT'
+
+
+def main(argv):
+    if len(argv) < 2 or len(argv) < 2 + {'diff': 2, 'export': 1}.get(argv[1], 0):
+        print(USAGE)
+        return 1
+    led = Ledger(argv[0])
+    cmd, args = argv[1], argv[2:]
+    if cmd == 'runs':
+        for r in led.runs():
+            print('%-26s %-30s %-20s %s' % (r['run'], r['mvis'], r['host'], r['config'] or ''))
+    elif cmd == 'images':
+        print(led.table(led.images(mvis=args[0] if args else None)))
+    elif cmd == 'steps':
+        for s in led.steps(run=args[0] if args else None):
+            print('%-26s %-24s %4i %-10s %9.1f %9s' % (s['run'], s['mvis'], s['step'], s['status'],
+                                                       s['wall'], '%.0f' % s['maxrss_mb']
+                                                       if s['maxrss_mb'] is not None else '-'))
+    elif cmd == 'diff':
+        for d in led.diff(args[0], args[1]):
+            sa = '%.1f' % d['a']['snr'] if d['a'] and d['a']['snr'] else '-'
+            sb = '%.1f' % d['b']['snr'] if d['b'] and d['b']['snr'] else '-'
+            drms = '%+.1f%%' % (100. * d['drms']) if d['drms'] is not None else '-'
+            print('%-45s S/N %7s -> %7s  rms %8s  %s' % (os.path.basename(str(d['key'])), sa, sb, drms,
+                  ', '.join('%s %s -> %s' % (p, v[0], v[1]) for p, v in d['params'].items())))
+    elif cmd == 'export':
+        print('%d records written to %s' % (led.export(args[0]), args[0]))
+    else:
+        print('unknown command ' + cmd)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
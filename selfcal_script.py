@@ -11,7 +11,9 @@
 # /raid/scratch/aaz/2021.1.00917.S/Imaging  (or you could further subdivide for bands etc.)
 # Further rounds of self-cal can be added if needed
 #
-# The final round of applycal makes a copy of the data before calibrating weights.
+# The final round of applycal saves the weights and flags before calibrating weights
+# (a reflink copy of the MS, or its columns in a .ckpt, by checkpoint.snapshot;
+# checkpoint.restore(cvis, cvis+'_prefinalapplycalwt') undoes either).
 # Failed solutions are not flagged as all data have already had phase ref solutions and
 # some spw just have less continuum so lower S/N
 #
@@ -28,7 +30,10 @@
 #    it more assertive .
 #    Also, if you are doing it interactively, once the automasking residual is <~1 mJy, I suggest
 #    masking the central ~1" for all planes manually, to pick up weak central emission.
-#    If you restart tclean, set calcres=False, calcpsf=False.
+#    If you restart tclean, set calcres=False, calcpsf=False.  The imaging steps do this themselves
+#    when they are rerun after an interruption (cleanjournal, every cleansegment major cycles).
+#    The continuum rounds do this for the PSF themselves: while flags, weights and imaging parameters
+#    are unchanged the PSF of the previous round is reused (psfcache, kept in cvis+'.psfcache').
 #
 ##############################################################
 # Check for best CASA version, currently /usr/local/casa-6.3.0-48/bin/casa
@@ -41,20 +46,35 @@ target='V4334_Sgr'
 
 msin=[pth+'Band_6/MSes/band_6_lower_half.ms',pth+'Band_6/MSes/band_6_upper_half.ms']
 mvis=target+'_B6.ms'
+cvis=mvis+'.contavg'   # line-free channels averaged, for self-cal (step 2)
+# 0 concatenates msin into one MS; N (or 'auto', one per core) makes mvis a multi-MS of N
+# spw-group partitions for parallel CASA tasks under mpicasa and concurrent reads here (mmspart)
+mmsparts=0
 
 # Enter a list of refants, e.g. the first few in the pipeline priority lists for each dataset (weblog task hif_refant).
 antrefs='DA63, DA57, DV08, DV24'
 
-Nspw=40
-rms_1_1 = 0.25  # mJy rms noise predicted mid B6 242 GHz for 1 GHz, 1 min. Dec -17 from sensitivity calculator
-# Time for sensitivity calculation (should be able to get from data but utility not compatible at present)
-ToS= 100./10.    #100 min over 10 tunings
+# mJy rms noise for 1 GHz, 1 min, Dec -17 from sensitivity calculator;
+# None uses sensitivity.RMS_1_1 for the band (B6 0.25 mid-band 242 GHz, B7 0.4).
+# Time on source, antennas and spws are read from the MS.
+rms_1_1 = None
+# Data seen to have bad solutions (flagged in step 6 and again on the full MS in step 12):
+# a flagdata selection, a list of flag commands, or 'auto' to flag the outliers calflags finds in .p0
+# (steps 5, 7, 9 print these and write them to e.g. mvis+'.p0.flagcmd' for review)
+badsols=dict(antenna='DA50', scan='48', spw='17,19,21,23')
 # Solution intervals - refine after step 4
 # Ideally there should be approx. integer solints per scan and solint should be ~integer multiple of integration time
 # The actual minimum solint may be >> theoretical as some spw have fewer line-free channels.
 solintp0='66s'     # increase if less than minsolint
 solintp1='21s'     # no less than minsolint
 solinta1='66s'     # usually longer than solintp1
+# Step 4 compares the S/N and phase rms of these solints with a quick NumPy gain solver; [] to skip
+previewsolints=['inf','66s','42s','21s','int']
+# Or let step 5 choose: phase rounds with shrinking solints down to the step 4 minimum solint,
+# then an amp round, stopping when the peak S/N improves by less than autocalgain (replaces steps 5-10)
+autoselfcal=False
+autocalgain=0.05   # fractional S/N improvement needed to keep a round
+autocalamp=True    # finish with an amplitude round (solint solinta1)
 
 contchans='17:0~88;101~112,19:0~123, 21:0~9;34~55;59~72;85~89;97~123, 23:0~17;38~90,\
 29:0~90;93~123,31:0~8;33~40;74~123, 33:25~123,35:0~87;95~106;114~120,\
@@ -67,15 +87,18 @@ contchans='17:0~88;101~112,19:0~123, 21:0~9;34~55;59~72;85~89;97~123, 23:0~17;38
 169:0~110,171:0~8;32~79;91~123,173:0~5;37~123,175:0~7;24~64;73~123,\
 181:0~51;69~76;91~117,183:0~123,185:0~58;115~123,187:0~20;52~123'
 
+# or contchans='auto' to find the line-free channels of mvis (after step 0) from its averaged spectra
+linefreesigma=3.5   # for 'auto': channels this many x the noise from the continuum are line
+linefreegrow=2      # and this many channels either side of them
+
 #########################################
 
-# repeat for B7
+# repeat for B7, or better keep each band in configs/ (see bandconfig below)
 #msin=[]
 #mvis=target+'_B7.ms'
+#cvis=mvis+'.contavg'
 #antrefs=''
 #contchans=''
-#rms_1_1 = 0.4  # mJy rms noise mid B7 for 1 GHz, 1 min. Dec -17
-#ToS= 150./10.   # 150 min over 10 tunings
 
 ##########################################
 # Parameters for all
@@ -84,6 +107,13 @@ cell='0.05arcsec'
 R=0.75
 imsz=540
 contchwd=0.015626283 # GHz (in fact all channels, here)
+nchanspw=128         # channels per spw (TDM)
+contavgnchan=1       # channels per spw after averaging the line-free channels for self-cal
+# self-cal model: 'column' writes MODEL_DATA after each continuum round (savemodel='modelcolumn');
+# 'virtual' keeps only the model image (savemodel='virtual'), predicted by gaincal on the fly
+# and by modelpred for the step 4 preview - no column write and read per round, smaller cvis
+modelmode='column'
+contsubmode='mstransform'  # step 12 continuum subtraction, or 'numpy' for the streaming uvcontsub engine
 Ncorr = 2.           # 2 polarizations
 
 ##################################
@@ -98,21 +128,36 @@ masktype='auto-multithresh' # 'automultithresh' for automasking or 'user' for ma
 thismask=''     # default name will be used but you can specify an existing mask
 nthresh=3.5     # rms multiplier for initial automasking
 mbf=0.3         # min beam fraction for automasking
-
-# open file to send continuum stats to.
-statfile=open(mvis+'_imstats1.txt', 'a')
+# boxes for continuum image statistics (blcx,blcy,trcx,trcy as imstat)
+statboxes={'noise':'10,10,'+str(imsz-10)+','+str(0.2*imsz),
+           'peak':str(0.25*imsz)+','+str(0.25*imsz)+','+str(0.75*imsz)+','+str(0.75*imsz)}
+cubechunk=''    # '' for one tclean job; 'spw' or N to image the same cube in chunks cut at spw boundaries or of N channels
+cubeworkers=4   # chunks imaged at once
+cubememgb=64    # memory budget (GB) for the chunks imaged at once
+cleansegment=5  # major cycles between deconvolution checkpoints (resume after a kill); 0 for none
+# moment maps and spectra of the cube (step 14)
+peakpos=''         # continuum peak 'ICRS <ra>rad <dec>rad' as printed by step 4 ('' uses fitcen if step 4 ran in this session)
+specradius='0.3arcsec'  # aperture radius for the spectrum at peakpos
+momchans=''        # cube channels for the moment maps e.g. '1200~1500', '' for all
+momclip=3.         # moments use pixels above momclip x the rms of their channel
+momkind='image'    # or 'pbcor' (noisier at the edges, where the per-channel rms is measured)
+# automasking sweep (step 15): lists of tclean values to try in all combinations, {} to skip, e.g.
+# sweepgrid=dict(noisethreshold=[3.,3.5,4.25], minbeamfrac=[0.1,0.3], lownoisethreshold=[1.2,1.5], robust=[0.5,1.])
+sweepgrid={}
+sweepon='cont'     # continuum (cvis, as step 3) or a few cube channels of the contsub MS e.g. '21:40~60'
 
 #***
 # After each continuum imaging step (in the next or the same step) the script
-# writes the peak, rms, S/N to screen and to a text file target*_imstats.txt
-# This is cumulative including repeated steps so you can check for improvement.
+# writes the peak, rms, S/N to screen and to the run ledger target*_ledger.sqlite
+# This is cumulative including repeated steps so you can check for improvement:
+# python runledger.py V4334_Sgr_ledger.sqlite images (or diff RUN1 RUN2, export out.jsonl).
 #
 # set thesteps here (e.g. to only do band 6, do [0], 1
 # or in terminal mysteps=[0] etc. (will overrule thesteps)
 thesteps = []
 step_title = {0:'Concatenate and list',
               1:'Print time on source, predicted sensitivity etc.',
-              2: '',
+              2:'Make channel-averaged continuum MS',
               3:'First continuum image',
               4:'Get image statistics and predict gaincal solint',
               5:'First phase-only self-calibration, plotms solutions',
@@ -123,48 +168,114 @@ step_title = {0:'Concatenate and list',
               10:'Apply calibration and re-image',
               11: '',
               12:'Subtract continuum and check line visibilities',
-              13:'Make image cube'}
+              13:'Make image cube',
+              14:'Moment maps, channel noise and spectrum',
+              15:'Automasking parameter sweep'}
 
 import sys
 import os
 import numpy as np
-sys.path.append("/raid/scratch/dwalker/analysis_scripts/")
-import analysisUtils as aU
+import casatasks
+aUpath="/raid/scratch/dwalker/analysis_scripts/"   # analysisUtils, imported only where used (step 4)
 from os import write
 
-# Estimate continuum sensitivity
-def totcont(contchans):
-#    for s in sps:
-#        if s in contchans:
-#            contchans=contchans.replace(s, '(-')
-    contchans=re.sub(r'.?.?:','(-', contchans)                    # replace spw numbers and :
-    contchans=contchans.replace('1(','(')                         # remove 1 from spw numbers >100
-    contchans=contchans.replace('~','+').replace(';',')+(-').replace(',',')+')
-    contchans=contchans+(')')
-    return contchans
+# helper modules live next to this script
+try: scriptdir=os.path.dirname(os.path.abspath(__file__))
+except NameError:
+    scriptdir=os.getcwd()
+sys.path.append(scriptdir)
+import chansel
+import steprunner
+import cubechunks
+import imstats
+import autocal
+import checkpoint
+import uvcontsub
+import sensitivity
+import steptrace
+import gainsolve
+import calflags
+import msmeta
+import moments
+import psfcache
+import masksweep
+import runconfig
+import runledger
+import linefree
+import costmodel
+import mmspart
+import modelpred
+import cleanjournal
+import incrapply
+
+# Per-band parameters from a config file instead of the blocks above, e.g. in terminal
+# bandconfig='configs/B7.json' (batch.py sets SELFCAL_CONFIG and runs bands concurrently)
+try: bandconfig
+except NameError:
+    bandconfig=os.environ.get('SELFCAL_CONFIG', '')
+if bandconfig:
+    runconfig.apply(globals(), bandconfig)
+
+# Line-free channels found automatically, cached in mvis+'.linefree.json' until step 0
+# remakes mvis (not when later steps flag or calibrate it, which would requeue steps 2-12).
+# Without a step-0 record the first result is kept: remove the .json to redo it.
+if contchans=='auto':
+    if os.path.exists(mvis):
+        contchans=linefree.contchans(mvis, nsigma=linefreesigma, grow=linefreegrow,
+                                     stamp=steprunner.completed(mvis+'_steps.json', 0) or 'kept')
+        print('contchans='+repr(contchans))
+    else:
+        print('contchans=auto needs mvis: run step 0, then the later steps')
+        contchans=''
 
+# Parse the continuum selection once; all steps take channels/bandwidth from contsel
+contsel=chansel.parse(contchans)
 if len(contchans) > 1:
-    ncontchan=eval(totcont(contchans))
-    contGHz=contchwd*ncontchan               # total line-free continuum
+    ncontchan=contsel.nchan()
+    contGHz=contsel.ghz(contchwd)               # total line-free continuum
 
-# sensitivity as ideal * sqrt(ncontchan/maxcontchan)
+# sensitivity per spw from time on source and line-free bandwidth, combined over all spws
+# (MS metadata are read once and cached in mvis+'.meta.json' until the MS changes)
+try: dryrun
+except NameError:
+    dryrun=False
 if len(contchans) > 1:
+  sensvis=None
   if os.path.exists(mvis):
+      sensvis=mvis
+  elif dryrun and all(os.path.exists(m) for m in msin):
+      sensvis=msin                             # before step 0: spws numbered as concat will
+  if sensvis:
+      sens=sensitivity.predict(sensitivity.metadata(sensvis, target, freqtol=2e6), contsel, rms_1_1,
+                               ncorr=int(Ncorr))
       try: Nants
       except NameError:
-          Nants=len(aU.getUnflaggedAntennas(mvis)[0])
-#      try: ToS    # utility does not work at present, ToS hard-wired
-#      except NameError:
-#          ToS=aU.timeOnSource(msin[0],field=target,scienceSpwsOnly=True)[0]['minutes_on_source_with_latency'] # average time on target
-      predicted_rms_cont=rms_1_1*(ToS*contGHz)**-0.5
-      predicted_rms_line = predicted_rms_cont*(float(ncontchan))**0.5 # potential sensitvity per chan
+          Nants=sens['nants']
+      Nspw=sens['nspw']
+      ToS=sens['tos_mean']                     # avg. per tuning
+      predicted_rms_cont=sens['rms_cont']
+      predicted_rms_line=sens['rms_line']      # potential sensitivity per chan (median spw)
+
+# Self-cal tables to transfer to the full-resolution MS in step 12
+selfcaltables=[mvis+'.p0',mvis+'.p1',mvis+'.a1']
+if autoselfcal and autocal.accepted(mvis) is not None:
+    selfcaltables=autocal.accepted(mvis)     # may be [] if no round improved the image
 
 # Set thresholds for imaging
 if 'predicted_rms_cont' in locals():
     thresh= '%2.3f mJy' %(predicted_rms_cont)
+    # continuum imaging parameters, used to decide whether an imaging step is up to date
+    contimpars=dict(spw=contsel.casa, imsz=imsz, cell=cell, thresh=thresh,
+                    masktype=masktype, nthresh=nthresh, mbf=mbf, modelmode=modelmode)
+savemodel={'column':'modelcolumn', 'virtual':'virtual'}[modelmode]
 
 if 'predicted_rms_line' in locals():
     linethresh= '%2.3f mJy' %(predicted_rms_line)
+if dryrun and 'linethresh' not in locals():
+    # no metadata to predict from: placeholders, so the dry run can list the steps
+    thresh=linethresh='0mJy'
+    contimpars=dict(spw=contsel.casa, imsz=imsz, cell=cell, thresh=thresh,
+                    masktype=masktype, nthresh=nthresh, mbf=mbf, modelmode=modelmode)
 
 ###############
 try:
@@ -176,30 +287,90 @@ if (thesteps==[]):
   thesteps = range(0,len(step_title))
   print( 'Executing all steps: ', thesteps)
 
+# Steps whose inputs, parameters and products are unchanged since they last
+# completed are skipped.  In terminal forcesteps=[13] etc. to rerun regardless.
+try: forcesteps
+except NameError:
+    forcesteps=[]
+# Wall/CPU time, peak RSS, I/O and product sizes of every step and heavy task call
+# go to mvis+'_trace_<run>.json' (Chrome trace-event format) and a summary '.txt'
+tracer=steptrace.Tracer(mvis+'_trace')
+tracer.instrument(globals(), casatasks)
+tracer.instrument(imstats, tasks=['stats', 'cubestats'])
+tracer.instrument(gainsolve, tasks=['load', 'compare'])
+# Predicted and achieved rms, peak, S/N, minsol, peak position, parameters and step timings
+# of every run, all bands, go to one SQLite ledger
+# In terminal dryrun=True lists the steps that would run with their estimated visibilities, memory,
+# disk and time (from the MS metadata, imsz, channels and deconvolver, calibrated by earlier traces)
+# and records nothing in the ledger
+ledger=None if dryrun else runledger.Ledger(target+'_ledger.sqlite', run=tracer.run, mvis=mvis,
+                                            config=bandconfig)
+plan=None
+if len(contchans) > 1 and (os.path.exists(mvis) or dryrun):
+  # before step 0 the estimate is from msin, spw ids numbered as concat will number them
+  # (freqtol as step 0); with mmsparts the sub-MS layout differs, so it is approximate
+  cost=costmodel.Model([mvis] if os.path.exists(mvis) else msin, ncorr=int(Ncorr),
+                       concat=True, freqtol=2e6)
+  contspws=chansel.parse(','.join(str(s) for s in contsel.spws), nchan=nchanspw)
+  # the step-13 cube: every spw of mvis (not only those with line-free channels)
+  cubesel=chansel.parse(spwsel or ','.join(str(s) for s in sorted(set(o for m in cost.spwmaps for o in m.values()))),
+                        nchan=nchanspw)
+  cubenchan=4040 if spwsel=='' else cubesel.nchan()
+  cubechunknchan=nchanspw if cubechunk=='spw' else (int(cubechunk) if cubechunk else None)
+  contround=lambda nterms, niter, save=None: cost.applycal(contsel, contavgnchan) + \
+      cost.tclean(contsel, contavgnchan, imsz, nterms=nterms, niter=niter, savemodel=save)
+  plan=costmodel.Plan({0: cost.copy(),
+                       2: cost.copy(contsel, contavgnchan, insel=contspws),
+                       3: cost.tclean(contsel, contavgnchan, imsz, niter=150, savemodel=savemodel),
+                       4: cost.gaincal(contsel, contavgnchan, nsolve=max(1, len(previewsolints))),
+                       5: (cost.gaincal(contsel, contavgnchan) + contround(2, 300, savemodel))*5 if autoselfcal
+                          else cost.gaincal(contsel, contavgnchan),
+                       6: contround(1, 200, savemodel),
+                       7: cost.gaincal(contsel, contavgnchan),
+                       8: contround(2, 300, savemodel),
+                       9: cost.gaincal(contsel, contavgnchan),
+                       10: contround(2, 300),
+                       12: cost.applycal() + cost.copy(cubesel),
+                       13: cost.tclean(cubesel, None, imsz, nchan=cubenchan, niter=50000, cycleniter=200,
+                                       nworkers=cubeworkers if cubechunknchan else 1, chunk=cubechunknchan),
+                       14: cost.images(imsz, cubenchan),
+                       15: cost.tclean(contsel, contavgnchan, imsz, niter=150)*max(1, len(masksweep.grid(sweepgrid)))
+                           if sweepgrid else None},
+                      mvis+'_trace', memgb=cubememgb, diskgb=costmodel.freedisk('.'))
+runner=steprunner.StepRunner(mvis+'_steps.json', force=forcesteps, tracer=tracer, ledger=ledger,
+                             dryrun=dryrun, plan=plan)
+
 ##########
 
 # # concatenate
 # mystep = 0
-# if(mystep in thesteps):
+# if(mystep in thesteps and
+#    runner.start(mystep, inputs=msin, exists=[mvis], outputs=[mvis+'.listobs'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print( 'Step ', mystep, step_title[mystep])
 #
 #   os.system('rm -rf '+mvis)
-#   concat(vis=msin,
-#          concatvis=mvis,
-#          freqtol='2MHz',
-#          dirtol='1arcsec',
-#          copypointing=False)
+#   if mmsparts:
+#     mmspart.make(msin, mvis, nparts=mmsparts,
+#                  freqtol='2MHz',
+#                  dirtol='1arcsec')
+#   else:
+#     concat(vis=msin,
+#            concatvis=mvis,
+#            freqtol='2MHz',
+#            dirtol='1arcsec',
+#            copypointing=False)
 #
 #
 #   listobs(vis=mvis,
 #           verbose=True,
 #           overwrite=True,
 #           listfile=mvis+'.listobs')
+#   runner.finish(mystep)
 #
 # # Print useful information
 # mystep = 1
-# if(mystep in thesteps):
+# if(mystep in thesteps and runner.start(mystep, always=True)):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print( 'Step ', mystep, step_title[mystep])
 #
@@ -212,12 +383,9 @@ if (thesteps==[]):
 #   print( 'Predicted line rms  %5.3f mJy' %(predicted_rms_line))
 #   print( 'This will be set as "linethresh" for cube cleaning and automasking, tweak as needed.\n')
 #
-#   statfile.write('concatenated MS '+mvis+'\n')
-#   statfile.write( 'Total line-free continuum %5.2f GHz\n' %(contGHz))
-#   statfile.write( '\nTime on source (avg. per tuning)  %5.1f min\n' %(ToS))
-#   statfile.write( str(Nants)+'  antennas present (not necessarily in all spw).\n')
-#   statfile.write( 'Predicted continuum rms  %5.3f mJy\n' %(predicted_rms_cont))
-#   statfile.write( 'Predicted line rms  %5.3f mJy\n' %(predicted_rms_line))
+#   ledger.record(mystep, mvis, kind='prediction', predicted=predicted_rms_cont/1000.,
+#                 contGHz=contGHz, ToS=ToS, Nants=Nants, predicted_line_mjy=predicted_rms_line)
+#   runner.finish(mystep)
 #
 # # # Plot to check continuum selection
 # # mystep = 2
@@ -227,7 +395,7 @@ if (thesteps==[]):
 # #
 # #   chs=''
 # #   if len(contchans) > 0:
-# #       chs=contchans
+# #       chs=contsel.casa
 # #
 # #   plotms(vis=mvis,
 # #          xaxis='channel', yaxis='amp',
@@ -238,64 +406,99 @@ if (thesteps==[]):
 # #          coloraxis='observation',#showtsky=True,
 # #          iteraxis='spw')
 #
+# # Average the line-free channels of each spw to contavgnchan channels, once.
+# # Self-cal (steps 3-10) solves and images on this, step 12 transfers the solutions to mvis.
+# mystep = 2
+# if(mystep in thesteps and
+#    runner.start(mystep, deps=[0], params=dict(spw=contsel.casa, nchan=contavgnchan),
+#                 exists=[cvis])):
+#   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
+#   print( 'Step ', mystep, step_title[mystep])
+#
+#   chanbin=[int(np.ceil(contsel.nchan(s)/float(contavgnchan))) for s in contsel.spws]
+#   os.system('rm -rf '+cvis+'*')
+#   mstransform(vis=mvis,
+#               outputvis=cvis,
+#               datacolumn='data',
+#               spw=contsel.casa,
+#               reindex=False,          # keep spw ids so caltables apply to mvis
+#               chanaverage=True,
+#               chanbin=chanbin)        # averaging uses and sums the weights
+#
+#   listobs(vis=cvis,
+#           overwrite=True,
+#           listfile=cvis+'.listobs')
+#   runner.finish(mystep)
 #
 # # first image continuum
 # mystep = 3
-# if(mystep in thesteps):
+# if(mystep in thesteps and
+#    runner.start(mystep, deps=[2], params=dict(contimpars, niter=150),
+#                 outputs=[mvis+'_cont.clean.image'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print( 'Step ', mystep, step_title[mystep])
 #
 #   print('Stop cleaning when residual is all noise, maybe higher than threshold\n')
 #
-#   clearcal(vis=mvis,
-#            addmodel=True)                             # **
-#
-#   os.system('rm -rf '+mvis+'_cont.clean*')
-#   tclean(vis=mvis,
-#          imagename=mvis+'_cont.clean',
-#          spw=contchans,
-#          imsize=imsz,
-#          cell=cell,
-#          weighting = 'briggs',
-#          robust=0.5,
-#          interactive=False,
-#          perchanweightdensity=False,
-#          threshold=thresh,
-#          niter=150,
-#          savemodel='modelcolumn',
-#          parallel=True,
-#          usemask=masktype,
-#          sidelobethreshold=2.5,
-#          noisethreshold=nthresh,
-#          minbeamfrac=mbf,
-#          lownoisethreshold=1.2,
-#          growiterations=75)
+#   clearcal(vis=cvis,
+#            addmodel=(modelmode=='column'))            # **
+#   if modelmode=='virtual':
+#       delmod(vis=cvis, otf=True, scr=True)   # drop any MODEL_DATA column, gaincal would use it
+#
+#   cleanjournal.tclean(vis=cvis,        # resumes an interrupted run of the same image
+#                       imagename=mvis+'_cont.clean',
+#                       task=psfcache.tclean,   # reusing the PSF of an earlier round
+#                       segment=cleansegment,
+#                       spw='',      # all of cvis is line-free
+#                       imsize=imsz,
+#                       cell=cell,
+#                       weighting = 'briggs',
+#                       robust=0.5,
+#                       interactive=False,
+#                       perchanweightdensity=False,
+#                       threshold=thresh,
+#                       niter=150,
+#                       savemodel=savemodel,
+#                       parallel=True,
+#                       usemask=masktype,
+#                       sidelobethreshold=2.5,
+#                       noisethreshold=nthresh,
+#                       minbeamfrac=mbf,
+#                       lownoisethreshold=1.2,
+#                       growiterations=75)
 #
 #   print('Check in logger or by plotting that the model is saved.\n\n')
+#   runner.finish(mystep)
 
 # # Stats and prediction
 # mystep = 4
-# if(mystep in thesteps):
+# if(mystep in thesteps and runner.start(mystep, always=True)):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print( 'Step ', mystep, step_title[mystep])
 #
-#   rms=imstat(imagename=mvis+'_cont.clean.image',
-#              box='10,10,'+str(imsz-10)+','+str(0.2*imsz))['rms'][0]
-#   peak=imstat(imagename=mvis+'_cont.clean.image',
-#               box=str(0.25*imsz)+','+str(0.25*imsz)+','+str(0.75*imsz)+','+str(0.75*imsz))['max'][0]
+#   imst=imstats.stats(mvis+'_cont.clean.image', statboxes)      # one read for both boxes
+#   rms=imst['noise']['rms']
+#   peak=imst['peak']['max']
 #   print( mvis+'_cont.clean.image')
 #   print( 'Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy' %(predicted_rms_cont, rms*1000.))
 #   print( 'Continuum peak  %5.3f mJy; S/N %5i' %(peak*1000., peak/rms))
 #   print( 'You might want to reduce threshold if the rms is lower.')
 #
-#   statfile.write('\n'+mvis+'_cont.clean.image\n')
-#   statfile.write('Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy\n' %(predicted_rms_cont, rms*1000.))
-#   statfile.write('Continuum peak  %5.3f mJy; S/N %5i\n' %(peak*1000., peak/rms))
-#
-#   N=float(Nants)
-#   minsol=60.*(3.*predicted_rms_cont/(peak*1000.))**2 *ToS*(N*(N-1)/(2*(N-3)))*Ncorr*float(Nspw)
+#   minsolspw=sensitivity.minsolint(sens, peak*1000.)
+#   minsol=np.median(minsolspw)
 #   print( 'Minimum solint for S/N 3 per antenna, per spw, per polarization %5.1f sec' %(minsol) )
-#   statfile.write( 'Minimum solint for S/N 3 per antenna, per spw, per polarization %5.1f sec\n' %(minsol) )
+#   print( '(%5.1f sec for spw %i, which has the least continuum)' %(minsolspw.max(), sens['spw'][np.argmax(minsolspw)]) )
+#
+#   if previewsolints:             # phase-only solutions against the step 3 model, in seconds
+#       lines=['Quick-look phase solutions (gaintype T, refant '+antrefs+')']
+#       print(lines[0])
+#       def both(line):
+#           print(line)
+#           lines.append(line)
+#       model=modelpred.read(mvis+'_cont.clean') if modelmode=='virtual' else None
+#       gainsolve.compare(gainsolve.load(cvis, target, model=model), previewsolints, refant=antrefs,
+#                         calmode='p', gaintype='T', log=both)
+#       ledger.note(mystep, '\n'.join(lines))
 #
 #   print( 'Note these values (also and enter solintp0, solintp1, solinta1 values in variables at start\n')
 #   print( 'If min. solint is very short, start with a longer solint e.g. 60s, to refine model first\n')
@@ -307,6 +510,7 @@ if (thesteps==[]):
 #       fitcenRA=fitcenRA+2.*np.pi
 #   fitcenDec=fit['direction']['m1']['value']
 #   fitcen='ICRS '+str(fitcenRA)+'rad  '+str(fitcenDec)+'rad'
+#   aU=msmeta.analysisutils(aUpath)
 #   fitcenradec=aU.rad2radec(fitcenRA, fitcenDec)
 #   imcen=aU.rad2radec(imhead(image1,mode='get',hdkey='crval1')['value'], imhead(image1,mode='get',hdkey='crval2')['value'])
 # #  fitcendegra= aU.rad2deg(fit['direction']['m0']['value'])
@@ -316,34 +520,39 @@ if (thesteps==[]):
 # # raoff=3600000.*degrees(fitcenRA-imhead(image1,mode='get',hdkey='crval1')['value'])*cos((fitcenDec+imhead(image1,mode='get',hdkey='crval2')['value'])/2)
 # #  decoff=3600000.*degrees(fitcenDec-imhead(image1,mode='get',hdkey='crval2')['value'])
 #
-#   statfile.write( '\npeakpos = "'+fitcen+'"\n')
-#   statfile.write( '='+imcen+'\n')
-# #  statfile.write( 'Peak position - pointing centre = (%4.1f, %4.1f) mas' % (raoff, decoff))
+#   ledger.record(mystep, image1, rms=rms, peak=peak, predicted=predicted_rms_cont/1000.,
+#                 minsol=minsol, peakpos=fitcen, peakradec=fitcenradec, imcen=imcen,
+#                 minsolmax=minsolspw.max())
 #
 #   print( 'peakpos = "'+fitcen+'"' )
 #   print( '='+imcen+'\n')
 # #  print( 'Peak position - pointing centre = (%4.1f, %4.1f) mas' % (raoff, decoff))
+#   runner.finish(mystep)
 #
 #
 # # first phase self-cal
 # mystep = 5
-# if(mystep in thesteps):
+# if(mystep in thesteps and not autoselfcal and
+#    runner.start(mystep, deps=[3], params=dict(spw=contsel.casa, solint=solintp0, refant=antrefs),
+#                 outputs=[mvis+'.p0'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print('Step ', mystep, step_title[mystep])
 #
-# #  ft(vis=mvis,
+# #  ft(vis=cvis,
 # #    model=target+'_'+config+'_cont.clean.model',
 # #    usescratch=True)
 #
 #   os.system('rm -rf '+mvis+'.p0')
-#   gaincal(vis=mvis,
+#   gaincal(vis=cvis,
 #           field=target,
 #           caltable=mvis+'.p0',
-#           spw=contchans,
+#           spw='',      # all of cvis is line-free
 #           solint=solintp0,
 #           refant=antrefs,
 #           refantmode='flex',
 #           calmode='p')
+#   calflags.review(mvis+'.p0')   # outliers and flag commands, instead of paging through plotms
+#   runner.finish(mystep)
 #
 #   # plotms(vis=mvis+'.p0',
 #   #        xaxis='time',yaxis='phase',
@@ -352,80 +561,120 @@ if (thesteps==[]):
 #   #        gridrows=5,gridcols=2,
 #   #        iteraxis='antenna')
 #
+# # or automatic self-cal, in place of steps 5-10
+# mystep = 5
+# if(mystep in thesteps and autoselfcal and
+#    runner.start(mystep, deps=[3], params=dict(contimpars, refant=antrefs, gain=autocalgain,
+#                                               amp=autocalamp, solinta1=solinta1, flags=badsols),
+#                 outputs=[mvis+'_autocal.json'])):
+#   casalog.post('Step '+str(mystep)+' '+step_title[mystep]+' (automatic)','INFO')
+#   print('Step ', mystep, step_title[mystep], '(automatic)')
+#
+#   calflags.flag(cvis, badsols)      # 'auto' needs solutions: nothing to flag yet
+#   if not checkpoint.existing(cvis+'_prefinalapplycalwt'):     # only the columns applycal changes
+#       checkpoint.snapshot(cvis, cvis+'_prefinalapplycalwt')
+#
+#   imst=imstats.stats(mvis+'_cont.clean.image', statboxes)
+#   rms=imst['noise']['rms']
+#   peak=imst['peak']['max']
+#   minsol=np.median(sensitivity.minsolint(sens, peak*1000.))
+#   selfcaltables=autocal.run(cvis, mvis, peak, rms, minsol,
+#                             gaincalpars=dict(field=target, refant=antrefs, refantmode='flex'),
+#                             tcleanpars=dict(spw='', imsize=imsz, cell=cell,
+#                                             deconvolver='mtmfs', nterms=2,
+#                                             weighting = 'briggs', robust=0.5,
+#                                             interactive=False, perchanweightdensity=False,
+#                                             threshold=thresh, niter=300, parallel=True,
+#                                             savemodel=savemodel,
+#                                             usemask=masktype, sidelobethreshold=2.5,
+#                                             noisethreshold=nthresh, minbeamfrac=mbf,
+#                                             lownoisethreshold=1.2, growiterations=75),
+#                             boxes=statboxes,
+#                             mingain=autocalgain,
+#                             amp=autocalamp,
+#                             ampsolint=solinta1)
+#   print('Accepted '+', '.join(selfcaltables))
+#   for h in autocal.history(mvis)[1:]:
+#       ledger.record(mystep, mvis+'_cont'+h['round']+'.clean', rms=h['rms'], peak=h['peak'],
+#                     predicted=predicted_rms_cont/1000., params=dict(solint=h['solint']),
+#                     accepted=mvis+'.'+h['round'] in selfcaltables)
+#   runner.finish(mystep)
+#
 # # applycal and re-image
 # mystep = 6
-# if(mystep in thesteps):
+# if(mystep in thesteps and not autoselfcal and
+#    runner.start(mystep, deps=[5], params=dict(contimpars, niter=200, flags=badsols),
+#                 outputs=[mvis+'_contp0.clean.image'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print('Step ', mystep, step_title[mystep])
 #
 # # flag data seen to have bad solutions
-#   flagdata(vis=mvis,
-#            mode='manual',
-#            antenna='DA50',
-#            scan='48',
-#            spw='17,19,21,23')
+#   calflags.flag(cvis, badsols, mvis+'.p0')
 #
 # # Do not flag nor weight, to avoid a imperfect model biasing results
-#   applycal(vis=mvis,
-#            gaintable=mvis+'.p0',
-#            applymode='calonly',
-#            calwt=False,
-#            flagbackup=False)
-#
-#   os.system('rm -rf '+mvis+'_contp0.clean*')
-#   tclean(vis=mvis,
-#          imagename=mvis+'_contp0.clean',
-#          spw=contchans,
-#          imsize=imsz,
-#          cell=cell,
-#          weighting = 'briggs',
-#          robust=0.5,
-#          interactive=False,
-#          perchanweightdensity=False,
-#          threshold=thresh,
-#          niter=200,
-#          savemodel='modelcolumn',
-#          parallel=True,
-#          usemask=masktype,
-#          sidelobethreshold=2.5,
-#          noisethreshold=nthresh,
-#          minbeamfrac=mbf,
-#          lownoisethreshold=1.2,
-#          growiterations=75)
-#
-#
-#   rms=imstat(imagename=mvis+'_contp0.clean.image',
-#              box='10,10,'+str(imsz-10)+','+str(0.2*imsz))['rms'][0]
-#   peak=imstat(imagename=mvis+'_contp0.clean.image',
-#               box=str(0.25*imsz)+','+str(0.25*imsz)+','+str(0.75*imsz)+','+str(0.75*imsz))['max'][0]
+#   incrapply.applycal(vis=cvis,
+#                      gaintable=mvis+'.p0',
+#                      applymode='calonly',
+#                      calwt=False,
+#                      flagbackup=False)
+#
+#   cleanjournal.tclean(vis=cvis,        # resumes an interrupted run of the same image
+#                       imagename=mvis+'_contp0.clean',
+#                       task=psfcache.tclean,   # reusing the PSF of an earlier round
+#                       segment=cleansegment,
+#                       spw='',      # all of cvis is line-free
+#                       imsize=imsz,
+#                       cell=cell,
+#                       weighting = 'briggs',
+#                       robust=0.5,
+#                       interactive=False,
+#                       perchanweightdensity=False,
+#                       threshold=thresh,
+#                       niter=200,
+#                       savemodel=savemodel,
+#                       parallel=True,
+#                       usemask=masktype,
+#                       sidelobethreshold=2.5,
+#                       noisethreshold=nthresh,
+#                       minbeamfrac=mbf,
+#                       lownoisethreshold=1.2,
+#                       growiterations=75)
+#
+#
+#   imst=imstats.stats(mvis+'_contp0.clean.image', statboxes)      # one read for both boxes
+#   rms=imst['noise']['rms']
+#   peak=imst['peak']['max']
 #
 #   print(mvis+'_contp0.clean.image\n')
 #   print( 'Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy' %(predicted_rms_cont, rms*1000.))
 #   print( 'Continuum peak  %5.3f mJy; S/N %5i' %(peak*1000., peak/rms))
 #   print( 'You might want to reduce threshold if the rms is lower.')
 #
-#   statfile.write('\n'+mvis+'_contp0.clean.image\n')
-#   statfile.write('Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy\n' %(predicted_rms_cont, rms*1000.))
-#   statfile.write('Continuum peak  %5.3f mJy; S/N %5i\n' %(peak*1000., peak/rms))
+#   ledger.record(mystep, mvis+'_contp0.clean.image', rms=rms, peak=peak, predicted=predicted_rms_cont/1000.)
+#   runner.finish(mystep)
 #
 # ######################################
 # # second phase self-cal
 # mystep = 7
-# if(mystep in thesteps):
+# if(mystep in thesteps and not autoselfcal and
+#    runner.start(mystep, deps=[6], params=dict(spw=contsel.casa, solint=solintp1, refant=antrefs),
+#                 outputs=[mvis+'.p1'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print('Step ', mystep, step_title[mystep])
 #
 #   os.system('rm -rf '+mvis+'.p1')
-#   gaincal(vis=mvis,
+#   gaincal(vis=cvis,
 #           field=target,
 #           caltable=mvis+'.p1',
 #           gaintable=mvis+'.p0',
 #           gaintype='T',    # average polarisations to allow shorter solint
-#           spw=contchans,
+#           spw='',      # all of cvis is line-free
 #           solint=solintp1,
 #           refant=antrefs,
 #           refantmode='flex',
 #           calmode='p')
+#   calflags.review(mvis+'.p1')   # outliers and flag commands, instead of paging through plotms
+#   runner.finish(mystep)
 #
 #   # plotms(vis=mvis+'.p1',
 #   #        xaxis='time',yaxis='phase',
@@ -436,69 +685,74 @@ if (thesteps==[]):
 #
 # # applycal and re-image
 # mystep = 8
-# if(mystep in thesteps):
+# if(mystep in thesteps and not autoselfcal and
+#    runner.start(mystep, deps=[7], params=dict(contimpars, niter=300),
+#                 outputs=[mvis+'_contp1.clean.image.tt0'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print('Step ', mystep, step_title[mystep])
 #
 # # Do not flag nor weight, to avoid a imperfect model biasing results
-#   applycal(vis=mvis,
-#            gaintable=[mvis+'.p0',mvis+'.p1'],
-#            applymode='calonly',
-#            calwt=False,
-#            flagbackup=False)
-#
-#   os.system('rm -rf '+mvis+'_contp1.clean*')
-#   tclean(vis=mvis,
-#          imagename=mvis+'_contp1.clean',
-#          spw=contchans,
-#          imsize=imsz,
-#          cell=cell,
-#          deconvolver='mtmfs', nterms=2,
-#          weighting = 'briggs',
-#          robust=0.5,
-#          interactive=False,
-#          perchanweightdensity=False,
-#          threshold=thresh,
-#          niter=300,
-#          savemodel='modelcolumn',
-#          parallel=True,
-#          usemask=masktype,
-#          sidelobethreshold=2.5,
-#          noisethreshold=nthresh,
-#          minbeamfrac=mbf,
-#          lownoisethreshold=1.2,
-#          growiterations=75)
-#
-#   rms=imstat(imagename=mvis+'_contp1.clean.image.tt0',
-#              box='10,10,'+str(imsz-10)+','+str(0.2*imsz))['rms'][0]
-#   peak=imstat(imagename=mvis+'_contp1.clean.image.tt0',
-#               box=str(0.25*imsz)+','+str(0.25*imsz)+','+str(0.75*imsz)+','+str(0.75*imsz))['max'][0]
+#   incrapply.applycal(vis=cvis,
+#                      gaintable=[mvis+'.p0',mvis+'.p1'],
+#                      applymode='calonly',
+#                      calwt=False,
+#                      flagbackup=False)
+#
+#   cleanjournal.tclean(vis=cvis,        # resumes an interrupted run of the same image
+#                       imagename=mvis+'_contp1.clean',
+#                       task=psfcache.tclean,   # reusing the PSF of an earlier round
+#                       segment=cleansegment,
+#                       spw='',      # all of cvis is line-free
+#                       imsize=imsz,
+#                       cell=cell,
+#                       deconvolver='mtmfs', nterms=2,
+#                       weighting = 'briggs',
+#                       robust=0.5,
+#                       interactive=False,
+#                       perchanweightdensity=False,
+#                       threshold=thresh,
+#                       niter=300,
+#                       savemodel=savemodel,
+#                       parallel=True,
+#                       usemask=masktype,
+#                       sidelobethreshold=2.5,
+#                       noisethreshold=nthresh,
+#                       minbeamfrac=mbf,
+#                       lownoisethreshold=1.2,
+#                       growiterations=75)
+#
+#   imst=imstats.stats(mvis+'_contp1.clean.image.tt0', statboxes)      # one read for both boxes
+#   rms=imst['noise']['rms']
+#   peak=imst['peak']['max']
 #
 #   print(mvis+'_contp1.clean.image.tt0\n')
 #   print( 'Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy' %(predicted_rms_cont, rms*1000.))
 #   print( 'Continuum peak  %5.3f mJy; S/N %5i' %(peak*1000., peak/rms))
 #
-#   statfile.write('\n'+mvis+'_contp1.clean.image.tt0\n')
-#   statfile.write('Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy\n' %(predicted_rms_cont, rms*1000.))
-#   statfile.write('Continuum peak  %5.3f mJy; S/N %5i\n' %(peak*1000., peak/rms))
+#   ledger.record(mystep, mvis+'_contp1.clean.image.tt0', rms=rms, peak=peak, predicted=predicted_rms_cont/1000.)
+#   runner.finish(mystep)
 #
 # ######################
 # # amp self-cal
 # mystep = 9
-# if(mystep in thesteps):
+# if(mystep in thesteps and not autoselfcal and
+#    runner.start(mystep, deps=[8], params=dict(spw=contsel.casa, solint=solinta1, refant=antrefs),
+#                 outputs=[mvis+'.a1'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print('Step ', mystep, step_title[mystep])
 #
 #   os.system('rm -rf '+mvis+'.a1')
-#   gaincal(vis=mvis,
+#   gaincal(vis=cvis,
 #           field=target,
 #           caltable=mvis+'.a1',
 #           gaintable=[mvis+'.p0',mvis+'.p1'],
-#           spw=contchans,
+#           spw='',      # all of cvis is line-free
 #           solint=solinta1,
 #           refant=antrefs,
 #           refantmode='flex',
 #           calmode='a')
+#   calflags.review(mvis+'.a1')   # outliers and flag commands, instead of paging through plotms
+#   runner.finish(mystep)
 #
 #   # plotms(vis=mvis+'.a1',
 #   #        xaxis='time',yaxis='amp',
@@ -509,50 +763,51 @@ if (thesteps==[]):
 #
 # # applycal and re-image
 # mystep = 10
-# if(mystep in thesteps):
+# if(mystep in thesteps and not autoselfcal and
+#    runner.start(mystep, deps=[9], params=dict(contimpars, niter=300),
+#                 outputs=[mvis+'_contpa1.clean.image.tt0'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print('Step ', mystep, step_title[mystep])
 #
-#   if not os.path.exists(mvis+'_prefinalapplycalwt'):
-#       os.system('cp -r '+mvis+' '+mvis+'_prefinalapplycalwt')
-#   applycal(vis=mvis,
-#            gaintable=[mvis+'.p0',mvis+'.p1',mvis+'.a1'],
-#            applymode='calonly')  # see notes at start
-# #           calwt=False,          # see notes at start
-# #           flagbackup=False)
-#
-#   os.system('rm -rf '+mvis+'_contpa1.clean*')
-#   tclean(vis=mvis,
-#          imagename=mvis+'_contpa1.clean',
-#          spw=contchans,
-#          imsize=imsz,
-#          cell=cell,
-#          deconvolver='mtmfs', nterms=2,
-#          weighting = 'briggs',
-#          robust=0.5,
-#          interactive=False,
-#          threshold=thresh,
-#          niter=300,
-#          parallel=True,
-#          usemask=masktype,
-#          sidelobethreshold=2.5,
-#          noisethreshold=nthresh,
-#          minbeamfrac=mbf,
-#          lownoisethreshold=1.2,
-#          growiterations=75)
-#
-#   rms=imstat(imagename=mvis+'_contpa1.clean.image.tt0',
-#              box='10,10,'+str(imsz-10)+','+str(0.2*imsz))['rms'][0]
-#   peak=imstat(imagename=mvis+'_contpa1.clean.image.tt0',
-#               box=str(0.25*imsz)+','+str(0.25*imsz)+','+str(0.75*imsz)+','+str(0.75*imsz))['max'][0]
+#   if not checkpoint.existing(cvis+'_prefinalapplycalwt'):     # only the columns applycal changes
+#       checkpoint.snapshot(cvis, cvis+'_prefinalapplycalwt')
+#   incrapply.applycal(vis=cvis,
+#                      gaintable=[mvis+'.p0',mvis+'.p1',mvis+'.a1'],
+#                      applymode='calonly')  # see notes at start
+# #                     calwt=False,          # see notes at start
+# #                     flagbackup=False)
+#
+#   cleanjournal.tclean(vis=cvis,        # resumes an interrupted run of the same image
+#                       imagename=mvis+'_contpa1.clean',
+#                       task=psfcache.tclean,   # reusing the PSF of an earlier round
+#                       segment=cleansegment,
+#                       spw='',      # all of cvis is line-free
+#                       imsize=imsz,
+#                       cell=cell,
+#                       deconvolver='mtmfs', nterms=2,
+#                       weighting = 'briggs',
+#                       robust=0.5,
+#                       interactive=False,
+#                       threshold=thresh,
+#                       niter=300,
+#                       parallel=True,
+#                       usemask=masktype,
+#                       sidelobethreshold=2.5,
+#                       noisethreshold=nthresh,
+#                       minbeamfrac=mbf,
+#                       lownoisethreshold=1.2,
+#                       growiterations=75)
+#
+#   imst=imstats.stats(mvis+'_contpa1.clean.image.tt0', statboxes)      # one read for both boxes
+#   rms=imst['noise']['rms']
+#   peak=imst['peak']['max']
 #
 #   print(mvis+'_contpa1.clean.image.tt0\n')
 #   print( 'Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy' %(predicted_rms_cont, rms*1000.))
 #   print( 'Continuum peak  %5.3f mJy; S/N %5i' %(peak*1000., peak/rms))
 #
-#   statfile.write('\n'+mvis+'_contpa1.clean.image.tt0\n')
-#   statfile.write('Predicted continuum rms  %5.3f mJy; achieved %5.3f mJy\n' %(predicted_rms_cont, rms*1000.))
-#   statfile.write('Continuum peak  %5.3f mJy; S/N %5i\n' %(peak*1000., peak/rms))
+#   ledger.record(mystep, mvis+'_contpa1.clean.image.tt0', rms=rms, peak=peak, predicted=predicted_rms_cont/1000.)
+#   runner.finish(mystep)
 #
 # # # Check continuum selection,  no spw entirely flagged, corrected continuum slope more regular
 # # mystep = 11
@@ -562,7 +817,7 @@ if (thesteps==[]):
 # #
 # #   chs=''
 # #   if len(contchans) > 0:
-# #       chs=contchans
+# #       chs=contsel.casa
 # #
 # #   plotms(vis=mvis,
 # #          xaxis='freq', yaxis='amp',
@@ -575,18 +830,40 @@ if (thesteps==[]):
 #
 # # uvcontsub
 # mystep = 12
-# if(mystep in thesteps):
+# if(mystep in thesteps and
+#    runner.start(mystep, deps=[5, 10], params=dict(fitspw=contsel.casa, fitorder=1, flags=badsols,
+#                                                   mode=contsubmode),
+#                 outputs=[mvis+'.contsub'])):
 #   casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
 #   print('Step ', mystep, step_title[mystep])
 #
+#   # transfer the self-cal solutions from the continuum MS to the full-resolution MS
+#   if selfcaltables:
+#       calflags.flag(mvis, badsols, selfcaltables[0])
+#       if not checkpoint.existing(mvis+'_prefinalapplycalwt'):     # only the columns applycal changes
+#           checkpoint.snapshot(mvis, mvis+'_prefinalapplycalwt')
+#       incrapply.applycal(vis=mvis,
+#                          gaintable=selfcaltables,
+#                          applymode='calonly')  # as step 10
+#   else:
+#       print('No self-cal round was accepted, the line data are not self-calibrated')
+#       clearcal(vis=mvis)      # corrected = data, for the continuum subtraction
+#
 #   os.system('rm -rf '+mvis+'.contsub')
 #   os.system('rm -rf '+mvis+'.contsub.flagversions')
-#   mstransform(vis= mvis,
-#             douvcontsub=True,
-#             reindex=False,    #*** CHECK WORKS should keep original spw numbering
-#             outputvis=mvis+'.contsub',
-#             fitspw=contchans,
-#             fitorder=1)
+#   if contsubmode=='numpy':
+#       fitdiag=uvcontsub.run(mvis, mvis+'.contsub', contsel, fitorder=1)
+#       for s in sorted(fitdiag):
+#           print( 'spw %3i line-free fit residual rms %6.3f mJy, %i rows refitted for flags'
+#                  %(s, fitdiag[s]['rms']*1000., fitdiag[s]['refit']))
+#   else:
+#       mstransform(vis= mvis,
+#                 douvcontsub=True,
+#                 reindex=False,    #*** CHECK WORKS should keep original spw numbering
+#                 outputvis=mvis+'.contsub',
+#                 fitspw=contsel.casa,
+#                 fitorder=1)
+#   runner.finish(mystep)
 
   # plotms(vis=mvis+'.contsub',
   #        xaxis='freq',
@@ -597,26 +874,9 @@ if (thesteps==[]):
   #        avgbaseline=True,
   #        coloraxis='spw')
 
-# image cubes
-# might need to experiment with automasking and threshold...
-mystep = 13
-if(mystep in thesteps):
-  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
-  print('Step ', mystep, step_title[mystep])
-
-  st=0
-  nch=-1
-  if spwsel=='' or spwsel=='17':
-      st=5
-  if spwsel=='':
-      nch=4040
-
-  os.system('rm -rf '+mvis+'_spw'+spwsel+'.clean*')
-  tclean(vis=mvis+'.contsub',
-         imagename=mvis+'_spw'+spwsel+'.clean',
-         spw=spwsel,      # NB if blank=all, set start & nchan as per preamble to avoid bad/blank end chans
-         start=st, nchan=nch,
-         specmode='cube',
+# cube imaging parameters (steps 13 and 15)
+if 'linethresh' in locals():
+  cubepars=dict(specmode='cube',
          outframe='lsrk',
          perchanweightdensity=False,
          imsize=imsz,
@@ -635,9 +895,125 @@ if(mystep in thesteps):
          lownoisethreshold=1.2,     # increase for much bright emission
          growiterations=75,         # for speed
          threshold=linethresh,
-         niter=50000,
-         parallel=True)               # increase if needed
+         niter=50000)               # increase if needed
+
+# image cubes
+# might need to experiment with automasking and threshold...
+mystep = 13
+if(mystep in thesteps and
+   runner.start(mystep, deps=[12],
+                params=dict(spwsel=spwsel, imsz=imsz, cell=cell, mask=thismask, masktype=masktype,
+                            nthresh=nthresh, mbf=mbf, linethresh=linethresh, niter=50000,
+                            chunk=cubechunk),
+                outputs=[mvis+'_spw'+spwsel+'.clean.image'])):
+  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
+  print('Step ', mystep, step_title[mystep])
+
+  st=0
+  nch=-1
+  if spwsel=='' or spwsel=='17':
+      st=5
+  if spwsel=='':
+      nch=4040
+
+  if cubechunk=='' or interact:
+      # checkpointed every cleansegment major cycles, an interrupted run resumes
+      cleanjournal.tclean(vis=mvis+'.contsub',
+                          imagename=mvis+'_spw'+spwsel+'.clean',
+                          spw=spwsel,      # NB if blank=all, set start & nchan as per preamble to avoid bad/blank end chans
+                          start=st, nchan=nch,
+                          parallel=True,
+                          segment=0 if interact else cleansegment,
+                          stamp=msmeta.mtime(mvis+'.contsub'),
+                          **cubepars)
+  else:
+      # the single job's LSRK channel grid (spw, start, nchan) cut at spw boundaries or
+      # into blocks of cubechunk channels, each imaged with its start/width/nchan in Hz
+      # chunks that already imaged are kept, rerun the step to redo only failed chunks
+      failed=cubechunks.run(mvis+'.contsub',
+                            mvis+'_spw'+spwsel+'.clean',
+                            cubepars,
+                            spw=spwsel, start=st, nchan=nch,
+                            chunk=cubechunk,
+                            nworkers=cubeworkers,
+                            memgb=cubememgb,
+                            segment=cleansegment)
+      if failed:
+          raise RuntimeError('Cube chunks failed: '+' '.join(failed)+'; rerun step 13 to retry them')
+
+  # per-channel noise and peak, streamed through the cube
+  cubest=imstats.cubestats(mvis+'_spw'+spwsel+'.clean', statboxes)
+  print( 'Predicted line rms  %5.3f mJy; achieved median %5.3f mJy per channel' %(predicted_rms_line, 1000.*np.nanmedian(cubest['noise']['rms'])))
+  print( 'Line peak  %5.3f mJy in channel %i' %(1000.*np.nanmax(cubest['peak']['max']), np.nanargmax(cubest['peak']['max'])))
+  ledger.record(mystep, mvis+'_spw'+spwsel+'.clean', kind='cube',
+                rms=np.nanmedian(cubest['noise']['rms']), peak=np.nanmax(cubest['peak']['max']),
+                predicted=predicted_rms_line/1000., peakchan=int(np.nanargmax(cubest['peak']['max'])))
+
+  runner.finish(mystep)
+
+# moments, per-channel noise and aperture spectrum at the continuum peak, in one pass through the cube
+mystep = 14
+if(mystep in thesteps and
+   runner.start(mystep, deps=[13],
+                params=dict(peakpos=peakpos, radius=specradius, chans=momchans, clip=momclip, kind=momkind),
+                outputs=[mvis+'_spw'+spwsel+'.clean.mom0', mvis+'_spw'+spwsel+'.clean.spectrum.txt'])):
+  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
+  print('Step ', mystep, step_title[mystep])
+
+  if peakpos=='' and 'fitcen' in locals():
+      peakpos=fitcen
+  mom=moments.run(imstats.resolve(mvis+'_spw'+spwsel+'.clean', momkind),
+                  centre=peakpos,
+                  radius=specradius,
+                  noisebox=statboxes['noise'],
+                  chans=momchans,
+                  clip=momclip,
+                  nworkers=cubeworkers,
+                  outfile=mvis+'_spw'+spwsel+'.clean')
+  print( 'Wrote '+mvis+'_spw'+spwsel+'.clean.mom0, .mom1, .mom2, .peak, .peakvel and .spectrum.txt')
+  if peakpos:
+      print( 'Peak flux density %5.3f mJy in %s at %s' %(1000.*np.nanmax(mom['spectrum']), specradius, peakpos))
+      ledger.record(mystep, mvis+'_spw'+spwsel+'.clean.spectrum.txt', kind='spectrum',
+                    peak=np.nanmax(mom['spectrum']), peakpos=peakpos, radius=specradius)
+  runner.finish(mystep)
+
+# try combinations of automasking parameters at once and rank them, instead of one tclean at a time
+mystep = 15
+if(mystep in thesteps and sweepgrid and
+   runner.start(mystep, deps=[3] if sweepon=='cont' else [12],
+                params=dict(grid=sweepgrid, on=sweepon, thresh=thresh, linethresh=linethresh),
+                outputs=[mvis+'_'+sweepon.replace(':','_')+'_sweep.json'])):
+  casalog.post('Step '+str(mystep)+' '+step_title[mystep],'INFO')
+  print('Step ', mystep, step_title[mystep])
+
+  if sweepon=='cont':
+      sweepvis=cvis
+      sweeppars=dict(spw='', imsize=imsz, cell=cell, weighting='briggs', robust=0.5,
+                     perchanweightdensity=False, threshold=thresh, niter=150, usemask=masktype,
+                     sidelobethreshold=2.5, noisethreshold=nthresh, minbeamfrac=mbf,
+                     lownoisethreshold=1.2, growiterations=75)
+  else:
+      sweepvis=mvis+'.contsub'
+      sweeppars=dict(cubepars, spw=sweepon, restoringbeam='', pbcor=False)
+  ranked=masksweep.run(sweepvis, mvis+'_'+sweepon.replace(':','_'), sweeppars, sweepgrid, statboxes,
+                       nworkers=cubeworkers, memgb=cubememgb)
+  for r in ranked:
+      ledger.record(mystep, r['imagename'], kind='sweep', rms=r['rms'], peak=r['peak'],
+                    params=r['pars'], maskfrac=r['maskfrac'], runtime=r['time'])
+  if ranked:
+      print('Best: '+', '.join('%s=%s' %(k, v) for k, v in ranked[0]['pars'].items()))
+  runner.finish(mystep)
 
 
 
-statfile.close()
+if ledger is not None:
+    ledger.close()
+if dryrun:
+    if plan is not None:
+        rec=costmodel.recommend(cubenchan, imsz, cubememgb)
+        print(plan.report(['Cube: chunks of %s channels with %i workers (%.1f GB each) fit cubememgb=%g'
+                           %(rec['chunk'], rec['nworkers'], rec['memgb'], cubememgb)] if rec else
+                          ['Cube: no chunk fits cubememgb=%g' %(cubememgb)]))
+else:
+    tracer.save()
+    print(tracer.summary())
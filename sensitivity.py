@@ -0,0 +1,146 @@
+##############################################################
+# Sensitivity and solint prediction from MS metadata
+#
+# Per science spw: time on source (from the target scans and integration
+# times), line-free bandwidth (from contsel), channel width and antennas.
+# From these, as arrays over all spws at once:
+#   rms_spw   continuum rms of each spw's line-free channels (mJy)
+#   rms_cont  all spws combined;  rms_tuning  per tuning (spws sharing scans)
+#   rms_line  rms per channel in each spw (mJy)
+#   minsolint(sens, peak)  minimum solint (s) for S/N 3 per antenna/spw/pol
+# Metadata come from msmeta, cached per MS and modification time.
+#
+#   sens = sensitivity.predict(sensitivity.metadata(mvis, target), contsel)
+#   sensitivity.metadata(msin, target)     # before concat: spws numbered as concat will
+##############################################################
+
+import numpy as np
+
+import msmeta
+
+# mJy rms for 1 GHz, 1 min, Dec -17, mid-band (ALMA sensitivity calculator)
+RMS_1_1 = {6: 0.25, 7: 0.4}
+BANDS = {3: (84e9, 116e9), 4: (125e9, 163e9), 5: (163e9, 211e9), 6: (211e9, 275e9),
+         7: (275e9, 373e9), 8: (385e9, 500e9)}
+
+
+def band(freq):
+    """ALMA band number for a frequency in Hz."""
+    for b, (lo, hi) in BANDS.items():
+        if lo <= freq <= hi:
+            return b
+    raise ValueError('%.1f GHz is not in a known band' % (freq / 1e9))
+
+
+def metadata(vis, field, freqtol=2e6):
+    """Per-spw metadata for field in vis, as NumPy arrays (from msmeta's cache).
+
+    vis may be a list of MSs (msin before step 0): their spws are numbered as
+    concat numbers them (costmodel.concatspws) and merged spws add up.
+    """
+    if not isinstance(vis, str):
+        return _concat([_metadata(v, field) for v in vis],
+                       _spwmaps(vis, freqtol) if len(vis) > 1 else [None])
+    return _metadata(vis, field)
+
+
+def _spwmaps(vislist, freqtol):
+    import costmodel
+    return costmodel.concatspws([msmeta.get(v) for v in vislist], freqtol)
+
+
+def _concat(metas, spwmaps):
+    """Merge per-MS metadata by concat spw id: time on source adds up."""
+    out = {}
+    for meta, spwmap in zip(metas, spwmaps):
+        for i, s in enumerate(meta['spw']):
+            s = int(s) if spwmap is None else spwmap[int(s)]
+            m = {k: meta[k][i] for k in meta}
+            if s in out:
+                o = out[s]
+                o['tos'] += m['tos']
+                o['nants'] = max(o['nants'], m['nants'])
+                o['scans'] = tuple(sorted(set(o['scans']) | set(m['scans'])))
+            else:
+                out[s] = m
+    spws = sorted(out)
+    res = {k: np.asarray([out[s][k] for s in spws]) for k in metas[0] if k not in ('spw', 'scans')}
+    res['spw'] = np.asarray(spws)
+    res['scans'] = [out[s]['scans'] for s in spws]
+    return res
+
+
+def _metadata(vis, field):
+    meta = msmeta.get(vis)
+    fid = meta['fields'][field]['id']
+    nunflagged = len(meta['unflagged'])
+    out = {'spw': [], 'freq': [], 'chanwidth': [], 'nchan': [], 'tos': [],
+           'inttime': [], 'nants': [], 'scans': []}
+    for s in sorted(meta['spws'], key=int):
+        spw = meta['spws'][s]
+        if not spw['target'] or spw['nchan'] <= 4:          # skip WVR/channel-averaged
+            continue
+        scans = sorted((int(n), sc) for n, sc in meta['scans'].items()
+                       if fid in sc['fields'] and int(s) in sc['spws'])
+        if not scans:
+            continue
+        out['spw'].append(int(s))
+        out['freq'].append(spw['freq'])
+        out['chanwidth'].append(spw['chanwidth'])
+        out['nchan'].append(spw['nchan'])
+        out['tos'].append(sum(sc['nint'] * sc['inttime'] for n, sc in scans) / 60.)
+        out['inttime'].append(scans[0][1]['inttime'])
+        out['nants'].append(min(max(sc['nants'] for n, sc in scans), nunflagged))
+        out['scans'].append(tuple(n for n, sc in scans))
+    res = {k: np.asarray(v) for k, v in out.items() if k != 'scans'}
+    res['scans'] = out['scans']
+    return res
+
+
+def predict(meta, contsel, rms_1_1=None, ncorr=2):
+    """Predicted sensitivities for the line-free channels in contsel.
+
+    rms_1_1 (mJy for 1 GHz, 1 min) defaults to RMS_1_1 for the band.
+    Returns a dict of scalars and per-spw arrays.
+    """
+    if rms_1_1 is None:
+        rms_1_1 = RMS_1_1[band(np.median(meta['freq']))]
+    spw = meta['spw']
+    nfree = np.array([contsel.nchan(s) for s in spw])
+    bw = nfree * meta['chanwidth'] / 1e9                  # GHz
+    tos = meta['tos']
+    w = tos * bw
+    # tunings: spws observed in the same scans
+    tunings = sorted(set(meta['scans']))
+    tuning = np.array([tunings.index(sc) for sc in meta['scans']])
+    wt = np.bincount(tuning, weights=w, minlength=len(tunings))
+    with np.errstate(divide='ignore'):
+        rms_spw = rms_1_1 * w**-0.5
+        rms_tuning = rms_1_1 * wt**-0.5
+    rms_line_spw = rms_1_1 * (tos * meta['chanwidth'] / 1e9)**-0.5
+    return {'spw': spw,
+            'nspw': len(spw),
+            'nants': int(np.max(meta['nants'])),
+            'ncorr': ncorr,
+            'tos': tos,
+            'tos_mean': float(np.mean(np.bincount(tuning, weights=tos) / np.bincount(tuning))),
+            'contGHz': float(bw.sum()),
+            'bw': bw,
+            'rms_spw': rms_spw,
+            'rms_cont': float(rms_1_1 * w.sum()**-0.5),
+            'tuning': tuning,
+            'rms_tuning': rms_tuning,
+            'rms_line_spw': rms_line_spw,
+            'rms_line': float(np.median(rms_line_spw)),
+            'inttime': float(np.median(meta['inttime']))}
+
+
+def minsolint(sens, peak):
+    """Minimum solint (s) per spw for S/N 3 per antenna, per spw, per polarization.
+
+    peak in mJy.  With equal spws this is the step 4 formula
+    60 (3 rms_cont/peak)^2 ToS N(N-1)/(2(N-3)) Ncorr Nspw.
+    """
+    n = float(sens['nants'])
+    return (60. * (3. * sens['rms_spw'] / peak)**2 * sens['tos'] *
+            (n * (n - 1) / (2 * (n - 3))) * sens['ncorr'])
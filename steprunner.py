@@ -0,0 +1,141 @@
+##############################################################
+# Dependency-aware step runner
+#
+# Each step declares what it depends on:
+#   inputs  - files/directories it reads that no earlier step writes (e.g. msin)
+#   params  - the parameter values it uses (solint, thresh, niter, ...)
+#   deps    - earlier steps whose products it reads (e.g. the MS, models, caltables)
+#   outputs - products it creates (images, caltables, contsub MS)
+# These are hashed into a key, a dependency by its key and completion count,
+# so rerunning a step (forced, or for a deleted output) requeues the steps
+# after it.  A step is skipped when its key matches the one recorded the
+# last time it completed and its outputs are unchanged since then.
+# Steps that only modify an MS in place (applycal) declare no outputs; steps
+# downstream of them pick up the change through deps.
+#
+# The state is kept in a small JSON file next to the MS, e.g. mvis+'_steps.json'
+#
+# With dryrun=True no step runs: the ones that would are listed with their
+# estimated memory, disk and time from plan (a costmodel.Plan).
+##############################################################
+
+import hashlib
+import json
+import os
+
+
+def stamp(path):
+    """Cheap fingerprint of a file or directory tree (names, sizes, mtimes)."""
+    h = hashlib.sha1()
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        st = os.stat(path)
+        h.update(('%d %d' % (st.st_size, st.st_mtime_ns)).encode())
+        return h.hexdigest()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            fp = os.path.join(root, f)
+            st = os.stat(fp)
+            h.update(('%s %d %d\n' % (os.path.relpath(fp, path), st.st_size,
+                                       st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def completed(statefile, step):
+    """'<key> <run>' of the last completion of step recorded in statefile, or None."""
+    if not os.path.exists(statefile):
+        return None
+    with open(statefile) as f:
+        rec = json.load(f).get(str(step))
+    return None if rec is None else '%s %d' % (rec['key'], rec.get('run', 0))
+
+
+class StepRunner(object):
+    """Decide which steps need (re)running and record the ones that completed."""
+
+    def __init__(self, statefile, force=(), tracer=None, ledger=None, dryrun=False, plan=None):
+        self.statefile = statefile
+        self.force = set(force)
+        self.tracer = tracer
+        self.ledger = ledger
+        self.dryrun = dryrun
+        self.plan = plan
+        self.state = {}
+        if os.path.exists(statefile):
+            with open(statefile) as f:
+                self.state = json.load(f)
+        self._pending = {}
+
+    def key(self, inputs=(), params=None, deps=()):
+        h = hashlib.sha1()
+        h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        for p in inputs:
+            h.update(('%s %s\n' % (p, stamp(p))).encode())
+        for d in deps:
+            rec = self.state.get(str(d))
+            h.update(('step %s %s\n' % (d, rec['key'] if rec else None)).encode())
+            if rec and 'run' in rec:
+                # each completion counts, e.g. a forced rerun with the same key
+                h.update(('run %d\n' % rec['run']).encode())
+        return h.hexdigest()
+
+    def current(self, step, key, outputs, exists=()):
+        rec = self.state.get(str(step))
+        if rec is None or rec['key'] != key:
+            return False
+        if not all(os.path.exists(p) for p in exists):
+            return False
+        for p in outputs:
+            s = stamp(p)
+            if s is None or s != rec['outputs'].get(p):
+                return False
+        return True
+
+    def start(self, step, inputs=(), params=None, deps=(), outputs=(), exists=(),
+              always=False):
+        """Return True if the step has to run, False if it is up to date.
+
+        exists lists products that must be present but may legitimately be
+        modified by later steps (e.g. mvis after concat), so are not stamped.
+        always=True runs the step regardless (cheap steps that only report).
+        """
+        key = self.key(inputs, params, deps)
+        if not always and step not in self.force and self.current(step, key, outputs, exists):
+            print('Step ', step, 'up to date, skipping')
+            if self.ledger is not None and not self.dryrun:
+                self.ledger.skipped(step)
+            return False
+        if self.dryrun:
+            if self.plan is not None:
+                self.plan.show(step)
+            else:
+                print('Step ', step, 'would run')
+            return False
+        self._pending[step] = (key, list(outputs))
+        if self.tracer is not None:
+            model = self.plan.model_s(step) if self.plan is not None else None
+            self.tracer.begin('Step %s' % step, args={'model_s': model} if model else None)
+        if self.ledger is not None:
+            self.ledger.begin(step, params)
+        return True
+
+    def finish(self, step):
+        """Record a completed step; call at the end of its block."""
+        key, outputs = self._pending.pop(step)
+        ev = None
+        if self.tracer is not None:
+            ev = self.tracer.end('Step %s' % step, outputs)
+        if self.ledger is not None:
+            self.ledger.finish(step, ev=ev)
+        run = self.state.get(str(step), {}).get('run', 0) + 1
+        self.state[str(step)] = {'key': key, 'run': run,
+                                 'outputs': {p: stamp(p) for p in outputs}}
+        self.save()
+
+    def save(self):
+        tmp = self.statefile + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.statefile)
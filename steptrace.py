@@ -0,0 +1,230 @@
+##############################################################
+# Per-step and per-task resource trace
+#
+# Records, for every traced step and CASA task call: wall and CPU time
+# (including child processes), the peak RSS during the call (this process
+# and its child processes, sampled every interval seconds from /proc, so
+# spikes shorter than that can be missed), the process peak so far (the
+# getrusage high-water mark, which only grows over a run), bytes
+# read/written (Linux /proc/self/io) and the size of the products the call wrote.  Written as
+# Chrome trace-event JSON (load in chrome://tracing or ui.perfetto.dev)
+# plus a plain-text summary table, one pair of files per run.
+#
+#   tracer = steptrace.Tracer(mvis+'_trace')
+#   tracer.instrument(globals(), casatasks)   # wrap tclean, gaincal, ...
+#   with tracer.span('Step 3'): ...
+##############################################################
+
+import functools
+import glob
+import itertools
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+TASKS = ['concat', 'tclean', 'gaincal', 'applycal', 'mstransform', 'split',
+         'flagdata', 'imstat', 'imfit', 'imageconcat', 'imsmooth', 'listobs']
+
+# task arguments naming what a task writes
+_PRODUCTS = ['imagename', 'caltable', 'outputvis', 'concatvis', 'outfile', 'listfile']
+
+
+def _io():
+    """(read_bytes, write_bytes) of this process, or (0, 0) if unavailable."""
+    try:
+        with open('/proc/self/io') as f:
+            d = dict(line.split(': ') for line in f.read().splitlines())
+        return int(d['read_bytes']), int(d['write_bytes'])
+    except (IOError, OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _cpu():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _maxrss():
+    """Process peak so far: RSS high-water mark in MB of this process and its
+    waited-for children since they started (not of the current call)."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+def _rss():
+    """Current RSS in MB of this process and its descendants, or None without /proc."""
+    pids, todo = [], [os.getpid()]
+    while todo:
+        p = todo.pop()
+        pids.append(p)
+        try:
+            for t in os.listdir('/proc/%d/task' % p):
+                with open('/proc/%d/task/%s/children' % (p, t)) as f:
+                    todo.extend(int(c) for c in f.read().split())
+        except (IOError, OSError, ValueError):
+            pass
+    kb = None
+    for p in pids:
+        try:
+            with open('/proc/%d/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        kb = (kb or 0) + int(line.split()[1])
+                        break
+        except (IOError, OSError, ValueError):       # exited meanwhile
+            pass
+    return None if kb is None else kb / 1024.
+
+
+def du(path):
+    """Size in bytes of a file or directory tree."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def products(kwargs):
+    """Paths a task call writes, from its arguments (imagename.* etc.)."""
+    out = []
+    for k in _PRODUCTS:
+        v = kwargs.get(k)
+        if not v:
+            continue
+        out.extend(sorted(glob.glob(v + '.*')) if k == 'imagename' else [v])
+    return out
+
+
+def runid():
+    """Run id: start time, process and a random suffix, so runs of several
+    bands started in the same second (batch.py) do not share it."""
+    return '%s_%d_%s' % (time.strftime('%Y%m%d_%H%M%S'), os.getpid(), uuid.uuid4().hex[:4])
+
+
+class Tracer(object):
+    """Collects trace events; saves prefix+'_<run>.json' and '_<run>.txt'."""
+
+    def __init__(self, prefix, run=None, interval=0.5):
+        self.run = run or runid()
+        self.jsonfile = '%s_%s.json' % (prefix, self.run)
+        self.txtfile = '%s_%s.txt' % (prefix, self.run)
+        self.events = []
+        self.t0 = time.time()
+        self._open = {}
+        self.interval = interval
+        self._peaks = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._calls = itertools.count()
+
+    def _sample(self):
+        """Update the peak RSS of the open calls until none is open."""
+        while True:
+            rss = _rss()
+            with self._lock:
+                if not self._peaks:
+                    self._sampler = None
+                    return
+                for k, v in self._peaks.items():
+                    if rss is not None and (v is None or rss > v):
+                        self._peaks[k] = rss
+            time.sleep(self.interval)
+
+    def begin(self, name, cat='step', args=None):
+        self._open[name] = (cat, args or {}, time.time(), _cpu(), _io())
+        with self._lock:
+            self._peaks[name] = _rss()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='steptrace')
+                self._sampler.daemon = True
+                self._sampler.start()
+
+    def end(self, name, products=()):
+        cat, args, t0, c0, (r0, w0) = self._open.pop(name)
+        rss = _rss()
+        with self._lock:
+            peak = self._peaks.pop(name, None)
+        peak = max(p for p in (peak, rss, 0.) if p is not None)
+        r1, w1 = _io()
+        ev = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': 1,
+              'ts': int((t0 - self.t0) * 1e6), 'dur': int((time.time() - t0) * 1e6),
+              'args': dict(args, cpu=round(_cpu() - c0, 3),
+                           peakrss_mb=round(peak, 1) if peak else None,
+                           procpeak_mb=round(_maxrss(), 1),
+                           read_bytes=r1 - r0, write_bytes=w1 - w0,
+                           products={p: du(p) for p in products if os.path.exists(p)})}
+        self.events.append(ev)
+        if cat == 'step':
+            self.save()
+        return ev
+
+    @contextmanager
+    def span(self, name, cat='step', args=None, products=()):
+        self.begin(name, cat, args)
+        try:
+            yield
+        finally:
+            self.end(name, products)
+
+    def wrap(self, func, name=None):
+        """Trace every call of a CASA task (or any function)."""
+        name = name or func.__name__
+        if getattr(func, '_traced', False):
+            return func
+
+        @functools.wraps(func)
+        def traced(*args, **kwargs):
+            with self._lock:                         # traced tasks may run in threads (mmspart.pmap)
+                key = '%s#%d' % (name, next(self._calls))
+            self.begin(key, 'task', {'task': name})
+            try:
+                return func(*args, **kwargs)
+            finally:
+                ev = self.end(key, products(kwargs))
+                ev['name'] = name
+        traced._traced = True
+        return traced
+
+    def instrument(self, *namespaces, tasks=TASKS):
+        """Replace the named tasks in dicts (e.g. globals()) or modules by traced versions."""
+        for ns in namespaces:
+            for t in tasks:
+                if isinstance(ns, dict):
+                    if t in ns:
+                        ns[t] = self.wrap(ns[t], t)
+                elif hasattr(ns, t):
+                    setattr(ns, t, self.wrap(getattr(ns, t), t))
+
+    def summary(self):
+        """Text table of the events, one line each."""
+        lines = ['%-28s %10s %10s %9s %9s %10s %10s %10s' % (
+            'name', 'wall (s)', 'cpu (s)', 'peak (MB)', 'proc (MB)', 'read (MB)', 'write (MB)',
+            'prod (MB)')]
+        lines.append('  peak: RSS sampled during the call; proc: process peak so far')
+        for ev in sorted(self.events, key=lambda e: e['ts']):
+            a = ev['args']
+            indent = '  ' if ev['cat'] == 'task' else ''
+            peak = a.get('peakrss_mb')
+            lines.append('%-28s %10.1f %10.1f %9s %9.0f %10.1f %10.1f %10.1f' % (
+                indent + ev['name'], ev['dur'] / 1e6, a['cpu'], '-' if peak is None else '%.0f' % peak,
+                a.get('procpeak_mb', a.get('maxrss_mb')),
+                a['read_bytes'] / 1e6, a['write_bytes'] / 1e6,
+                sum(a['products'].values()) / 1e6))
+        return '\n'.join(lines)
+
+    def save(self):
+        with open(self.jsonfile, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                       'otherData': {'run': self.run}}, f)
+        with open(self.txtfile, 'w') as f:
+            f.write(self.summary() + '\n')
@@ -0,0 +1,90 @@
+##############################################################
+# Synthetic visibilities shaped like 2021.1.00917.S
+#
+# No CASA needed: arrays are laid out as casatools table getcol returns them
+# (DATA is (ncorr, nchan, nrow) complex64 per spw, one row per baseline and
+# integration), so the NumPy engines can be checked and timed on a plain
+# Linux box.
+#
+#   vis = synthvis.make(nant=12, nspw=4, ntime=30)
+#   vis['data'][spw], vis['flag'][spw], vis['ant1'], vis['uvw'], ...
+#
+# Sky: a point source at the phase centre with a power-law continuum plus
+# Gaussian line emission offset from it; antenna phase (and optionally
+# amplitude) errors are applied as per-antenna gains.
+##############################################################
+
+import numpy as np
+
+C = 299792458.
+
+
+def baselines(nant):
+    a1, a2 = np.triu_indices(nant, 1)
+    return a1.astype(np.int32), a2.astype(np.int32)
+
+
+def make(nant=12, nspw=4, nchan=128, ntime=30, ncorr=2, chanwidth=15.625e6,
+         freq0=211e9, spwstep=1.9e9, flux=5e-3, alpha=2.5, nlines=2,
+         lineflux=20e-3, lineoffset=(0.3, -0.2), noise=1e-3,
+         phaseerr=30., amperr=0.1, inttime=6.048, maxbl=1500., seed=1):
+    """Synthetic dataset; returns a dict of arrays (see module header).
+
+    phaseerr is the rms antenna phase error in degrees, amperr the rms
+    fractional amplitude error, lineoffset the line source (l, m) in arcsec.
+    Lines are placed at random channels in every other spw; 'linemask' gives
+    the channels they cover in each spw.
+    """
+    rng = np.random.default_rng(seed)
+    a1, a2 = baselines(nant)
+    nbl = len(a1)
+    nrow = nbl * ntime
+
+    # antenna positions (m) and uvw rotating with hour angle
+    pos = rng.uniform(-maxbl / 2, maxbl / 2, size=(nant, 2))
+    ha = np.linspace(-0.5, 0.5, ntime) * np.pi / 12 * (ntime * inttime / 3600.)
+    bl = pos[a2] - pos[a1]
+    cosh, sinh = np.cos(ha)[:, None], np.sin(ha)[:, None]
+    u = (bl[None, :, 0] * cosh - bl[None, :, 1] * sinh).ravel()
+    v = (bl[None, :, 0] * sinh + bl[None, :, 1] * cosh).ravel()
+    uvw = np.vstack((u, v, np.zeros(nrow)))
+    time = np.repeat(4.9e9 + np.arange(ntime) * inttime, nbl)
+    ant1 = np.tile(a1, ntime)
+    ant2 = np.tile(a2, ntime)
+
+    # per-antenna gains per integration (slow random walk in phase)
+    ph = np.cumsum(rng.normal(0, phaseerr / np.sqrt(ntime), size=(ntime, nant, ncorr)), axis=0)
+    ph -= ph.mean(axis=0)
+    amp = 1 + rng.normal(0, amperr, size=(nant, ncorr))
+    gains = amp[None] * np.exp(1j * np.deg2rad(ph))          # (ntime, nant, ncorr)
+    tidx = np.repeat(np.arange(ntime), nbl)
+    gij = gains[tidx, ant1] * np.conj(gains[tidx, ant2])     # (nrow, ncorr)
+
+    l, m = np.deg2rad(np.asarray(lineoffset) / 3600.)
+    out = {'nant': nant, 'ncorr': ncorr, 'ant1': ant1, 'ant2': ant2,
+           'time': time, 'uvw': uvw, 'inttime': inttime, 'gains': gains,
+           'freq': [], 'data': [], 'model': [], 'flag': [], 'weight': [],
+           'linemask': []}
+    for s in range(nspw):
+        freq = freq0 + s * spwstep + np.arange(nchan) * chanwidth
+        cont = flux * (freq / freq0)**alpha
+        linespec = np.zeros(nchan)
+        lmask = np.zeros(nchan, dtype=bool)
+        if s % 2 == 0:
+            for c in rng.integers(15, nchan - 15, size=nlines):
+                w = rng.uniform(1.5, 4.)
+                linespec += lineflux * np.exp(-0.5 * ((np.arange(nchan) - c) / w)**2)
+                lmask[max(0, int(c - 4 * w)):int(c + 4 * w) + 1] = True
+        phase = -2j * np.pi * (u[:, None] * l + v[:, None] * m) * freq[None, :] / C
+        sky = cont[None, :] + linespec[None, :] * np.exp(phase)          # (nrow, nchan)
+        data = gij.T[:, :, None] * sky[None]                               # (ncorr, nrow, nchan)
+        data = data + noise * (rng.standard_normal(data.shape) +
+                               1j * rng.standard_normal(data.shape)) / np.sqrt(2)
+        out['freq'].append(freq)
+        out['data'].append(np.ascontiguousarray(data.transpose(0, 2, 1)).astype(np.complex64))
+        out['model'].append(np.broadcast_to(cont[None, :, None],
+                                            (ncorr, nchan, nrow)).astype(np.complex64))
+        out['flag'].append(np.zeros((ncorr, nchan, nrow), dtype=bool))
+        out['weight'].append(np.full((ncorr, nrow), 1. / noise**2, dtype=np.float32))
+        out['linemask'].append(lmask)
+    return out
@@ -0,0 +1,224 @@
+##############################################################
+# Streaming uv-continuum subtraction (alternative to step 12 mstransform)
+#
+# For each spw the polynomial design matrix A (nchan x order+1) and its
+# pseudo-inverse over the line-free channels are computed once, giving a
+# projector P = A pinv(A[free]) (nchan x nfree).  Each block of rows is
+# then continuum-subtracted with one batched matrix multiply
+#     data - P @ data[free]
+# (P cast to the data type, so a complex64 block stays complex64 and the
+# product goes to BLAS).  Spectra with flagged line-free channels are
+# refitted with a projector per flag pattern, all spectra sharing a pattern
+# at once; spectra with too few unflagged line-free channels get no fit.  Blocks
+# are read in order, fitted in a thread pool with a bounded number in
+# flight, and written back, so memory is set by nrow and nworkers.
+#
+# The output is laid out as mstransform(douvcontsub=True) writes it: a new
+# MS whose DATA column holds the continuum-subtracted corrected data.
+#
+#   diag = uvcontsub.run(mvis, mvis+'.contsub', contsel, fitorder=1)
+#
+# python uvcontsub.py checks the engine on synthetic visibilities.
+##############################################################
+
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def projector(mask, order=1):
+    """(nchan, nfree) matrix mapping line-free channels to the fitted continuum."""
+    nchan = len(mask)
+    x = np.linspace(-1., 1., nchan)
+    a = np.vander(x, order + 1, increasing=True)
+    return a @ np.linalg.pinv(a[mask])
+
+
+def _refit(data, flag, mask, bad, model, order):
+    """Refit the continuum of the bad (ncorr, nrow) spectra of model in place,
+    from their unflagged line-free channels, one projector per flag pattern."""
+    p, r = np.nonzero(bad)
+    free = np.flatnonzero(mask)
+    patterns, inv = np.unique(flag[p, :, r][:, free], axis=0, return_inverse=True)
+    inv = inv.ravel()
+    for k, pat in enumerate(patterns):
+        use = mask.copy()
+        use[free[pat]] = False
+        i = np.flatnonzero(inv == k)
+        if use.sum() <= order:                      # (nearly) fully flagged: no fit
+            model[p[i], :, r[i]] = 0.
+            continue
+        proj = projector(use, order).astype(data.dtype)
+        model[p[i], :, r[i]] = data[p[i], :, r[i]][:, use] @ proj.T
+
+
+def subtract(data, flag, mask, proj, order=1):
+    """Continuum-subtract data (ncorr, nchan, nrow) with line-free mask.
+
+    Returns (residual, stats) where stats holds the sum of squares and count
+    of line-free residuals and the number of rows refitted for flags.
+    """
+    model = np.matmul(proj.astype(data.dtype), data[:, mask, :])
+    bad = flag[:, mask, :].any(axis=1)                  # (ncorr, nrow)
+    if bad.any():
+        _refit(data, flag, mask, bad, model, order)
+    res = (data - model).astype(data.dtype, copy=False)
+    good = ~flag[:, mask, :]
+    rf = res[:, mask, :][good]
+    return res, {'ss': float(np.sum(np.abs(rf)**2)), 'n': int(rf.size),
+                 'refit': int(bad.sum())}
+
+
+def _block(r0, n, data, flag, mask, proj, order):
+    return r0, n, subtract(data, flag, mask, proj, order)
+
+
+def _spwmap(vis):
+    from casatools import table
+    tb = table()
+    tb.open(vis + '/DATA_DESCRIPTION')
+    try:
+        return tb.getcol('SPECTRAL_WINDOW_ID')
+    finally:
+        tb.close()
+
+
+def _subtractms(vis, fitsel, fitorder, nrow, nworkers):
+    """Continuum-subtract DATA of one MS (or sub-MS) in place; {spw: sums}."""
+    from casatools import table
+    spwmap = _spwmap(vis)
+    sums = {}
+    tb = table()
+    tb.open(vis, nomodify=False)
+    try:
+        for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+            spw = int(spwmap[ddid])
+            if spw not in fitsel:
+                sums[spw] = None
+                continue
+            sub = tb.query('DATA_DESC_ID==%d' % ddid)
+            nchan = sub.getcell('DATA', 0).shape[1]
+            mask = fitsel.mask(spw, nchan)
+            proj = projector(mask, fitorder)
+            tot = {'ss': 0., 'n': 0, 'refit': 0}
+            pending = deque()
+
+            def write(fut):
+                r0, n, (res, st) = fut.result()
+                sub.putcol('DATA', res, r0, n)
+                for k in tot:
+                    tot[k] += st[k]
+
+            with ThreadPoolExecutor(max_workers=nworkers) as pool:
+                for r0 in range(0, sub.nrows(), nrow):
+                    n = min(nrow, sub.nrows() - r0)
+                    data = sub.getcol('DATA', r0, n)
+                    flag = sub.getcol('FLAG', r0, n)
+                    pending.append(pool.submit(_block, r0, n, data, flag, mask, proj, fitorder))
+                    # bound the blocks held in memory
+                    while len(pending) > 2 * nworkers:
+                        write(pending.popleft())
+                while pending:
+                    write(pending.popleft())
+            tot['nrow'] = int(sub.nrows())
+            sums[spw] = tot
+            sub.close()
+        tb.flush()
+    finally:
+        tb.close()
+    return sums
+
+
+def run(vis, outputvis, fitsel, fitorder=1, nrow=20000, nworkers=4, datacolumn='corrected'):
+    """Continuum-subtract vis into outputvis using the channels in fitsel.
+
+    fitsel is a chansel.ChanSel of line-free channels (e.g. contsel).  Returns
+    per-spw diagnostics (rms of the line-free fit residuals, rows, refits),
+    also written to outputvis+'.fitdiag.json'.  If vis is a multi-MS, so is
+    outputvis, and its sub-MSs are subtracted concurrently, sharing the
+    nworkers threads.
+    """
+    import casatasks
+    import mmspart
+
+    os.system('rm -rf ' + outputvis + ' ' + outputvis + '.flagversions')
+    casatasks.split(vis=vis, outputvis=outputvis, datacolumn=datacolumn, keepflags=True)
+    nparts = len(mmspart.parts(outputvis))
+    inner = max(1, nworkers // nparts)
+    tot = {}
+    for sums in mmspart.pmap(lambda p: _subtractms(p, fitsel, fitorder, nrow, inner),
+                             outputvis, nworkers):
+        for spw, st in sums.items():
+            if st is None:
+                tot.setdefault(spw, None)
+                continue
+            t = tot.get(spw) or {'ss': 0., 'n': 0, 'refit': 0, 'nrow': 0}
+            tot[spw] = {k: t[k] + st[k] for k in t}
+    diag = {}
+    for spw in sorted(tot):
+        t = tot[spw]
+        if t is None:
+            print('spw %d has no line-free channels, not subtracted' % spw)
+            continue
+        diag[spw] = {'rms': float(np.sqrt(t['ss'] / max(t['n'], 1))),
+                     'nrow': t['nrow'],
+                     'refit': t['refit']}
+    with open(outputvis + '.fitdiag.json', 'w') as f:
+        json.dump(diag, f, indent=1, sort_keys=True)
+    return diag
+
+
+def selftest(nspw=4, fitorder=1, seed=2):
+    """Check subtract() on synthetic visibilities; returns the max errors.
+
+    Verifies the output keeps the DATA layout and dtype (ncorr, nchan, nrow)
+    complex64, that a continuum of order fitorder is removed to noise level
+    in the line-free channels, that the lines survive, and that the batched
+    result matches a per-spectrum np.polyfit reference, including rows with
+    flagged line-free channels, and that fully flagged spectra are left as they are.
+    """
+    import chansel
+    import synthvis
+    vis = synthvis.make(nspw=nspw, ntime=10, phaseerr=0., amperr=0., seed=seed)
+    rng = np.random.default_rng(seed)
+    worst = {'ref': 0., 'cont': 0., 'line': 0.}
+    for s in range(nspw):
+        data, flag = vis['data'][s], vis['flag'][s].copy()
+        ncorr, nchan, nrow = data.shape
+        lmask = vis['linemask'][s]
+        sel = chansel.ChanSel({s: np.flatnonzero(~lmask)[:, None].repeat(2, 1)})
+        mask = sel.mask(s, nchan)
+        flag[:, rng.integers(0, nchan, 5), rng.integers(0, nrow, 5)] = True
+        flag[0, :, 1] = True
+        res, st = subtract(data, flag, mask, projector(mask, fitorder), fitorder)
+        assert res.shape == data.shape and res.dtype == np.complex64
+        assert np.array_equal(res[0, :, 1], data[0, :, 1])
+        # reference: independent polyfit per spectrum on unflagged line-free channels
+        x = np.linspace(-1., 1., nchan)
+        for p in range(ncorr):
+            for r in range(0, nrow, max(1, nrow // 50)):
+                use = mask & ~flag[p, :, r]
+                if use.sum() <= fitorder:
+                    continue
+                d = data[p, :, r]
+                cre = np.polyval(np.polyfit(x[use], d[use].real, fitorder), x)
+                cim = np.polyval(np.polyfit(x[use], d[use].imag, fitorder), x)
+                ref = d - (cre + 1j * cim)
+                worst['ref'] = max(worst['ref'], float(np.max(np.abs(ref - res[p, :, r]))))
+        noise = np.sqrt(st['ss'] / st['n'])
+        worst['cont'] = max(worst['cont'], abs(noise - 1e-3) / 1e-3)
+        # line channels: residual should be data minus the true continuum
+        err = (res - (data - vis['model'][s]))[:, lmask, :].mean(axis=2)
+        if lmask.any():
+            worst['line'] = max(worst['line'], float(np.abs(err).max()) / 20e-3)
+    return worst
+
+
+if __name__ == '__main__':
+    w = selftest()
+    print('max |engine - polyfit| %.2e, line-free rms vs noise %.1f%%, line error %.1f%% of peak'
+          % (w['ref'], 100. * w['cont'], 100. * w['line']))
+    assert w['ref'] < 1e-5 and w['cont'] < 0.05 and w['line'] < 0.05